@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Benchmarks for the search data structures.
+
+USAGE:
+    python benchmark.py {autocomplete,build,fuzzy,postings,presence} [sizes...]
+"""
+
+import random
+import sys
+import time
+
+from collections import defaultdict
+from string import letters # [a-zA-Z]
+
+import search1
+import search2
+import search3
+import suffixarray
+
+def random_strings(count, min_length=4, max_length=16, seed=0):
+    """
+    Generates a reproducible list of random [a-zA-Z] strings
+    """
+    generator = random.Random(seed)
+    return [''.join(generator.choice(letters) for _ in
+        range(generator.randint(min_length, max_length)))
+        for _ in range(count)]
+
+def timed(function, *args):
+    """
+    Returns the wall-clock seconds taken to call function(*args)
+    """
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+def insert_loop(strings):
+    suffix_array = suffixarray.SuffixArray()
+    for string in strings:
+        suffix_array.insert(string)
+    return suffix_array
+
+def benchmark_build(sizes):
+    """
+    Compares SuffixArray.build against inserting the same strings one by one
+    """
+    print("%10s %14s %14s" % ("strings", "insert loop", "build"))
+    for size in sizes:
+        strings = random_strings(size)
+        print("%10d %13.2fs %13.2fs" % (size, timed(insert_loop, strings),
+            timed(suffixarray.SuffixArray.build, strings)))
+
+def dict_of_sets_size(dictionary):
+    """
+    Approximate bytes held by a dictionary of sets, counting keys and sets
+    but not the (shared) set members
+    """
+    return sys.getsizeof(dictionary) + sum(sys.getsizeof(key) +
+        sys.getsizeof(value) for key, value in dictionary.iteritems())
+
+def benchmark_fuzzy(sizes):
+    """
+    Compares ingest time and memory of search2's precomputed fuzzy indexes
+    """
+    print("%10s %10s %12s %12s %14s" % ("strings", "index", "ingest", "keys",
+        "bytes"))
+    for size in sizes:
+        strings = random_strings(size)
+        for name in ('variants', 'wildcards'):
+            index = search2.INDEXES[name]()
+            start = time.time()
+            for string in strings:
+                index.add(string)
+            print("%10d %10s %11.2fs %12d %14d" % (size, name,
+                time.time() - start, len(index.substring_dict),
+                dict_of_sets_size(index.substring_dict)))
+
+def substring_sets(strings):
+    """
+    Builds search1's original substring index: a set of strings per key
+    """
+    substring_dict = defaultdict(set)
+    for string in strings:
+        for i in range(len(string)):
+            for j in range(i + 1, len(string) + 1):
+                substring_dict[string[i:j]].add(string)
+    return substring_dict
+
+def postings_size(index, dictionary):
+    """
+    Approximate bytes held by one of search1's interned indexes, counting
+    its keys, posting arrays and document table but not the (shared)
+    strings themselves
+    """
+    return sys.getsizeof(dictionary) + sum(sys.getsizeof(key) +
+        sys.getsizeof(value) for key, value in dictionary.iteritems()) + \
+        sys.getsizeof(index.documents) + sys.getsizeof(index.document_ids)
+
+def benchmark_postings(sizes):
+    """
+    Compares the memory held by search1's substring index with sets of
+    strings, with interned IDs in posting arrays, and by its trigram index
+    """
+    print("%10s %12s %14s %14s %14s" % ("strings", "keys", "sets",
+        "postings", "trigrams"))
+    for size in sizes:
+        strings = random_strings(size, 4, 8)
+        sets_bytes = dict_of_sets_size(substring_sets(strings))
+        index = search1.SubstringIndex()
+        trigrams = search1.TrigramIndex()
+        for string in strings:
+            index.add(string)
+            trigrams.add(string)
+        print("%10d %12d %14d %14d %14d" % (size, len(index.substring_dict),
+            sets_bytes, postings_size(index, index.substring_dict),
+            postings_size(trigrams, trigrams.trigram_dict)))
+
+def benchmark_presence(sizes):
+    """
+    Compares the memory held by search3's substring set with its Bloom
+    filter index, built in bulk
+    """
+    print("%10s %12s %14s %14s" % ("strings", "substrings", "set",
+        "bloom"))
+    for size in sizes:
+        strings = random_strings(size, 4, 8)
+        index = search3.SubstringSetIndex()
+        for string in strings:
+            index.add(string)
+        substring_set = index.substring_set
+        set_bytes = sys.getsizeof(substring_set) + sum(sys.getsizeof(key)
+            for key in substring_set)
+        print("%10d %12d %14d %14d" % (size, len(substring_set), set_bytes,
+            search3.BloomIndex.build(strings).filter.nbytes))
+
+def benchmark_autocomplete(sizes, keystrokes=1000):
+    """
+    Times completions of the prefixes typed on the way to random documents,
+    one keystroke at a time, the first time each prefix is asked for (when
+    popular ones fill the top-K table) and again afterwards
+    """
+    print("%10s %14s %14s %14s %14s" % ("strings", "first mean", "first max",
+        "again mean", "again max"))
+    for size in sizes:
+        strings = random_strings(size)
+        suffix_array = suffixarray.SuffixArray.build(strings)
+        generator = random.Random(size)
+        prefixes = []
+        for _ in range(keystrokes // 4):
+            string = generator.choice(strings)
+            prefixes.extend(string[:length] for length in range(1, 5))
+        columns = []
+        for _ in range(2):
+            seconds = [timed(suffix_array.completions, prefix)
+                for prefix in prefixes]
+            columns.extend([sum(seconds) / len(seconds), max(seconds)])
+        print("%10d %12.3fms %12.3fms %12.3fms %12.3fms" % ((size,) +
+            tuple(1000 * column for column in columns)))
+
+BENCHMARKS = {
+    'autocomplete': (benchmark_autocomplete, [10000, 100000, 1000000]),
+    'build': (benchmark_build, [10000, 100000, 1000000]),
+    'fuzzy': (benchmark_fuzzy, [100, 1000]),
+    'postings': (benchmark_postings, [10000, 100000]),
+    'presence': (benchmark_presence, [10000, 100000]),
+}
+
+def main(args):
+    """
+    Runs the named benchmark, optionally overriding its default sizes
+    """
+    if not args or args[0] not in BENCHMARKS:
+        sys.exit("usage: benchmark.py {%s} [sizes...]" %
+            ','.join(sorted(BENCHMARKS)))
+    benchmark, sizes = BENCHMARKS[args[0]]
+    benchmark([int(size) for size in args[1:]] or sizes)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
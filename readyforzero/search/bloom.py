@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Bloom filters: sets that can only be added to and tested, held in a bit
+array a small fraction the size of the keys themselves.
+
+A key that was added is always reported as present. A key that wasn't is
+reported as present (a false positive) with probability at most the
+filter's error rate.
+"""
+
+import hashlib
+import math
+import struct
+
+DEFAULT_ERROR_RATE = 0.001
+
+class BloomFilter(object):
+    """
+    A Bloom filter sized for a fixed number of keys. Each key sets hashes
+    bits of a bytearray, chosen by double hashing an MD5 digest of the key.
+
+    Args:
+        capacity:   the number of keys the error rate holds up to
+        error_rate: the false positive rate at capacity
+    """
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) /
+            math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / float(capacity) *
+            math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+    def positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        first, second = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        """
+        Adds a key, returning whether it was new (or rather, whether it set
+        any bits that weren't already set)
+        """
+        new = False
+        bits = self.bits
+        for position in self.positions(key):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(key))
+
+class ScalableBloomFilter(object):
+    """
+    A Bloom filter that grows as keys are added, by chaining filters of
+    doubling capacity. Each filter's error rate is half its predecessor's,
+    with the first's chosen so that together they never exceed error_rate.
+    """
+    GROWTH = 2
+    TIGHTENING = 0.5
+
+    def __init__(self, error_rate=DEFAULT_ERROR_RATE, initial_capacity=1024):
+        self.error_rate = error_rate
+        self.filters = [BloomFilter(initial_capacity,
+            error_rate * (1 - self.TIGHTENING))]
+
+    @property
+    def nbytes(self):
+        return sum(bloom_filter.nbytes for bloom_filter in self.filters)
+
+    def add(self, key):
+        if key in self:
+            return False
+        current = self.filters[-1]
+        if current.count >= current.capacity:
+            current = BloomFilter(current.capacity * self.GROWTH,
+                current.error_rate * self.TIGHTENING)
+            self.filters.append(current)
+        return current.add(key)
+
+    def __contains__(self, key):
+        return any(key in bloom_filter for bloom_filter in self.filters)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A cache of serialized search responses, shared by the search applications.
+
+Entries are keyed by request URI (so paging and fuzzy arguments are part of
+the key) and tagged with the index generation they were computed from. Any
+add to the index bumps its generation, which makes every older entry a miss.
+"""
+
+import json
+import time
+import tornado.web
+
+from collections import OrderedDict
+
+class ResponseCache(object):
+    """
+    An LRU cache of response bodies with an optional TTL.
+
+    Args:
+        max_entries:    the number of responses to keep
+        ttl:            seconds before an entry expires, or None to only
+                        expire entries when the index changes
+    """
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        """
+        Returns the cached body for key, if it was computed from the given
+        index generation and hasn't expired
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry_generation, expires, body = entry
+            if entry_generation == generation and \
+                    (expires is None or expires > time.time()):
+                self.entries[key] = entry
+                self.hits += 1
+                return body
+        self.misses += 1
+        return None
+
+    def put(self, key, generation, body):
+        self.entries.pop(key, None)
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (generation, expires, body)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def write_cached(self, handler, generation):
+        """
+        Writes the cached response for handler's request, if there is one.
+        Returns whether it did.
+        """
+        body = self.get(handler.request.uri, generation)
+        handler.set_header("X-Cache", "HIT" if body is not None else "MISS")
+        if body is None:
+            return False
+        handler.write(body)
+        return True
+
+    def store(self, handler, generation, body):
+        """
+        Caches the body written for handler's request
+        """
+        if body is not None:
+            self.put(handler.request.uri, generation, body)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+            'entries': len(self.entries)}
+
+class CacheStatsHandler(tornado.web.RequestHandler):
+    """
+    A handler to report the cache's hit and miss counters
+    """
+    def initialize(self, cache):
+        self.cache = cache
+
+    def get(self):
+        self.write(json.dumps(self.cache.stats()))
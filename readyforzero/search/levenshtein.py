@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A module for bounded edit distance matching
+"""
+
+class LevenshteinAutomaton(object):
+    """
+    A Levenshtein automaton that accepts any text starting with a string
+    within max_edits insertions, deletions or substitutions of the query.
+
+    States are (depth, row) pairs, where depth is how much text has been
+    consumed and row[j] is the edit distance between that text and query[:j],
+    capped at max_edits + 1. Only the diagonal band of width 2 * max_edits + 1
+    can fall under the cap, so each step costs O(max_edits) comparisons.
+    States can be kept and stepped again later, which lets callers walking
+    sorted text (or a trie) reuse the states of a shared prefix.
+
+    Args:
+        string:     the query
+        max_edits:  the largest edit distance that still counts as a match
+    """
+    def __init__(self, string, max_edits):
+        self.string = string
+        self.max_edits = max_edits
+
+    def start(self):
+        """
+        The state before any text has been consumed
+        """
+        limit = self.max_edits + 1
+        return 0, [min(j, limit) for j in range(len(self.string) + 1)]
+
+    def step(self, state, char):
+        """
+        The state after consuming one more character of text
+        """
+        depth, row = state
+        depth += 1
+        limit = self.max_edits + 1
+        new_row = [limit] * len(row)
+        new_row[0] = min(depth, limit)
+        for j in range(max(1, depth - self.max_edits),
+                min(len(self.string), depth + self.max_edits) + 1):
+            cost = 0 if self.string[j - 1] == char else 1
+            new_row[j] = min(new_row[j - 1] + 1, row[j - 1] + cost,
+                row[j] + 1, limit)
+        return depth, new_row
+
+    def is_match(self, state):
+        """
+        Whether the text consumed so far is within max_edits of the query
+        """
+        return state[1][-1] <= self.max_edits
+
+    def can_match(self, state):
+        """
+        Whether consuming more text could still lead to a match
+        """
+        return min(state[1]) <= self.max_edits
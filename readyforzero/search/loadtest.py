@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Load tests for the search applications.
+
+Each app is served from a child process holding a fresh index. A synthetic
+corpus is added to it, and then searches for substrings of the corpus are
+made, by a number of concurrent AsyncHTTPClient requests. Every run prints
+one JSON object per app, with the ingest rate, search throughput and
+p50/p95/p99 search latency, and the growth in the server's resident memory
+per indexed character, so that runs of different versions can be compared.
+
+USAGE:
+    python loadtest.py [--apps APP...] [--documents N] [--queries N]
+        [--concurrency N] [--min-length N] [--max-length N]
+        [--query-length N] [--batch-size N] [--timeout SECONDS] [--seed N]
+
+where an APP is a module name, optionally followed by one of its index
+backends (e.g. search1:trigrams).
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import sys
+import time
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import urllib
+
+import benchmark
+import search1
+import search2
+import search2_suffixarray
+import search3
+import segments
+import suffixarray
+
+APPS = {
+    'search1': search1,
+    'search2': search2,
+    'search2_suffixarray': search2_suffixarray,
+    'search3': search3,
+}
+
+def make_app(name):
+    """
+    Builds the application named by an APP argument, around a fresh index
+    """
+    module_name, _, index_name = name.partition(':')
+    module = APPS[module_name]
+    if module is search2_suffixarray:
+        factory = suffixarray.SuffixArray
+    else:
+        factory = module.INDEXES[index_name or default_index(module)]
+    return module.make_application(segments.SegmentedIndex(factory))
+
+def default_index(module):
+    """
+    Returns the name of the index backend an app uses by default
+    """
+    for name, factory in module.INDEXES.items():
+        if factory is module.index.factory:
+            return name
+
+def serve(name, sockets):
+    """
+    Serves an app on already bound sockets until killed
+    """
+    # The parent's IOLoop can't be used once forked
+    io_loop = tornado.ioloop.IOLoop()
+    io_loop.make_current()
+    server = tornado.httpserver.HTTPServer(make_app(name))
+    server.add_sockets(sockets)
+    io_loop.start()
+
+def resident_memory(pid):
+    """
+    Returns the resident memory of a process in bytes, or None where /proc
+    isn't available
+    """
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return None
+
+def percentile(latencies, percent):
+    """
+    Returns the nearest-rank percentile of a sorted list of latencies
+    """
+    rank = int(math.ceil(percent / 100.0 * len(latencies)))
+    return latencies[max(rank, 1) - 1]
+
+@tornado.gen.coroutine
+def drive(requests, concurrency):
+    """
+    Makes the given requests, concurrency at a time. Resolves to the sorted
+    latencies in seconds of those that succeeded, and the number that
+    failed (or timed out).
+    """
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True,
+        max_clients=concurrency)
+    pending = iter(requests)
+    latencies = []
+    failures = [0]
+
+    @tornado.gen.coroutine
+    def worker():
+        for request in pending:
+            start = time.time()
+            try:
+                yield client.fetch(request)
+            except Exception:
+                failures[0] += 1
+            else:
+                latencies.append(time.time() - start)
+
+    yield [worker() for _ in range(concurrency)]
+    client.close()
+    raise tornado.gen.Return((sorted(latencies), failures[0]))
+
+def ingest_requests(url, corpus, batch_size, timeout):
+    """
+    Returns the requests that add the corpus, one string at a time or in
+    batches of batch_size
+    """
+    if not batch_size:
+        return [tornado.httpclient.HTTPRequest(url + '/add', method='POST',
+                body=urllib.urlencode({'string': string}),
+                request_timeout=timeout)
+            for string in corpus]
+    return [tornado.httpclient.HTTPRequest(url + '/add/batch', method='POST',
+            body='\n'.join(corpus[start:start + batch_size]),
+            request_timeout=timeout)
+        for start in range(0, len(corpus), batch_size)]
+
+def search_requests(url, corpus, count, length, timeout, generator):
+    """
+    Returns requests searching for random substrings of the corpus
+    """
+    requests = []
+    for _ in range(count):
+        string = generator.choice(corpus)
+        start = generator.randint(0, max(len(string) - length, 0))
+        requests.append(tornado.httpclient.HTTPRequest(
+            url + '/search/' + string[start:start + length],
+            request_timeout=timeout))
+    return requests
+
+def run(name, corpus, queries, concurrency=16, query_length=3,
+        batch_size=0, timeout=60, seed=0):
+    """
+    Load tests one app, returning a dictionary of measurements
+    """
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    url = 'http://127.0.0.1:%d' % sockets[0].getsockname()[1]
+    process = multiprocessing.Process(target=serve, args=(name, sockets))
+    process.daemon = True
+    process.start()
+    for socket in sockets:
+        socket.close()
+
+    try:
+        baseline = resident_memory(process.pid)
+        io_loop = tornado.ioloop.IOLoop.current()
+        ingest = ingest_requests(url, corpus, batch_size, timeout)
+        start = time.time()
+        _, ingest_failures = io_loop.run_sync(
+            lambda: drive(ingest, concurrency))
+        ingest_seconds = time.time() - start
+        resident = resident_memory(process.pid)
+
+        searches = search_requests(url, corpus, queries, query_length,
+            timeout, random.Random(seed))
+        start = time.time()
+        latencies, search_failures = io_loop.run_sync(
+            lambda: drive(searches, concurrency))
+        search_seconds = time.time() - start
+    finally:
+        process.terminate()
+        process.join()
+
+    characters = sum(len(string) for string in corpus)
+    return {
+        'app': name,
+        'documents': len(corpus),
+        'characters': characters,
+        'ingest_per_second': len(corpus) / ingest_seconds,
+        'ingest_failures': ingest_failures,
+        'searches': len(latencies),
+        'search_failures': search_failures,
+        'searches_per_second': len(latencies) / search_seconds,
+        'latency_ms': dict(('p%d' % percent,
+            1000 * percentile(latencies, percent) if latencies else None)
+            for percent in (50, 95, 99)),
+        'resident_bytes_per_character': (resident - baseline) /
+            float(characters) if resident is not None else None,
+    }
+
+def main(args):
+    """
+    Load tests each app named on the command line in turn
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--apps', nargs='+', default=sorted(APPS),
+        metavar='APP')
+    parser.add_argument('--documents', type=int, default=10000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--min-length', type=int, default=4)
+    parser.add_argument('--max-length', type=int, default=16)
+    parser.add_argument('--query-length', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=0,
+        help="add strings through /add/batch, this many at a time, rather "
+            "than one at a time through /add")
+    parser.add_argument('--timeout', type=float, default=60,
+        help="seconds before a request counts as failed")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(args)
+    corpus = benchmark.random_strings(args.documents, args.min_length,
+        args.max_length, args.seed)
+    for name in args.apps:
+        print(json.dumps(run(name, corpus, args.queries, args.concurrency,
+            args.query_length, args.batch_size, args.timeout, args.seed),
+            sort_keys=True))
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
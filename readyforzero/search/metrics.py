@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Request timings and index sizes for the search applications, served on
+/metrics in the Prometheus text format.
+
+Handlers time the phases of each request (looking up the index, selecting
+the page of results, serializing it...) by wrapping them in
+`with metrics.phase(handler, name)`. The phases of a finished request are
+added to a histogram per handler and phase.
+
+Optionally, a sampling profiler records the stacks seen during requests and
+writes out those of slow requests, in the collapsed format that
+flamegraph.pl reads.
+"""
+
+import contextlib
+import os
+import signal
+import time
+import tornado.gen
+import tornado.web
+
+from collections import Counter
+
+import suffixarray
+
+# Upper bounds of the timing histograms' buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+@contextlib.contextmanager
+def phase(handler, name):
+    """
+    Times the enclosed block as a phase of handler's request, if the
+    handler is instrumented
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings = getattr(handler, 'phase_timings', None)
+        if timings is not None:
+            timings.append((name, time.time() - start))
+
+class Histogram(object):
+    """
+    Cumulative counts of observations under each of BUCKETS, plus their sum
+    """
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for position, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[position] += 1
+        self.count += 1
+        self.sum += value
+
+def index_stats(index):
+    """
+    Sizes of an index: its generation, live documents, the entries its
+    segments hold (deleted and duplicate strings included) and tombstones,
+    plus whichever of lookup keys, automaton states, suffixes and the bytes
+    of suffix array buffers or Bloom filters its segments have
+    """
+    if hasattr(index, 'scatter'):
+        return index.combine_stats(index.scatter('stats'))
+
+    stats = Counter(generation=index.generation)
+    stats['segments'] = len(index.segments)
+    # A string can be in several segments, and a deleted one stays in its
+    # segment until it's compacted, so entries can outnumber documents
+    stats['entries'] = sum(len(strings)
+        for strings in index.segment_documents)
+    stats['documents'] = index.document_count()
+    stats['tombstones'] = len(index.tombstones)
+    for segment in index.segments:
+        for name in ('substring_dict', 'trigram_dict', 'substring_set'):
+            if hasattr(segment, name):
+                stats['keys'] += len(getattr(segment, name))
+        if hasattr(segment, 'filter'):
+            stats['bytes'] += segment.filter.nbytes
+        if hasattr(segment, 'automaton'):
+            stats['states'] += len(segment.automaton.transitions)
+        suffix_array = getattr(segment, 'suffix_array', segment)
+        if isinstance(suffix_array, suffixarray.SuffixArray):
+            stats['suffixes'] += len(suffix_array.array)
+            # int32 offsets, LCPs and document starts, and UTF-32 text
+            stats['bytes'] += 4 * (2 * len(suffix_array.array) +
+                len(suffix_array.document_starts) + len(suffix_array.text))
+    return stats
+
+@tornado.gen.coroutine
+def gather_index_stats(index):
+    """
+    Resolves to index_stats(index), waiting on a sharded index's shards
+    without blocking the IOLoop
+    """
+    if hasattr(index, 'scatter'):
+        stats = yield index.lookup('stats')
+    else:
+        stats = index_stats(index)
+    raise tornado.gen.Return(stats)
+
+class Metrics(object):
+    """
+    The timings of an application's requests, along with the index (and
+    response cache, if any) whose sizes are reported alongside them
+
+    Args:
+        profiler:   a Profiler to run during requests, or None
+    """
+    def __init__(self, index, cache=None, profiler=None):
+        self.index = index
+        self.cache = cache
+        self.profiler = profiler
+        self.histograms = {}
+
+    def observe(self, handler, phase, seconds):
+        key = (handler, phase)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(seconds)
+
+    def render(self, stats=None):
+        """
+        Returns every metric in the Prometheus text format, with the given
+        index stats (or index_stats of the index)
+        """
+        lines = [
+            "# HELP search_phase_seconds Time spent in each phase of a "
+                "request",
+            "# TYPE search_phase_seconds histogram",
+        ]
+        for (handler, phase), histogram in sorted(self.histograms.items()):
+            labels = 'handler="%s",phase="%s"' % (handler, phase)
+            for bound, count in zip(BUCKETS, histogram.buckets):
+                lines.append('search_phase_seconds_bucket{%s,le="%g"} %d' %
+                    (labels, bound, count))
+            lines.append('search_phase_seconds_bucket{%s,le="+Inf"} %d' %
+                (labels, histogram.count))
+            lines.append('search_phase_seconds_sum{%s} %r' %
+                (labels, histogram.sum))
+            lines.append('search_phase_seconds_count{%s} %d' %
+                (labels, histogram.count))
+
+        if stats is None:
+            stats = index_stats(self.index)
+        for name, value in sorted(stats.items()):
+            lines.append("# TYPE search_index_%s gauge" % name)
+            lines.append("search_index_%s %d" % (name, value))
+
+        if self.cache is not None:
+            stats = self.cache.stats()
+            for name in ('hits', 'misses'):
+                lines.append("# TYPE search_cache_%s_total counter" % name)
+                lines.append("search_cache_%s_total %d" %
+                    (name, stats[name]))
+            lines.append("# TYPE search_cache_entries gauge")
+            lines.append("search_cache_entries %d" % stats['entries'])
+        return "\n".join(lines) + "\n"
+
+class Profiler(object):
+    """
+    A sampling profiler for slow requests. While a request is running, the
+    stack is sampled every interval seconds of CPU time (with SIGPROF, so
+    only on Unix, and only in the main thread); if the request takes at
+    least threshold seconds, its samples are appended to path as collapsed
+    stacks. One request is profiled at a time, and since requests
+    interleave on the IOLoop, its samples can include other requests' work.
+    """
+    def __init__(self, path, threshold=0.1, interval=0.001):
+        self.path = path
+        self.threshold = threshold
+        self.interval = interval
+        self.samples = None
+        self.handler = None
+
+    def sample(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name,
+                os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.samples[";".join(reversed(stack))] += 1
+
+    def start(self, handler):
+        if self.handler is not None:
+            return
+        self.handler = handler
+        self.samples = Counter()
+        signal.signal(signal.SIGPROF, lambda signum, frame:
+            self.sample(frame))
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def finish(self, handler, seconds):
+        if handler is not self.handler:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        if seconds >= self.threshold:
+            self.dump()
+        self.handler = None
+
+    def dump(self):
+        with open(self.path, 'a') as stacks:
+            for stack, count in sorted(self.samples.items()):
+                stacks.write("%s %d\n" % (stack, count))
+
+class InstrumentedHandler(tornado.web.RequestHandler):
+    """
+    A handler whose requests are timed phase by phase (see phase), and in
+    total, into its metrics attribute if that's set
+    """
+    metrics = None
+
+    def prepare(self):
+        self.phase_timings = []
+        if self.metrics is not None and self.metrics.profiler is not None:
+            self.metrics.profiler.start(self)
+
+    def on_finish(self):
+        if self.metrics is None:
+            return
+        name = type(self).__name__
+        for phase_name, seconds in getattr(self, 'phase_timings', ()):
+            self.metrics.observe(name, phase_name, seconds)
+        total = self.request.request_time()
+        self.metrics.observe(name, 'total', total)
+        if self.metrics.profiler is not None:
+            self.metrics.profiler.finish(self, total)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    A handler to report metrics in the Prometheus text format
+    """
+    def initialize(self, registry):
+        self.metrics = registry
+
+    @tornado.gen.coroutine
+    def get(self):
+        stats = yield gather_index_stats(self.metrics.index)
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.metrics.render(stats))
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Pre-forked serving for the search applications.
+
+One writer process takes every add (and delete) and periodically publishes
+the index as a new generation in a shared directory: a snapshot file for
+each of its segments, a manifest listing them along with the deleted
+strings and each segment's strays (see segments.py), and a CURRENT file
+naming the manifest. A segment's snapshot is written by the first
+generation holding it and shared by later ones, so a generation only writes
+what changed: the live segment, if anything was added, and any segment a
+batch or compaction made. Any number of worker processes serve searches
+from the current generation, each segment memory-mapped read-only so that
+they all share one copy of its pages, and pick up newer generations as they
+appear without restarting, mapping only the segments they haven't yet.
+
+Deleted strings must never turn up once a delete has been answered, so the
+writer publishes a generation before it answers a delete (or an update), and
+workers look for a newer generation as each request arrives.
+"""
+
+import json
+import os
+import re
+import tempfile
+import tornado.gen
+import tornado.httpserver
+import tornado.ioloop
+import tornado.locks
+import tornado.netutil
+import tornado.process
+import tornado.routing
+import tornado.web
+
+import segments
+import snapshot
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.concurrent import run_on_executor
+
+# How often the writer publishes (if anything changed) and workers look for
+# a newer generation, in milliseconds
+PUBLISH_INTERVAL = 5000
+WATCH_INTERVAL = 1000
+
+class Generation(object):
+    """
+    What a segmented index holds, captured on the IOLoop so that it can be
+    written out on a worker thread: its segments, each one's strings (the
+    live segment's copied, since it keeps growing), the deleted strings and
+    each segment's strays
+    """
+    def __init__(self, index):
+        self.segments = index.segments
+        self.segment_documents = (list(index.segment_documents[0]),) + \
+            index.segment_documents[1:]
+        self.tombstones = list(index.tombstones)
+        self.strays = [list(index.strays.get(id(segment), ()))
+            for segment in self.segments]
+
+class GenerationStore(object):
+    """
+    A directory of numbered generation manifests and the segment snapshots
+    they list, with a CURRENT file naming the newest complete manifest.
+
+    Args:
+        directory:  where the generations live
+        keep:       how many generations to leave on disk. Workers that
+                    still map an older one's segments are unaffected by
+                    their removal.
+    """
+    GENERATION = re.compile(r'^generation-(\d+)\.json$')
+    SEGMENT = re.compile(r'^segment-\d+-\d+\.snapshot$')
+
+    def __init__(self, directory, keep=2):
+        self.directory = directory
+        self.keep = keep
+        # The snapshot of each segment (by id) written or loaded so far, as
+        # (segment, number of strings, name); the segment is held so that
+        # its id isn't reused
+        self.written = {}
+
+    def path(self, number):
+        return os.path.join(self.directory, 'generation-%d.json' % number)
+
+    def segment_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def current(self):
+        """
+        Returns the (number, path) of the current generation, or None if
+        nothing has been published yet
+        """
+        try:
+            with open(os.path.join(self.directory, 'CURRENT')) as current:
+                name = current.read().strip()
+        except IOError:
+            return None
+        return int(self.GENERATION.match(name).group(1)), \
+            os.path.join(self.directory, name)
+
+    def write_file(self, path, contents):
+        """
+        Writes a small file in full, then renames it into place
+        """
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory,
+            prefix='.generation-')
+        with os.fdopen(descriptor, 'w') as new_file:
+            new_file.write(contents)
+            new_file.flush()
+            os.fsync(new_file.fileno())
+        os.rename(temporary_path, path)
+
+    def publish(self, index):
+        """
+        Publishes a segmented index as the next generation, straight away
+        """
+        return self.write(Generation(index))
+
+    def write(self, generation):
+        """
+        Writes a captured Generation out as the next one. Only segments no
+        earlier generation wrote (or the live segment, once strings are added
+        to it) are snapshotted. The CURRENT file is only replaced (by
+        renaming over it) once the manifest and its segments are complete.
+        """
+        current = self.current()
+        number = current[0] + 1 if current else 1
+        written = {}
+        names = []
+        strays = []
+        for position, (segment, strings, held) in enumerate(zip(
+                generation.segments, generation.segment_documents,
+                generation.strays)):
+            if not strings:
+                continue
+            entry = self.written.get(id(segment))
+            if entry is None or entry[0] is not segment or \
+                    entry[1] != len(strings):
+                name = 'segment-%d-%d.snapshot' % (number, position)
+                snapshot.save_segment(segment, strings,
+                    self.segment_path(name), live=position == 0)
+                entry = (segment, len(strings), name)
+            written[id(segment)] = entry
+            names.append(entry[2])
+            strays.append(held)
+        self.written = written
+        self.write_file(self.path(number), json.dumps({'segments': names,
+            'tombstones': generation.tombstones, 'strays': strays}))
+        self.write_file(os.path.join(self.directory, 'CURRENT'),
+            os.path.basename(self.path(number)))
+
+        kept = set()
+        for name in os.listdir(self.directory):
+            match = self.GENERATION.match(name)
+            if match and int(match.group(1)) <= number - self.keep:
+                os.unlink(os.path.join(self.directory, name))
+            elif match:
+                kept.update(self.read(os.path.join(self.directory,
+                    name))['segments'])
+        for name in os.listdir(self.directory):
+            if self.SEGMENT.match(name) and name not in kept:
+                os.unlink(self.segment_path(name))
+        return number
+
+    def read(self, path):
+        with open(path) as manifest:
+            return json.load(manifest)
+
+    def load(self, index, path, mapped=None):
+        """
+        Swaps a segmented index over to the generation whose manifest is at
+        path. mapped holds the segments mapped for an earlier generation, by
+        name, along with their strings; those are reused rather than mapped
+        again. Returns the same for this generation's segments.
+        """
+        manifest = self.read(path)
+        mapped = mapped or {}
+        loaded = {}
+        for name in manifest['segments']:
+            if name in mapped:
+                loaded[name] = mapped[name]
+            else:
+                segment, strings = snapshot.restore_segment(index,
+                    self.segment_path(name))
+                loaded[name] = (segment, list(strings))
+        segments = [loaded[name][0] for name in manifest['segments']]
+        segment_documents = [loaded[name][1] for name in manifest['segments']]
+        index.replace_segments(segments, segment_documents,
+            manifest['tombstones'], manifest['strays'])
+        return loaded
+
+    def restore(self, index):
+        """
+        Loads the current generation into a restarted writer's index, so
+        that later generations share its segments' snapshots
+        """
+        loaded = self.load(index, self.current()[1])
+        self.written = dict((id(segment), (segment, len(strings), name))
+            for name, (segment, strings) in loaded.items())
+
+class Publisher(object):
+    """
+    Runs in the writer process, publishing the index whenever it has changed
+    since the last generation. The index is captured on the IOLoop, and its
+    new segments are written out on a worker thread.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def __init__(self, index, store):
+        self.index = index
+        self.store = store
+        self.published_generation = None
+        self.lock = tornado.locks.Lock()
+
+    @run_on_executor
+    def write(self, generation):
+        return self.store.write(generation)
+
+    @tornado.gen.coroutine
+    def check(self):
+        """
+        Publishes the index if it has changed since the last generation,
+        resolving once the changes made before the call are published. Calls
+        wait for any publish under way, so deletes arriving together share
+        the next one.
+        """
+        generation = self.index.generation
+        with (yield self.lock.acquire()):
+            if self.published_generation is None or \
+                    generation > self.published_generation:
+                # The generation holds every change made up to now
+                generation = self.index.generation
+                yield self.write(Generation(self.index))
+                self.published_generation = generation
+
+class Watcher(object):
+    """
+    Runs in each worker process, swapping the index over to the newest
+    generation whenever one is published. Segments it already maps are
+    kept, so only a generation's new segments are mapped.
+    """
+    def __init__(self, index, store):
+        self.index = index
+        self.store = store
+        self.loaded = None
+        self.mapped = {}
+
+    def check(self):
+        current = self.store.current()
+        if current is None or current[0] == self.loaded:
+            return
+        number, path = current
+        self.mapped = self.store.load(self.index, path, self.mapped)
+        self.loaded = number
+
+class WatchingRouter(tornado.routing.Router):
+    """
+    Routes a worker's requests to its application, first swapping in any
+    newer generation, so that a request never sees an index older than the
+    one published when it arrived
+    """
+    def __init__(self, application, watcher):
+        self.application = application
+        self.watcher = watcher
+
+    def find_handler(self, request, **kwargs):
+        self.watcher.check()
+        return self.application.find_handler(request, **kwargs)
+
+class WriterRedirectHandler(tornado.web.RequestHandler):
+    """
+    Sends writes arriving at a worker on to the writer process. A 307 keeps
+    the method and body, so clients simply POST again. The writer answers
+    deletes once they're published (see segments.DeleteHandler).
+    """
+    def initialize(self, writer_url):
+        self.writer_url = writer_url
+
+    def post(self):
+        self.redirect(self.writer_url + self.request.uri, status=307)
+
+def serve(make_application, make_index, workers, port, writer_port,
+        directory):
+    """
+    Forks a writer and the given number of search workers, then serves until
+    killed. Searches are answered on port; writes go to the writer on
+    writer_port (workers redirect any they receive).
+
+    Args:
+        make_application:   called as make_application(index, writer_url,
+                            publisher) to build each process' application;
+                            for the writer, writer_url is None and
+                            publisher is its Publisher, which deletes must
+                            wait on, while for workers publisher is None
+        make_index:         returns a fresh, empty segmented index
+    """
+    store = GenerationStore(directory)
+    sockets = tornado.netutil.bind_sockets(port)
+    task_id = tornado.process.fork_processes(workers + 1)
+    index = make_index()
+    if task_id == 0:
+        for socket in sockets:
+            socket.close()
+        if store.current() is not None:
+            store.restore(index)
+        publisher = Publisher(index, store)
+        publisher.published_generation = index.generation
+        make_application(index, None, publisher).listen(writer_port)
+        tornado.ioloop.PeriodicCallback(publisher.check,
+            PUBLISH_INTERVAL).start()
+        segments.Compactor(index).start()
+    else:
+        watcher = Watcher(index, store)
+        watcher.check()
+        server = tornado.httpserver.HTTPServer(WatchingRouter(
+            make_application(index, 'http://127.0.0.1:%d' % writer_port,
+                None), watcher))
+        server.add_sockets(sockets)
+        tornado.ioloop.PeriodicCallback(watcher.check, WATCH_INTERVAL).start()
+    tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Shared helpers for writing search results from the search applications.
+
+Results are returned in sorted order. A request can page through them with
+?limit=N and either ?offset=N or ?after=<last result seen>, and can ask for
+them to be streamed as JSON lines with ?stream=1. A page with more results
+behind it says where the next one starts: next_offset for offsets, or
+next_after (its last result) for ?after.
+
+Matches can be any iterable of strings, or a sorted view of them: an object
+whose iter_sorted(after, offset) method yields them in sorted order, lazily
+(see search1.Postings). Views are paged through without looking up any
+strings besides those returned.
+"""
+
+import heapq
+import itertools
+import json
+import tornado.gen
+import tornado.web
+
+import metrics
+
+# Number of results written between flushes when streaming
+STREAM_CHUNK_SIZE = 1000
+
+def int_argument(handler, name, default=None, minimum=0, maximum=None):
+    """
+    Reads an integer query argument, raising a 400 if it's malformed or out
+    of range
+    """
+    value = handler.get_argument(name, None)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise tornado.web.HTTPError(400, "%s must be an integer" % name)
+    if maximum is not None and not minimum <= value <= maximum:
+        raise tornado.web.HTTPError(400, "%s must be between %s and %s" %
+            (name, minimum, maximum))
+    if value < minimum:
+        if minimum == 1:
+            raise tornado.web.HTTPError(400,
+                "%s must be a positive integer" % name)
+        if minimum == 0:
+            raise tornado.web.HTTPError(400,
+                "%s must be a non-negative integer" % name)
+        raise tornado.web.HTTPError(400, "%s must be at least %s" %
+            (name, minimum))
+    return value
+
+def page_arguments(handler):
+    """
+    Reads the (limit, offset, after) page that handler's request asks for
+    """
+    return (int_argument(handler, 'limit', minimum=1),
+        int_argument(handler, 'offset', 0),
+        handler.get_argument('after', None))
+
+def select_results(matches, limit=None, offset=0, after=None):
+    """
+    Returns matches[offset:offset + limit] of the sorted matches, along with
+    whether any more follow. With a limit, only the smallest offset + limit
+    matches are ever sorted (a heap-based top-K), rather than all of them,
+    and of a sorted view, only the page (and one more) is taken.
+    """
+    if hasattr(matches, 'iter_sorted'):
+        selected = list(itertools.islice(matches.iter_sorted(after, offset),
+            None if limit is None else limit + 1))
+        if limit is None:
+            return selected, False
+        return selected[:limit], len(selected) > limit
+    if after is not None:
+        matches = [match for match in matches if match > after]
+    if limit is None:
+        return sorted(matches)[offset:], False
+    selected = heapq.nsmallest(offset + limit + 1, matches)
+    return selected[offset:offset + limit], len(selected) > offset + limit
+
+def iter_sorted(matches):
+    """
+    Yields matches in sorted order without sorting all of them up front, so
+    the first results of a broad query can go out straight away
+    """
+    heap = list(matches)
+    heapq.heapify(heap)
+    while heap:
+        yield heapq.heappop(heap)
+
+def iter_page(matches, after=None, offset=0):
+    """
+    Yields the sorted matches past after (if given), from offset on
+    """
+    if hasattr(matches, 'iter_sorted'):
+        return matches.iter_sorted(after, offset)
+    if after is not None:
+        matches = [match for match in matches if match > after]
+    return itertools.islice(iter_sorted(matches), offset, None)
+
+def streaming(handler):
+    """
+    Whether handler's request asked for results as JSON lines
+    """
+    return handler.get_argument('stream', '0') not in ('0', 'false')
+
+@tornado.gen.coroutine
+def write_results(handler, matches):
+    """
+    Writes the sorted matches for handler's request, honouring the paging
+    and streaming arguments. Resolves to the response body, or None if the
+    results were streamed.
+    """
+    limit, offset, after = page_arguments(handler)
+
+    if streaming(handler):
+        handler.set_header("Content-Type", "application/x-ndjson")
+        with metrics.phase(handler, 'stream'):
+            written = 0
+            for match in iter_page(matches, after, offset):
+                if limit is not None and written >= limit:
+                    break
+                handler.write(json.dumps(match) + "\n")
+                written += 1
+                if written % STREAM_CHUNK_SIZE == 0:
+                    yield handler.flush()
+        raise tornado.gen.Return(None)
+
+    with metrics.phase(handler, 'select'):
+        results, more = select_results(matches, limit, offset, after)
+    response = {'results': results}
+    if more and after is not None:
+        response['next_after'] = results[-1]
+    elif more:
+        response['next_offset'] = offset + limit
+    with metrics.phase(handler, 'serialize'):
+        body = json.dumps(response)
+    handler.write(body)
+    raise tornado.gen.Return(body)
@@ -5,67 +5,435 @@
 A light Tornado application that allows for search via substring matching.
 
 Returns results as a JSON-blog of the form: {"results": ["result_1", ...]}
+(see results.py for paging and streaming)
+
+USAGE:
+    python search1.py [--index {automaton,suffixarray,substrings,trigrams}]
+        [--snapshot PATH]
 """
 
-import json
+import argparse
+import bisect
+import cache
+import heapq
+import itertools
+import metrics
+import os
+import results
+import segments
+import shards
+import snapshot
+import suffixarray
+import suffixautomaton
+import sys
+import tornado.gen
 import tornado.ioloop
 import tornado.web
 
-from collections import defaultdict
+from array import array
 
-class FormHandler(tornado.web.RequestHandler):
+# Posting lists holding more than one in this many documents are paged
+# through by walking every document in sorted order
+DENSE_POSTINGS = 16
+
+class Postings(object):
     """
-    Including a form that can be used to add strings to the dictionary.
+    The documents holding a substring. Their IDs are kept in an array, and
+    are only looked up as strings as the results are iterated over. Paging
+    (see results.py) orders the IDs by their documents' ranks and looks up
+    only the page it returns.
+
+    Args:
+        ranks:  each document's rank in sorted order, by ID, and the IDs
+                in that order, or None if the IDs sort like their documents
     """
-    def get(self):
-        self.write('<html><body><form action="/add" method="post">'
-                '<input type="text" name="string">'
-                '<input type="submit" value="Submit">'
-                '</form></body></html>')
+    def __init__(self, documents, ids, ranks=None):
+        self.documents = documents
+        self.ids = ids
+        self.ranks = ranks
+
+    def __len__(self):
+        return len(self.ids)
 
-class AddHandler(tornado.web.RequestHandler):
+    def __iter__(self):
+        documents = self.documents
+        return (documents[document_id] for document_id in self.ids)
+
+    def iter_sorted(self, after=None, offset=0):
+        """
+        Yields the documents in sorted order, starting offset places past
+        after (or the start), looking each up only as it's reached
+        """
+        documents = self.documents
+        if self.ranks is None:
+            # A copy, since the live segment's posting lists grow
+            ids = self.ids[:]
+            start = first_after(documents, ids, after)
+            return (documents[document_id] for document_id in
+                itertools.islice(ids, start + offset, None))
+        ranks, order = self.ranks
+        lowest = first_after(documents, order, after)
+        if len(self.ids) * DENSE_POSTINGS > len(order):
+            # Most documents match, so walk them all in sorted order, keeping
+            # the matches, which soon fills a page
+            matching = bytearray(len(order))
+            for document_id in self.ids:
+                matching[document_id] = 1
+            ids = (document_id for document_id in
+                itertools.islice(order, lowest, None)
+                if matching[document_id])
+            return (documents[document_id] for document_id in
+                itertools.islice(ids, offset, None))
+        # Otherwise the matches' ranks are heaped and popped as they're
+        # needed, like results.iter_sorted does
+        heap = [ranks[document_id] for document_id in self.ids
+            if ranks[document_id] >= lowest]
+        heapq.heapify(heap)
+        return (documents[order[rank]] for rank in
+            itertools.islice(iter_heap(heap), offset, None))
+
+def first_after(documents, ids, after):
     """
-    Handler for adding strings
+    Returns the position of the first of the sorted IDs whose document sorts
+    past after (or 0 without one), looking up O(log n) documents
     """
-    def initialize(self, substring_dict):
-        self.substring_dict = substring_dict
+    start = 0
+    if after is not None:
+        end = len(ids)
+        while start < end:
+            middle = (start + end) // 2
+            if documents[ids[middle]] <= after:
+                start = middle + 1
+            else:
+                end = middle
+    return start
+
+def iter_heap(heap):
+    while heap:
+        yield heapq.heappop(heap)
+
+class InternedIndex(object):
+    """
+    Base for indexes that intern strings to integer IDs, in the order they
+    are added. Built segments add their strings in sorted order, so that
+    their IDs sort like their strings; for the live segment, a table of
+    each ID's rank is rebuilt when a search follows adds out of order.
+    """
+    def __init__(self):
+        self.documents = []
+        self.document_ids = {}
+        # Whether the IDs are in sorted order, and if not, their ranks (and
+        # the IDs by rank)
+        self.in_order = True
+        self.ranks = None
+
+    @classmethod
+    def build(cls, strings):
+        index = cls()
+        for string in sorted(set(strings)):
+            index.add(string)
+        return index
+
+    def intern(self, string):
+        """
+        Gives a new string the next ID and returns it, or returns None if
+        the string is already in
+        """
+        if string in self.document_ids:
+            return None
+        document_id = len(self.documents)
+        if self.documents and string < self.documents[-1]:
+            self.in_order = False
+        self.ranks = None
+        self.document_ids[string] = document_id
+        self.documents.append(string)
+        return document_id
+
+    def postings(self, ids):
+        """
+        Wraps IDs as Postings, with the rank table if they need it
+        """
+        if not self.in_order and self.ranks is None:
+            documents = self.documents
+            order = array('I', sorted(range(len(documents)),
+                key=documents.__getitem__))
+            ranks = array('I', [0]) * len(documents)
+            for rank, document_id in enumerate(order):
+                ranks[document_id] = rank
+            self.ranks = (ranks, order)
+        return Postings(self.documents, ids, self.ranks)
+
+class SubstringIndex(InternedIndex):
+    """
+    Index that precomputes every substring of every string, for O(1)
+    lookups at the cost of O(L^2) keys per string. Strings are interned to
+    integer IDs, so each key holds a compact array('I') of IDs rather than
+    a set of strings.
+    """
+    def __init__(self):
+        super(SubstringIndex, self).__init__()
+        self.substring_dict = {}
 
     def add_substrings(self, string):
         """
         Calculates all substrings for the given string. Using each substring as 
-        the key, adds the original string to the dictionary's set (in the value 
-        position)
+        the key, adds the string's ID to the dictionary's posting list (in the
+        value position)
         
         Useful for O(1) lookups of search terms, though a little expensive here
         in the computation.
         """
-        for i in range(len(string)):
-            for j in range(len(string[i:])):
-                self.substring_dict[string[i:len(string) - j]].add(string)
+        document_id = self.intern(string)
+        if document_id is None:
+            return
+        # IDs only ever grow, so appending keeps every posting list sorted
+        substrings = set(string[i:j] for i in range(len(string))
+            for j in range(i + 1, len(string) + 1))
+        for substring in substrings:
+            postings = self.substring_dict.get(substring)
+            if postings is None:
+                postings = self.substring_dict[substring] = array('I')
+            postings.append(document_id)
+
+    def add(self, string):
+        self.add_substrings(string)
+
+    def search(self, substring):
+        return self.postings(self.substring_dict.get(substring, array('I')))
+
+def gallop(postings, target, lo=0):
+    """
+    Returns the first position at or after lo holding an ID >= target, by
+    doubling the step until it's overshot and then bisecting. Skipping
+    through a long list this way costs O(log gap) per lookup.
+    """
+    step = 1
+    hi = lo
+    while hi < len(postings) and postings[hi] < target:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect.bisect_left(postings, target, lo, min(hi, len(postings)))
+
+def intersect(posting_lists):
+    """
+    Intersects sorted lists of IDs, starting from the smallest and galloping
+    through the others
+    """
+    posting_lists = sorted(posting_lists, key=len)
+    result = posting_lists[0]
+    for postings in posting_lists[1:]:
+        matches = []
+        position = 0
+        for document_id in result:
+            position = gallop(postings, document_id, position)
+            if position == len(postings):
+                break
+            if postings[position] == document_id:
+                matches.append(document_id)
+        result = matches
+        if not result:
+            break
+    return result
+
+class TrigramIndex(InternedIndex):
+    """
+    Index of the three-character substrings of each string, which grows
+    linearly with the strings' length. A search intersects the posting
+    lists of the query's trigrams, then checks each candidate really holds
+    the query. Queries shorter than a trigram are checked against every
+    string.
+    """
+    def __init__(self):
+        super(TrigramIndex, self).__init__()
+        self.trigram_dict = {}
+
+    def add(self, string):
+        document_id = self.intern(string)
+        if document_id is None:
+            return
+        # IDs only ever grow, so appending keeps every posting list sorted
+        for trigram in set(string[i:i + 3] for i in range(len(string) - 2)):
+            postings = self.trigram_dict.get(trigram)
+            if postings is None:
+                postings = self.trigram_dict[trigram] = array('I')
+            postings.append(document_id)
+
+    def candidates(self, substring):
+        """
+        Returns the sorted IDs of the strings holding every trigram of
+        substring
+        """
+        if len(substring) < 3:
+            return range(len(self.documents))
+        posting_lists = []
+        for trigram in set(substring[i:i + 3]
+                for i in range(len(substring) - 2)):
+            postings = self.trigram_dict.get(trigram)
+            if postings is None:
+                return []
+            posting_lists.append(postings)
+        return intersect(posting_lists)
+
+    def search(self, substring):
+        documents = self.documents
+        return self.postings(array('I', (document_id
+            for document_id in self.candidates(substring)
+            if substring in documents[document_id])))
+
+class SuffixAutomatonIndex(object):
+    """
+    Index backed by a generalized suffix automaton. Lookups take
+    O(len(substring)) plus the number of occurrences of substring, and
+    memory is linear in the total length of the strings.
+    """
+    def __init__(self):
+        self.automaton = suffixautomaton.SuffixAutomaton()
+
+    def add(self, string):
+        self.automaton.insert(string)
+
+    def search(self, substring):
+        return self.automaton.documents_containing(substring)
+
+class SuffixArrayIndex(object):
+    """
+    Index backed by a suffix array, answering each lookup with two
+    bisections. It can be restored from a memory-mapped snapshot, which makes
+    restarts nearly instant.
+    """
+    def __init__(self, suffix_array=None):
+        if suffix_array is None:
+            suffix_array = suffixarray.SuffixArray()
+        self.suffix_array = suffix_array
+
+    @classmethod
+    def build(cls, strings):
+        return cls(suffixarray.SuffixArray.build(strings))
+
+    @classmethod
+    def from_suffix_array(cls, suffix_array):
+        return cls(suffix_array)
+
+    def add(self, string):
+        self.suffix_array.insert(string)
+
+    def search(self, substring):
+        return self.suffix_array.get_exact_search_results(substring)
+
+INDEXES = {
+    'automaton': SuffixAutomatonIndex,
+    'suffixarray': SuffixArrayIndex,
+    'substrings': SubstringIndex,
+    'trigrams': TrigramIndex,
+}
+
+class FormHandler(tornado.web.RequestHandler):
+    """
+    Including a form that can be used to add strings to the dictionary.
+    """
+    def get(self):
+        self.write('<html><body><form action="/add" method="post">'
+                '<input type="text" name="string">'
+                '<input type="submit" value="Submit">'
+                '</form></body></html>')
+
+class AddHandler(metrics.InstrumentedHandler):
+    """
+    Handler for adding strings
+    """
+    def initialize(self, index, registry=None):
+        self.index = index
+        self.metrics = registry
 
     def post(self):
         self.set_header("Content-Type", "text/plain")
         self.write("You wrote " + self.get_argument("string"))
-        self.add_substrings(self.get_argument("string"))
+        with metrics.phase(self, 'index'):
+            self.index.add(self.get_argument("string"))
 
-class SearchHandler(tornado.web.RequestHandler):
+class SearchHandler(metrics.InstrumentedHandler):
     """
     A handler to return search results
     """
-    def initialize(self, substring_dict):
-        self.substring_dict = substring_dict
+    def initialize(self, index, cache, registry=None):
+        self.index = index
+        self.cache = cache
+        self.metrics = registry
 
+    @tornado.gen.coroutine
     def get(self, substring):
-        self.write(json.dumps({'results': sorted(self.substring_dict[substring])}))
+        generation = self.index.generation
+        with metrics.phase(self, 'cache'):
+            cached = not results.streaming(self) and \
+                self.cache.write_cached(self, generation)
+        if cached:
+            return
+        with metrics.phase(self, 'lookup'):
+            matches = yield shards.search(self.index,
+                results.page_arguments(self), substring)
+        body = yield results.write_results(self, matches)
+        self.cache.store(self, generation, body)
 
-substring_dict = defaultdict(set)
-application = tornado.web.Application([
-    (r"/formsubmit", FormHandler),
-    (r"/add", AddHandler, dict(substring_dict=substring_dict)),
-    (r"/search/([a-zA-Z]+)", SearchHandler, 
-        dict(substring_dict=substring_dict)),
-])
+def make_application(index, snapshot_path=None, profiler=None):
+    """
+    Builds the search application around the given index. With a
+    snapshot path, POSTing to /snapshot writes the index there. Request
+    timings and index sizes are served on /metrics.
+    """
+    response_cache = cache.ResponseCache()
+    request_metrics = metrics.Metrics(index, response_cache, profiler)
+    routes = [
+        (r"/formsubmit", FormHandler),
+        (r"/add", AddHandler,
+            dict(index=index, registry=request_metrics)),
+        (r"/add/batch", segments.BatchAddHandler, dict(index=index)),
+        (r"/delete", segments.DeleteHandler, dict(index=index)),
+        (r"/update", segments.UpdateHandler, dict(index=index)),
+        (r"/search/([a-zA-Z]+)", SearchHandler,
+            dict(index=index, cache=response_cache,
+                registry=request_metrics)),
+        (r"/cache", cache.CacheStatsHandler, dict(cache=response_cache)),
+        (r"/metrics", metrics.MetricsHandler, dict(registry=request_metrics)),
+    ]
+    if snapshot_path is not None:
+        routes.append((r"/snapshot", snapshot.SnapshotHandler,
+            dict(index=index, path=snapshot_path)))
+    return tornado.web.Application(routes)
 
-if __name__ == "__main__":
-    application.listen(8888)
+index = segments.SegmentedIndex(SubstringIndex)
+application = make_application(index)
+
+def main(args):
+    """
+    Starts the server with the index backend chosen on the command line
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', choices=sorted(INDEXES),
+        default='substrings')
+    parser.add_argument('--snapshot', metavar='PATH',
+        help="snapshot file to restore from at startup and write to on "
+            "POST /snapshot")
+    parser.add_argument('--shards', type=int, default=1,
+        help="partition the index across this many shards")
+    parser.add_argument('--shard-processes', action='store_true',
+        help="run each shard in a worker process of its own")
+    parser.add_argument('--profile-slow', type=float, metavar='SECONDS',
+        help="sample the stacks of requests, writing out those of requests "
+            "taking at least this long (see metrics.py)")
+    parser.add_argument('--profile-output', metavar='PATH',
+        default='slow-requests.folded')
+    args = parser.parse_args(args)
+    index = shards.make_index(INDEXES[args.index], args.shards,
+        args.shard_processes)
+    if args.snapshot and os.path.exists(args.snapshot):
+        snapshot.restore_index(index, args.snapshot)
+    segments.Compactor(index).start()
+    profiler = None
+    if args.profile_slow is not None:
+        profiler = metrics.Profiler(args.profile_output, args.profile_slow)
+    make_application(index, args.snapshot, profiler=profiler).listen(8888)
     tornado.ioloop.IOLoop.instance().start()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -5,32 +5,68 @@
 A light Tornado application that allows for search via fuzzy substring matching.
 
 Returns results as a JSON-blog of the form: {"results": ["result_1", ...]}
+(see results.py for paging and streaming)
+
+USAGE:
+    python search2.py [--index {automaton,variants,wildcards}] [--max-edits N]
+        [--snapshot PATH]
 """
 
-import difflib
-import json
+import argparse
+import cache
+import metrics
+import os
+import results
+import segments
+import shards
+import snapshot
+import suffixarray
+import sys
+import tornado.gen
 import tornado.ioloop
 import tornado.web
 
 from collections import defaultdict
 from string import letters # [a-zA-Z]
 
-class FormHandler(tornado.web.RequestHandler):
+class EditDistanceIndex(object):
     """
-    Including a form that can be used to add strings to the dictionary.
+    Fuzzy index that keeps the strings in a suffix array and walks it with a
+    Levenshtein automaton at query time. Finds any string containing a
+    substring within max_edits insertions, deletions or substitutions of the
+    search term.
     """
-    def get(self):
-        self.write('<html><body><form action="/add" method="post">'
-                '<input type="text" name="string">'
-                '<input type="submit" value="Submit">'
-                '</form></body></html>')
+    def __init__(self, max_edits=suffixarray.DEFAULT_MAX_EDITS,
+            suffix_array=None):
+        self.max_edits = max_edits
+        if suffix_array is None:
+            suffix_array = suffixarray.SuffixArray()
+        self.suffix_array = suffix_array
+
+    @classmethod
+    def build(cls, strings, max_edits=suffixarray.DEFAULT_MAX_EDITS):
+        return cls(max_edits, suffixarray.SuffixArray.build(strings))
+
+    @classmethod
+    def from_suffix_array(cls, suffix_array,
+            max_edits=suffixarray.DEFAULT_MAX_EDITS):
+        return cls(max_edits, suffix_array)
+
+    def add(self, string):
+        self.suffix_array.insert(string)
+
+    def search(self, substring):
+        return self.suffix_array.get_fuzzy_search_results(substring,
+            self.max_edits)
 
-class AddHandler(tornado.web.RequestHandler):
+class VariantIndex(object):
     """
-    Handler for adding strings
+    Fuzzy index that precomputes every substring of every single-letter
+    substitution of each string. Lookups are O(1), but ingest is very
+    expensive in both time and memory.
     """
-    def initialize(self, substring_dict):
-        self.substring_dict = substring_dict
+    def __init__(self):
+        self.substring_dict = defaultdict(set)
 
     def add_substrings(self, variant_string, actual_string):
         """
@@ -56,36 +92,176 @@ class AddHandler(tornado.web.RequestHandler):
         """
         strings = []
         for x in range(len(input_string)):
-            for char in letters:
+            for char in alphabet:
                 strings.append(input_string[:x] + char + input_string[x+1:])
         return strings
 
+    def add(self, string):
+        for string_variant in self.generate_variants(string):
+            self.add_substrings(string_variant, string)
+
+    def search(self, substring):
+        return self.substring_dict.get(substring, set())
+
+class WildcardIndex(object):
+    """
+    Fuzzy index of substitution wildcards. Finds the same strings as
+    VariantIndex: those containing a substring that differs from the search
+    term in at most one position.
+
+    Each substring is stored under itself and under every copy of it with
+    one character replaced by a WILDCARD marker. The query side generates
+    the same keys for the search term, so two strings of equal length share
+    a key exactly when they differ in at most one position. This needs
+    L + 1 keys per substring rather than 52 variants of every substring, and
+    needs no alphabet, but building still takes O(L^3) per string.
+    """
+    WILDCARD = u'\x00'
+
+    def __init__(self):
+        self.substring_dict = defaultdict(set)
+
+    def wildcards(self, string):
+        """
+        Returns the string along with each copy of it with one character
+        replaced by WILDCARD
+        """
+        keys = [string]
+        for x in range(len(string)):
+            keys.append(string[:x] + self.WILDCARD + string[x+1:])
+        return keys
+
+    def add(self, string):
+        for i in range(len(string)):
+            for j in range(i + 1, len(string) + 1):
+                for key in self.wildcards(string[i:j]):
+                    self.substring_dict[key].add(string)
+
+    def search(self, substring):
+        results = set()
+        for key in self.wildcards(substring):
+            results.update(self.substring_dict.get(key, ()))
+        return results
+
+INDEXES = {
+    'automaton': EditDistanceIndex,
+    'variants': VariantIndex,
+    'wildcards': WildcardIndex,
+}
+
+class FormHandler(tornado.web.RequestHandler):
+    """
+    Including a form that can be used to add strings to the dictionary.
+    """
+    def get(self):
+        self.write('<html><body><form action="/add" method="post">'
+                '<input type="text" name="string">'
+                '<input type="submit" value="Submit">'
+                '</form></body></html>')
+
+class AddHandler(metrics.InstrumentedHandler):
+    """
+    Handler for adding strings
+    """
+    def initialize(self, index, registry=None):
+        self.index = index
+        self.metrics = registry
+
     def post(self):
         self.set_header("Content-Type", "text/plain")
         self.write("You wrote " + self.get_argument("string"))
-        original_string = self.get_argument("string")
-        string_variants = self.generate_variants(original_string)
-        for string_variant in string_variants:
-            self.add_substrings(string_variant, original_string)
+        with metrics.phase(self, 'index'):
+            self.index.add(self.get_argument("string"))
 
-class SearchHandler(tornado.web.RequestHandler):
+class SearchHandler(metrics.InstrumentedHandler):
     """
     A handler to return search results
     """
-    def initialize(self, substring_dict):
-        self.substring_dict = substring_dict
+    def initialize(self, index, cache, registry=None):
+        self.index = index
+        self.cache = cache
+        self.metrics = registry
 
+    @tornado.gen.coroutine
     def get(self, substring):
-        self.write(json.dumps({'results': sorted(self.substring_dict[substring])}))
+        generation = self.index.generation
+        with metrics.phase(self, 'cache'):
+            cached = not results.streaming(self) and \
+                self.cache.write_cached(self, generation)
+        if cached:
+            return
+        with metrics.phase(self, 'lookup'):
+            matches = yield shards.search(self.index,
+                results.page_arguments(self), substring)
+        body = yield results.write_results(self, matches)
+        self.cache.store(self, generation, body)
+
+def make_application(index, snapshot_path=None, profiler=None):
+    """
+    Builds the search application around the given fuzzy index. With a
+    snapshot path, POSTing to /snapshot writes the index there. Request
+    timings and index sizes are served on /metrics.
+    """
+    response_cache = cache.ResponseCache()
+    request_metrics = metrics.Metrics(index, response_cache, profiler)
+    routes = [
+        (r"/formsubmit", FormHandler),
+        (r"/add", AddHandler,
+            dict(index=index, registry=request_metrics)),
+        (r"/add/batch", segments.BatchAddHandler, dict(index=index)),
+        (r"/delete", segments.DeleteHandler, dict(index=index)),
+        (r"/update", segments.UpdateHandler, dict(index=index)),
+        (r"/search/([a-zA-Z]+)", SearchHandler,
+            dict(index=index, cache=response_cache,
+                registry=request_metrics)),
+        (r"/cache", cache.CacheStatsHandler, dict(cache=response_cache)),
+        (r"/metrics", metrics.MetricsHandler, dict(registry=request_metrics)),
+    ]
+    if snapshot_path is not None:
+        routes.append((r"/snapshot", snapshot.SnapshotHandler,
+            dict(index=index, path=snapshot_path)))
+    return tornado.web.Application(routes)
 
-substring_dict = defaultdict(set)
-application = tornado.web.Application([
-    (r"/formsubmit", FormHandler),
-    (r"/add", AddHandler, dict(substring_dict=substring_dict)),
-    (r"/search/([a-zA-Z]+)", SearchHandler, 
-        dict(substring_dict=substring_dict)),
-])
+index = segments.SegmentedIndex(EditDistanceIndex)
+application = make_application(index)
 
-if __name__ == "__main__":
-    application.listen(8888)
+def main(args):
+    """
+    Starts the server with the fuzzy index chosen on the command line
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', choices=sorted(INDEXES),
+        default='automaton')
+    parser.add_argument('--max-edits', type=int,
+        default=suffixarray.DEFAULT_MAX_EDITS,
+        help="edit budget for the automaton index")
+    parser.add_argument('--snapshot', metavar='PATH',
+        help="snapshot file to restore from at startup and write to on "
+            "POST /snapshot")
+    parser.add_argument('--shards', type=int, default=1,
+        help="partition the index across this many shards")
+    parser.add_argument('--shard-processes', action='store_true',
+        help="run each shard in a worker process of its own")
+    parser.add_argument('--profile-slow', type=float, metavar='SECONDS',
+        help="sample the stacks of requests, writing out those of requests "
+            "taking at least this long (see metrics.py)")
+    parser.add_argument('--profile-output', metavar='PATH',
+        default='slow-requests.folded')
+    args = parser.parse_args(args)
+    if args.index == 'automaton':
+        index = shards.make_index(EditDistanceIndex, args.shards,
+            args.shard_processes, max_edits=args.max_edits)
+    else:
+        index = shards.make_index(INDEXES[args.index], args.shards,
+            args.shard_processes)
+    if args.snapshot and os.path.exists(args.snapshot):
+        snapshot.restore_index(index, args.snapshot)
+    segments.Compactor(index).start()
+    profiler = None
+    if args.profile_slow is not None:
+        profiler = metrics.Profiler(args.profile_output, args.profile_slow)
+    make_application(index, args.snapshot, profiler=profiler).listen(8888)
     tornado.ioloop.IOLoop.instance().start()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -7,10 +7,33 @@ This particular extension uses a suffix array, with the core data structure
 implementation in suffixarray.py
 
 Returns results as a JSON-blog of the form: {"results": ["result_1", ...]}
+(see results.py for paging and streaming)
+
+Searches forgive one edit by default; pass ?max_edits=N to change that.
+
+GET /autocomplete/<prefix> returns the most frequent completions of a prefix
+as {"results": ["completion_1", ...], "counts": [count_1, ...]}, ten unless
+?limit=N is given.
+
+USAGE:
+    python search2_suffixarray.py [--snapshot PATH]
+    python search2_suffixarray.py --workers N [--writer-port PORT]
+        [--generations DIR]
 """
 
+import argparse
+import cache
 import json
+import metrics
+import os
+import prefork
+import results
+import segments
+import shards
+import snapshot
 import suffixarray
+import sys
+import tornado.gen
 import tornado.ioloop
 import tornado.web
 
@@ -27,37 +50,154 @@ class FormHandler(tornado.web.RequestHandler):
                 '<input type="submit" value="Submit">'
                 '</form></body></html>')
 
-class AddHandler(tornado.web.RequestHandler):
+class AddHandler(metrics.InstrumentedHandler):
     """
     Handler for adding strings
     """
-    def initialize(self, suffix_array):
-        self.suffix_array = suffix_array
+    def initialize(self, index, registry=None):
+        self.index = index
+        self.metrics = registry
 
     def post(self):
         self.set_header("Content-Type", "text/plain")
         self.write("You wrote " + self.get_argument("string"))
-        self.suffix_array.insert(self.get_argument("string"))
+        with metrics.phase(self, 'index'):
+            self.index.add(self.get_argument("string"))
 
-class SearchHandler(tornado.web.RequestHandler):
+class SearchHandler(metrics.InstrumentedHandler):
     """
     A handler to return search results
     """
-    def initialize(self, suffix_array):
-        self.suffix_array = suffix_array
+    def initialize(self, index, cache, registry=None):
+        self.index = index
+        self.cache = cache
+        self.metrics = registry
 
+    @tornado.gen.coroutine
     def get(self, substring):
-        self.write(json.dumps({'results': sorted(
-            self.suffix_array.get_fuzzy_search_results(substring))}))
+        generation = self.index.generation
+        with metrics.phase(self, 'cache'):
+            cached = not results.streaming(self) and \
+                self.cache.write_cached(self, generation)
+        if cached:
+            return
+        max_edits = results.int_argument(self, 'max_edits',
+            suffixarray.DEFAULT_MAX_EDITS, maximum=suffixarray.MAX_EDITS)
+        with metrics.phase(self, 'lookup'):
+            matches = yield shards.search(self.index,
+                results.page_arguments(self), substring, max_edits)
+        body = yield results.write_results(self, matches)
+        self.cache.store(self, generation, body)
+
+class AutocompleteHandler(metrics.InstrumentedHandler):
+    """
+    A handler to return the most frequent completions of a prefix
+    """
+    def initialize(self, index, registry=None):
+        self.index = index
+        self.metrics = registry
 
-suffix_array = suffixarray.SuffixArray()
-application = tornado.web.Application([
-    (r"/formsubmit", FormHandler),
-    (r"/add", AddHandler, dict(suffix_array=suffix_array)),
-    (r"/search/([a-zA-Z]+)", SearchHandler, 
-        dict(suffix_array=suffix_array)),
-])
+    @tornado.gen.coroutine
+    def get(self, prefix):
+        limit = results.int_argument(self, 'limit',
+            suffixarray.DEFAULT_COMPLETIONS, minimum=1,
+            maximum=suffixarray.MAX_COMPLETIONS)
+        with metrics.phase(self, 'lookup'):
+            completions = yield shards.lookup(self.index, 'completions',
+                prefix, limit)
+        with metrics.phase(self, 'serialize'):
+            body = json.dumps({
+                'results': [completion for completion, _ in completions],
+                'counts': [count for _, count in completions],
+            })
+        self.write(body)
 
-if __name__ == "__main__":
-    application.listen(8888)
+def make_application(index, snapshot_path=None, writer_url=None,
+        profiler=None, publisher=None):
+    """
+    Builds the search application around the given suffix array index. With
+    a snapshot path, POSTing to /snapshot writes the index there. With a
+    writer URL, the application only serves searches and sends adds on to
+    the writer; with a publisher, it's the writer, and answers deletes once
+    they're published (see prefork.py). Request timings and index sizes are
+    served on /metrics.
+    """
+    response_cache = cache.ResponseCache()
+    request_metrics = metrics.Metrics(index, response_cache, profiler)
+    routes = [
+        (r"/formsubmit", FormHandler),
+        (r"/search/([a-zA-Z]+)", SearchHandler,
+            dict(index=index, cache=response_cache,
+                registry=request_metrics)),
+        (r"/autocomplete/([a-zA-Z]+)", AutocompleteHandler,
+            dict(index=index, registry=request_metrics)),
+        (r"/cache", cache.CacheStatsHandler, dict(cache=response_cache)),
+        (r"/metrics", metrics.MetricsHandler, dict(registry=request_metrics)),
+    ]
+    if writer_url is None:
+        routes.extend([
+            (r"/add", AddHandler,
+                dict(index=index, registry=request_metrics)),
+            (r"/add/batch", segments.BatchAddHandler, dict(index=index)),
+            (r"/delete", segments.DeleteHandler,
+                dict(index=index, publisher=publisher)),
+            (r"/update", segments.UpdateHandler,
+                dict(index=index, publisher=publisher)),
+        ])
+    else:
+        routes.append((r"/(?:add(?:/batch)?|delete|update)",
+            prefork.WriterRedirectHandler,
+            dict(writer_url=writer_url)))
+    if snapshot_path is not None:
+        routes.append((r"/snapshot", snapshot.SnapshotHandler,
+            dict(index=index, path=snapshot_path)))
+    return tornado.web.Application(routes)
+
+suffix_array = segments.SegmentedIndex(suffixarray.SuffixArray)
+application = make_application(suffix_array)
+
+def main(args):
+    """
+    Starts the server, restoring the index from a snapshot if one is given
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--snapshot', metavar='PATH',
+        help="snapshot file to restore from at startup and write to on "
+            "POST /snapshot")
+    parser.add_argument('--workers', type=int, default=0,
+        help="fork this many search processes, plus one writer process "
+            "that takes adds on --writer-port")
+    parser.add_argument('--writer-port', type=int, default=8889)
+    parser.add_argument('--generations', metavar='DIR', default='.',
+        help="where the writer publishes index generations for the workers")
+    parser.add_argument('--shards', type=int, default=1,
+        help="partition the index across this many shards (without "
+            "--workers)")
+    parser.add_argument('--shard-processes', action='store_true',
+        help="run each shard in a worker process of its own")
+    parser.add_argument('--profile-slow', type=float, metavar='SECONDS',
+        help="sample the stacks of requests, writing out those of requests "
+            "taking at least this long (see metrics.py)")
+    parser.add_argument('--profile-output', metavar='PATH',
+        default='slow-requests.folded')
+    args = parser.parse_args(args)
+    if args.workers:
+        prefork.serve(lambda index, writer_url, publisher:
+                make_application(index, writer_url=writer_url,
+                    publisher=publisher),
+            lambda: segments.SegmentedIndex(suffixarray.SuffixArray),
+            args.workers, 8888, args.writer_port, args.generations)
+        return
+    index = shards.make_index(suffixarray.SuffixArray, args.shards,
+        args.shard_processes)
+    if args.snapshot and os.path.exists(args.snapshot):
+        snapshot.restore_index(index, args.snapshot)
+    segments.Compactor(index).start()
+    profiler = None
+    if args.profile_slow is not None:
+        profiler = metrics.Profiler(args.profile_output, args.profile_slow)
+    make_application(index, args.snapshot, profiler=profiler).listen(8888)
     tornado.ioloop.IOLoop.instance().start()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
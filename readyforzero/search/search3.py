@@ -5,31 +5,40 @@
 A light Tornado application that checks to see if a string exists via substring 
 matching.
 
-Returns results as a JSON-blog of the form: {"results": True} (or False)
+Returns results as a JSON-blog of the form: {"results": True} (or False). With
+the Bloom filter index, which can return false positives, the response also
+holds a bound on the chance that a True is wrong: {"results": True,
+"false_positive_rate": 0.001}.
+
+USAGE:
+    python search3.py [--index {automaton,bloom,suffixarray,substrings}]
+        [--error-rate RATE] [--snapshot PATH]
 """
 
+import argparse
+import bloom
 import json
+import metrics
+import os
+import segments
+import shards
+import snapshot
+import suffixarray
+import suffixautomaton
+import sys
+import tornado.gen
 import tornado.ioloop
 import tornado.web
 
 from collections import defaultdict
 
-class FormHandler(tornado.web.RequestHandler):
+class SubstringSetIndex(object):
     """
-    Including a form that can be used to add strings to the dictionary.
+    Index that precomputes every substring of every string into a set, for
+    O(1) membership tests at the cost of O(L^2) entries per string.
     """
-    def get(self):
-        self.write('<html><body><form action="/add" method="post">'
-                '<input type="text" name="string">'
-                '<input type="submit" value="Submit">'
-                '</form></body></html>')
-
-class AddHandler(tornado.web.RequestHandler):
-    """
-    Handler for adding strings
-    """
-    def initialize(self, substring_set):
-        self.substring_set = substring_set
+    def __init__(self):
+        self.substring_set = set()
 
     def add_substrings(self, string):
         """
@@ -43,32 +52,203 @@ class AddHandler(tornado.web.RequestHandler):
             for j in range(len(string[i:])):
                 self.substring_set.add(string[i:len(string) - j])
 
+    def add(self, string):
+        self.add_substrings(string)
+
+    def contains(self, substring):
+        return substring in self.substring_set
+
+class SuffixAutomatonIndex(object):
+    """
+    Index backed by a generalized suffix automaton. Membership tests take
+    O(len(substring)), and memory is linear in the total length of the
+    strings.
+    """
+    def __init__(self):
+        self.automaton = suffixautomaton.SuffixAutomaton()
+
+    def add(self, string):
+        self.automaton.insert(string)
+
+    def contains(self, substring):
+        return substring in self.automaton
+
+class SuffixArrayIndex(object):
+    """
+    Index backed by a suffix array, answering each membership test with two
+    bisections. It can be restored from a memory-mapped snapshot, which makes
+    restarts nearly instant.
+    """
+    def __init__(self, suffix_array=None):
+        if suffix_array is None:
+            suffix_array = suffixarray.SuffixArray()
+        self.suffix_array = suffix_array
+
+    @classmethod
+    def build(cls, strings):
+        return cls(suffixarray.SuffixArray.build(strings))
+
+    @classmethod
+    def from_suffix_array(cls, suffix_array):
+        return cls(suffix_array)
+
+    def add(self, string):
+        self.suffix_array.insert(string)
+
+    def contains(self, substring):
+        return substring in self.suffix_array
+
+class BloomIndex(object):
+    """
+    Index of every substring of every string, held as the bits of a Bloom
+    filter: a small fraction of the memory of a set of the substrings. A
+    substring that was added is always found, but one that wasn't may be
+    too, with probability at most error_rate.
+    """
+    def __init__(self, error_rate=bloom.DEFAULT_ERROR_RATE,
+            bloom_filter=None):
+        if bloom_filter is None:
+            bloom_filter = bloom.ScalableBloomFilter(error_rate)
+        self.filter = bloom_filter
+        self.false_positive_rate = error_rate
+
+    @classmethod
+    def build(cls, strings, error_rate=bloom.DEFAULT_ERROR_RATE):
+        """
+        Builds a single filter sized for the strings' substrings, rather
+        than growing one as they're added
+        """
+        strings = list(strings)
+        capacity = sum(len(string) * (len(string) + 1) // 2
+            for string in strings)
+        bloom_filter = bloom.BloomFilter(max(capacity, 1), error_rate)
+        for string in strings:
+            for i in range(len(string)):
+                for j in range(i + 1, len(string) + 1):
+                    bloom_filter.add(string[i:j])
+        return cls(error_rate, bloom_filter)
+
+    def add(self, string):
+        for i in range(len(string)):
+            for j in range(i + 1, len(string) + 1):
+                self.filter.add(string[i:j])
+
+    def contains(self, substring):
+        return substring in self.filter
+
+INDEXES = {
+    'automaton': SuffixAutomatonIndex,
+    'bloom': BloomIndex,
+    'suffixarray': SuffixArrayIndex,
+    'substrings': SubstringSetIndex,
+}
+
+class FormHandler(tornado.web.RequestHandler):
+    """
+    Including a form that can be used to add strings to the dictionary.
+    """
+    def get(self):
+        self.write('<html><body><form action="/add" method="post">'
+                '<input type="text" name="string">'
+                '<input type="submit" value="Submit">'
+                '</form></body></html>')
+
+class AddHandler(metrics.InstrumentedHandler):
+    """
+    Handler for adding strings
+    """
+    def initialize(self, index, registry=None):
+        self.index = index
+        self.metrics = registry
+
     def post(self):
         self.set_header("Content-Type", "text/plain")
         self.write("You wrote " + self.get_argument("string"))
-        self.add_substrings(self.get_argument("string"))
+        with metrics.phase(self, 'index'):
+            self.index.add(self.get_argument("string"))
 
-class SearchHandler(tornado.web.RequestHandler):
+class SearchHandler(metrics.InstrumentedHandler):
     """
     A handler to return search results
     """
-    def initialize(self, substring_set):
-        self.substring_set = substring_set
+    def initialize(self, index, registry=None):
+        self.index = index
+        self.metrics = registry
 
+    @tornado.gen.coroutine
     def get(self, substring):
-        if substring in self.substring_set:
-            self.write(json.dumps({'results': True}))
-        else:
-            self.write(json.dumps({'results': False}))
-
-substring_set = set()
-application = tornado.web.Application([
-    (r"/formsubmit", FormHandler),
-    (r"/add", AddHandler, dict(substring_set=substring_set)),
-    (r"/search/([a-zA-Z]+)", SearchHandler, 
-        dict(substring_set=substring_set)),
-])
+        with metrics.phase(self, 'lookup'):
+            found = yield shards.lookup(self.index, 'contains', substring)
+        response = {'results': found}
+        # Bloom filter indexes can't be trusted when they say yes
+        false_positive_rate = yield shards.lookup(self.index,
+            'false_positive_rate')
+        if false_positive_rate is not None:
+            response['false_positive_rate'] = false_positive_rate
+        self.write(json.dumps(response))
 
-if __name__ == "__main__":
-    application.listen(8888)
+def make_application(index, snapshot_path=None, profiler=None):
+    """
+    Builds the search application around the given index. With a
+    snapshot path, POSTing to /snapshot writes the index there. Request
+    timings and index sizes are served on /metrics.
+    """
+    request_metrics = metrics.Metrics(index, profiler=profiler)
+    routes = [
+        (r"/formsubmit", FormHandler),
+        (r"/add", AddHandler, dict(index=index, registry=request_metrics)),
+        (r"/add/batch", segments.BatchAddHandler, dict(index=index)),
+        (r"/delete", segments.DeleteHandler, dict(index=index)),
+        (r"/update", segments.UpdateHandler, dict(index=index)),
+        (r"/search/([a-zA-Z]+)", SearchHandler,
+            dict(index=index, registry=request_metrics)),
+        (r"/metrics", metrics.MetricsHandler, dict(registry=request_metrics)),
+    ]
+    if snapshot_path is not None:
+        routes.append((r"/snapshot", snapshot.SnapshotHandler,
+            dict(index=index, path=snapshot_path)))
+    return tornado.web.Application(routes)
+
+index = segments.SegmentedIndex(SubstringSetIndex)
+application = make_application(index)
+
+def main(args):
+    """
+    Starts the server with the index backend chosen on the command line
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', choices=sorted(INDEXES),
+        default='substrings')
+    parser.add_argument('--error-rate', type=float,
+        default=bloom.DEFAULT_ERROR_RATE,
+        help="false positive rate for the bloom index")
+    parser.add_argument('--snapshot', metavar='PATH',
+        help="snapshot file to restore from at startup and write to on "
+            "POST /snapshot")
+    parser.add_argument('--shards', type=int, default=1,
+        help="partition the index across this many shards")
+    parser.add_argument('--shard-processes', action='store_true',
+        help="run each shard in a worker process of its own")
+    parser.add_argument('--profile-slow', type=float, metavar='SECONDS',
+        help="sample the stacks of requests, writing out those of requests "
+            "taking at least this long (see metrics.py)")
+    parser.add_argument('--profile-output', metavar='PATH',
+        default='slow-requests.folded')
+    args = parser.parse_args(args)
+    if args.index == 'bloom':
+        index = shards.make_index(BloomIndex, args.shards,
+            args.shard_processes, error_rate=args.error_rate)
+    else:
+        index = shards.make_index(INDEXES[args.index], args.shards,
+            args.shard_processes)
+    if args.snapshot and os.path.exists(args.snapshot):
+        snapshot.restore_index(index, args.snapshot)
+    segments.Compactor(index).start()
+    profiler = None
+    if args.profile_slow is not None:
+        profiler = metrics.Profiler(args.profile_output, args.profile_slow)
+    make_application(index, args.snapshot, profiler=profiler).listen(8888)
     tornado.ioloop.IOLoop.instance().start()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Segmented indexes, and batch ingest for the search applications.
+
+A segmented index is a tuple of independent index segments of the same kind.
+Single strings are added to the live segment on the IOLoop, while batches are
+built into a fresh segment on a worker thread and then published by swapping
+in a new tuple, so searches always see either none or all of a batch.
+
+Each string is indexed in one segment only, so that lookups which count
+(such as completions) count it once: the index keeps track of which segment
+holds each string, and adding one it already holds does nothing. A batch can
+still hold strings that are already in another segment (or one added while
+it was built), which stay there as strays, hidden from every lookup.
+
+Deleting a string only records a tombstone for it, which hides it from
+searches straight away. Compaction later rebuilds each segment holding
+deleted strings (or strays) without them, on the same worker thread, while
+searches carry on against the old segment, and then clears their tombstones.
+
+So that searches don't walk ever more segments, the live segment is rolled
+over into an immutable one once it holds LIVE_SEGMENT_SIZE strings, and
+segments are merged by size tier: whenever MERGE_FACTOR segments are of
+about the same size (within a factor of MERGE_FACTOR), they're rebuilt into
+one the same way compaction rebuilds segments. There are then at most
+MERGE_FACTOR - 1 segments per tier and O(log n) tiers, and each string is
+merged O(log n) times.
+
+Every change bumps the index's generation, which lets caches of search
+results tell when they've gone stale.
+"""
+
+import heapq
+import itertools
+import json
+import tornado.gen
+import tornado.ioloop
+import tornado.web
+
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from tornado.concurrent import run_on_executor
+
+# Completions asked of each segment (or shard) when combining theirs. Each
+# only offers its own top completions, so asking for more than the limit
+# makes it rarer for one that just misses every segment's top to be missed.
+COMBINED_COMPLETIONS = 100
+
+# How often the applications check for tombstones to compact away, in
+# milliseconds
+COMPACT_INTERVAL = 60000
+
+# Strings the live segment takes before a fresh one replaces it. This bounds
+# the cost of each add to indexes that shift their contents to insert.
+LIVE_SEGMENT_SIZE = 10000
+
+# How many segments of a size tier are merged at once, and the ratio
+# between the sizes of successive tiers
+MERGE_FACTOR = 4
+
+def size_tier(size):
+    """
+    The tier of a segment holding size strings
+    """
+    tier = 0
+    while size >= MERGE_FACTOR:
+        size //= MERGE_FACTOR
+        tier += 1
+    return tier
+
+def combine_completions(completion_lists, limit, deleted=()):
+    """
+    Sums the counts of the same completion offered by several indexes, less
+    any deleted counts, and ranks the totals
+    """
+    counts = Counter()
+    for completions in completion_lists:
+        for completion, count in completions:
+            counts[completion] += count
+    counts.subtract(deleted)
+    return sorted(((completion, count) for completion, count in
+        counts.items() if count > 0),
+        key=lambda pair: (-pair[1], pair[0]))[:limit]
+
+class SortedResults(object):
+    """
+    The combined results of several segments that each give a sorted view
+    of theirs (see results.py), less deleted strings and each segment's
+    strays. The views are merged lazily, so paging only looks up the strings
+    it passes over.
+    """
+    def __init__(self, views, tombstones, strays):
+        self.views = views
+        self.tombstones = set(tombstones)
+        self.strays = strays
+
+    def __iter__(self):
+        return self.iter_sorted()
+
+    def iter_sorted(self, after=None, offset=0):
+        merged = heapq.merge(*[(string for string in view.iter_sorted(after)
+                if string not in strays) if strays else view.iter_sorted(after)
+            for view, strays in zip(self.views, self.strays)])
+        # A string in several segments comes out of each
+        unique = (string for string, _ in itertools.groupby(merged)
+            if string not in self.tombstones)
+        return itertools.islice(unique, offset, None)
+
+class Compaction(object):
+    """
+    The segments being compacted (or merged), along with the deleted strings
+    they hold, whose tombstones the rebuilt segment will have cleared, and
+    each segment's strays, which it leaves out too
+    """
+    def __init__(self, segments, segment_documents, tombstones, strays):
+        self.segments = segments
+        self.segment_documents = segment_documents
+        self.tombstones = tombstones
+        self.strays = strays
+        self.strings = None
+
+class SegmentedIndex(object):
+    """
+    An index made up of segments, each created by calling factory. Searches
+    are answered by every segment and combined.
+
+    Args:
+        factory:    the index class (or any callable) to make segments with.
+                    If it has a build(strings) method, that is used to bulk
+                    build batch segments.
+        options:    keyword arguments passed along to factory and build
+    """
+    def __init__(self, factory, **options):
+        self.factory = factory
+        self.options = options
+        self.segments = (factory(**options),)
+        # The strings in each segment, kept so they can be re-indexed
+        self.segment_documents = ([],)
+        # The segment holding each string, deleted or not
+        self.owners = {}
+        # Deleted strings, still held by segments until they're compacted
+        self.tombstones = set()
+        # The strings each segment (by id) holds that another one owns
+        self.strays = {}
+        self.compaction = None
+        self.generation = 0
+
+    def dropping(self, segment, string):
+        """
+        Whether the running compaction is leaving segment's copy of string
+        out of the segment it's building
+        """
+        return self.compaction is not None and \
+            string in self.compaction.tombstones and \
+            any(segment is other for other in self.compaction.segments)
+
+    def claim(self, segment, string):
+        """
+        Records that segment holds a copy of string, and undeletes it. The
+        copy becomes the one lookups see unless another segment holds one
+        that compaction isn't dropping, in which case it's a stray.
+        """
+        owner = self.owners.get(string)
+        if owner is None or owner is segment or \
+                self.dropping(owner, string):
+            if owner is not None and owner is not segment:
+                self.strays.setdefault(id(owner), set()).add(string)
+            self.owners[string] = segment
+        else:
+            self.strays.setdefault(id(segment), set()).add(string)
+        self.tombstones.discard(string)
+
+    def add(self, string):
+        """
+        Adds a string to the live segment, first rolling it over if it's
+        full. A string some segment holds already is only undeleted.
+        """
+        owner = self.owners.get(string)
+        if owner is not None and not self.dropping(owner, string):
+            self.tombstones.discard(string)
+        else:
+            if len(self.segment_documents[0]) >= LIVE_SEGMENT_SIZE:
+                self.segments = (self.factory(**self.options),) + \
+                    self.segments
+                self.segment_documents = ([],) + self.segment_documents
+            self.segments[0].add(string)
+            self.segment_documents[0].append(string)
+            self.claim(self.segments[0], string)
+        self.generation += 1
+
+    def delete(self, string):
+        """
+        Hides a string from searches until compaction removes it
+        """
+        if string in self.owners:
+            self.tombstones.add(string)
+        self.generation += 1
+
+    def update(self, old, new):
+        """
+        Replaces one string with another
+        """
+        self.delete(old)
+        self.add(new)
+
+    def build_segment(self, strings):
+        """
+        Builds a standalone segment holding the given strings. This doesn't
+        touch the published segments, so it's safe to call off the IOLoop.
+        """
+        if hasattr(self.factory, 'build'):
+            return self.factory.build(strings, **self.options)
+        segment = self.factory(**self.options)
+        for string in strings:
+            segment.add(string)
+        return segment
+
+    def publish(self, segment, strings):
+        """
+        Makes a segment holding the given sequence of strings visible to
+        searches, in a single assignment. Strings it holds that another
+        segment holds already are strays in it.
+        """
+        for string in strings:
+            self.claim(segment, string)
+        self.segment_documents = self.segment_documents + (strings,)
+        self.segments = self.segments + (segment,)
+        self.generation += 1
+
+    def replace(self, segment, strings):
+        """
+        Swaps every segment out for the given one, holding the given strings
+        """
+        self.segment_documents = (strings,)
+        self.segments = (segment,)
+        self.owners = dict.fromkeys(strings, segment)
+        self.tombstones = set()
+        self.strays = {}
+        self.compaction = None
+        self.generation += 1
+
+    def replace_segments(self, segments, segment_documents, tombstones=(),
+            strays=()):
+        """
+        Swaps every segment out for the given ones, each holding the given
+        strings, behind a fresh live segment. tombstones are the deleted
+        strings among them, and strays (one collection per segment) the
+        strings each holds that another one owns, as a writer published
+        them (see prefork.py).
+        """
+        strays = dict((id(segment), set(held))
+            for segment, held in zip(segments, strays) if held)
+        owners = {}
+        for segment, strings in zip(segments, segment_documents):
+            held = dict.fromkeys(strings, segment)
+            for string in strays.get(id(segment), ()):
+                del held[string]
+            owners.update(held)
+        self.segment_documents = ([],) + tuple(segment_documents)
+        self.segments = (self.factory(**self.options),) + tuple(segments)
+        self.owners = owners
+        self.tombstones = set(tombstones)
+        self.strays = strays
+        self.compaction = None
+        self.generation += 1
+
+    def document_count(self):
+        """
+        The number of strings added so far and not deleted. Every owned
+        string is held once and each tombstone is for an owned string, so
+        this is kept up to date by add, publish, delete and compaction.
+        """
+        return len(self.owners) - len(self.tombstones)
+
+    def iter_hidden(self):
+        """
+        Yields every copy of a string that lookups mustn't see: each deleted
+        string, and each segment's strays
+        """
+        return itertools.chain(self.tombstones,
+            itertools.chain.from_iterable(self.strays.values()))
+
+    def iter_documents(self):
+        """
+        Yields every string added so far and not deleted, whichever segment
+        it's in
+        """
+        for segment, strings in zip(self.segments, self.segment_documents):
+            strays = self.strays.get(id(segment), ())
+            # Stop at the current end, in case the live segment grows
+            for position in range(len(strings)):
+                string = strings[position]
+                if string not in self.tombstones and string not in strays:
+                    yield string
+
+    def search(self, *args):
+        """
+        Combines the results of every segment's search, less any deleted
+        strings. A lone segment's results are passed through untouched when
+        nothing is deleted, and sorted views of results are merged lazily,
+        so that indexes which decode results lazily can keep doing so.
+        """
+        if len(self.segments) == 1 and not self.tombstones and \
+                not self.strays:
+            return self.segments[0].search(*args)
+        matches = [segment.search(*args) for segment in self.segments]
+        strays = [self.strays.get(id(segment)) for segment in self.segments]
+        if all(hasattr(view, 'iter_sorted') for view in matches):
+            return SortedResults(matches, self.tombstones, strays)
+        results = set()
+        for segment_matches, segment_strays in zip(matches, strays):
+            if segment_strays:
+                segment_matches = set(segment_matches) - segment_strays
+            results.update(segment_matches)
+        results.difference_update(self.tombstones)
+        return results
+
+    def contains(self, substring):
+        if not any(segment.contains(substring) for segment in self.segments):
+            return False
+        if not any(substring in string for string in self.iter_hidden()):
+            return True
+        # A deleted string (or stray) may be the only one holding substring
+        return any(substring in string for string in self.iter_documents())
+
+    def completions(self, prefix, limit):
+        """
+        Combines the top completions of prefix in every segment, less those
+        that deleted strings and strays contributed
+        """
+        deleted = Counter(string[position:] for string in self.iter_hidden()
+            for position in range(len(string))
+            if string.startswith(prefix, position))
+        if len(self.segments) == 1 and not deleted:
+            return self.segments[0].completions(prefix, limit)
+        depth = max(limit + sum(deleted.values()), COMBINED_COMPLETIONS)
+        return combine_completions([segment.completions(prefix, depth)
+            for segment in self.segments], limit, deleted)
+
+    def begin_compaction(self):
+        """
+        Starts compacting the smallest segment that holds deleted strings
+        (or strays), or else merging MERGE_FACTOR segments of the smallest
+        size tier that has that many (leaving the live segment be), unless
+        a compaction is already running. Other segments are left as they
+        are, so a deletion only costs rebuilding the segment it's in. When
+        the live segment is compacted, adds go to a fresh one from now on,
+        so it doesn't change while it's rebuilt. Returns the compaction to
+        pass to build_compaction and then finish_compaction, or None.
+        """
+        if self.compaction is not None:
+            return None
+        dirty = set(id(self.owners[string]) for string in self.tombstones)
+        dirty.update(self.strays)
+        positions = [position for position, segment in
+            enumerate(self.segments) if id(segment) in dirty]
+        if positions:
+            position = min(positions,
+                key=lambda position: len(self.segment_documents[position]))
+            segment = self.segments[position]
+            self.compaction = Compaction((segment,),
+                (self.segment_documents[position],),
+                set(string for string in self.tombstones
+                    if self.owners[string] is segment),
+                (set(self.strays.get(id(segment), ())),))
+            if position == 0:
+                self.segments = (self.factory(**self.options),) + \
+                    self.segments
+                self.segment_documents = ([],) + self.segment_documents
+        else:
+            tiers = defaultdict(list)
+            for position in range(1, len(self.segments)):
+                tiers[size_tier(len(self.segment_documents[position]))]\
+                    .append(position)
+            full = [positions for _, positions in sorted(tiers.items())
+                if len(positions) >= MERGE_FACTOR]
+            if full:
+                positions = full[0][:MERGE_FACTOR]
+                self.compaction = Compaction(
+                    tuple(self.segments[position] for position in positions),
+                    tuple(self.segment_documents[position]
+                        for position in positions), set(),
+                    tuple(set() for _ in positions))
+        return self.compaction
+
+    def build_compaction(self, compaction):
+        """
+        Builds a segment holding the compacted segments' strings, less the
+        deleted ones, strays and any duplicates. This doesn't touch the
+        published segments, so it's safe to call off the IOLoop.
+        """
+        seen = set(compaction.tombstones)
+        compaction.strings = []
+        for strings, strays in zip(compaction.segment_documents,
+                compaction.strays):
+            for string in strings:
+                if string not in seen and string not in strays:
+                    seen.add(string)
+                    compaction.strings.append(string)
+        return self.build_segment(compaction.strings)
+
+    def finish_compaction(self, compaction, segment):
+        """
+        Swaps the rebuilt segment in for the ones it was built from, which
+        now holds their strings, and clears the tombstones of the deleted
+        strings it left out (unless they were added again meanwhile, which
+        put them in the live segment). Does nothing if the index was
+        replaced in the meantime.
+        """
+        if compaction is not self.compaction:
+            return
+        self.compaction = None
+        compacted = set(id(segment) for segment in compaction.segments)
+        kept = [position for position, other in enumerate(self.segments)
+            if id(other) not in compacted]
+        newer = tuple(self.segments[position] for position in kept)
+        newer_documents = tuple(self.segment_documents[position]
+            for position in kept)
+        self.segments = newer[:1] + (segment,) + newer[1:]
+        self.segment_documents = newer_documents[:1] + \
+            (compaction.strings,) + newer_documents[1:]
+        for string in compaction.tombstones:
+            if id(self.owners.get(string)) in compacted:
+                del self.owners[string]
+                self.tombstones.discard(string)
+        self.owners.update(dict.fromkeys(compaction.strings, segment))
+        for segment_id in compacted:
+            self.strays.pop(segment_id, None)
+        self.generation += 1
+
+    def false_positive_rate(self):
+        """
+        Bounds the chance that contains is wrong when it says yes, by
+        summing the rates of any segments that can give false positives.
+        Returns None if none of them can.
+        """
+        rates = [segment.false_positive_rate for segment in self.segments
+            if hasattr(segment, 'false_positive_rate')]
+        if not rates:
+            return None
+        return min(1.0, sum(rates))
+
+def parse_batch(body):
+    """
+    Reads a batch of strings from a request body, given either as a JSON
+    array or one string per line
+    """
+    body = body.decode('utf-8')
+    if body.lstrip().startswith('['):
+        try:
+            strings = json.loads(body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Malformed JSON array")
+        if not all(isinstance(string, basestring) for string in strings):
+            raise tornado.web.HTTPError(400, "Batches may only hold strings")
+        return strings
+    return [line for line in body.splitlines() if line]
+
+class Compactor(object):
+    """
+    Compacts an index (segmented or sharded) whenever it has tombstones, and
+    merges its segments whenever there are too many. Segments are rebuilt on
+    the batch worker thread, so compactions queue up behind batches rather
+    than compete with them.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.executor = BatchAddHandler.executor
+
+    @run_on_executor
+    def build(self, compaction):
+        return self.index.build_compaction(compaction)
+
+    @tornado.gen.coroutine
+    def compact(self):
+        """
+        Compacts or merges until there's nothing left to do
+        """
+        while True:
+            compaction = self.index.begin_compaction()
+            if compaction is None:
+                return
+            segment = yield self.build(compaction)
+            self.index.finish_compaction(compaction, segment)
+
+    def start(self, interval=COMPACT_INTERVAL):
+        callback = tornado.ioloop.PeriodicCallback(self.compact, interval)
+        callback.start()
+        return callback
+
+class BatchAddHandler(tornado.web.RequestHandler):
+    """
+    Handler for adding many strings at once. The new segment is built on a
+    worker thread, so the IOLoop keeps serving searches in the meantime.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def initialize(self, index):
+        self.index = index
+
+    @run_on_executor
+    def build_segment(self, strings):
+        return self.index.build_segment(strings)
+
+    @tornado.gen.coroutine
+    def post(self):
+        strings = parse_batch(self.request.body)
+        if strings:
+            segment = yield self.build_segment(strings)
+            self.index.publish(segment, strings)
+            # Merge segments as they pile up, rather than a minute later
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                Compactor(self.index).compact)
+        self.write(json.dumps({'added': len(strings)}))
+
+class DeleteHandler(tornado.web.RequestHandler):
+    """
+    Handler for deleting strings. Once it has answered, the string no longer
+    turns up in searches: with a publisher (see prefork.py), not until the
+    deletion has been published to the search workers.
+    """
+    def initialize(self, index, publisher=None):
+        self.index = index
+        self.publisher = publisher
+
+    @tornado.gen.coroutine
+    def post(self):
+        string = self.get_argument("string")
+        self.index.delete(string)
+        if self.publisher is not None:
+            yield self.publisher.check()
+        self.write(json.dumps({'deleted': string}))
+
+class UpdateHandler(DeleteHandler):
+    """
+    Handler for replacing the string old with the string new
+    """
+    @tornado.gen.coroutine
+    def post(self):
+        old, new = self.get_argument("old"), self.get_argument("new")
+        self.index.update(old, new)
+        if self.publisher is not None:
+            yield self.publisher.check()
+        self.write(json.dumps({'deleted': old, 'added': new}))
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Sharded indexes for the search applications.
+
+A sharded index partitions its documents across a number of shards by a hash
+of each document, so that no one index (or, with worker processes, no one
+process) has to hold the whole corpus. A search is sent to every shard before
+any reply is read, so worker process shards all search at once, and each
+shard's sorted results are combined with a k-way heap merge, so the combined
+results come out sorted too. A document always hashes to the same shard, so
+no two shards ever return the same result. A handler's search carries the
+page it's after (see results.py), and each shard returns no more of its
+results than that page could need.
+
+Every request to a shard gets a future for its reply. Handlers wait for them
+with lookup, so the IOLoop carries on while the shards work; batch and
+compaction builds, which run on a worker thread, simply block on them. Worker
+processes build on a thread of their own, so they keep answering searches
+while a build runs.
+"""
+
+import heapq
+import itertools
+import multiprocessing
+import threading
+import tornado.gen
+import zlib
+
+import metrics
+import results
+import segments
+
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Requests that worker process shards handle on their build thread
+BUILD_METHODS = frozenset(['build', 'build_compaction'])
+
+def shard_number(string, shards):
+    """
+    Picks a shard for a document. crc32 (unlike hash) gives every process
+    the same answer.
+    """
+    if isinstance(string, unicode):
+        string = string.encode('utf-8')
+    return (zlib.crc32(string) & 0xffffffff) % shards
+
+class Shard(object):
+    """
+    One shard's segmented index, answering requests by name. A batch is
+    built by one request and published by another, so that every shard's
+    part of a batch can be built first and then published together.
+    """
+    def __init__(self, factory, options):
+        self.index = segments.SegmentedIndex(factory, **options)
+        self.pending = {}
+        self.compactions = {}
+
+    def handle(self, method, args):
+        return getattr(self, 'handle_' + method)(*args)
+
+    def handle_add(self, string):
+        self.index.add(string)
+
+    def handle_delete(self, string):
+        self.index.delete(string)
+
+    def handle_search(self, *args):
+        return sorted(self.index.search(*args))
+
+    def handle_search_page(self, page, *args):
+        # The page's results are among each shard's first offset + limit
+        # past after, and one more says whether any follow
+        limit, offset, after = page
+        matches = self.index.search(*args)
+        if limit is None:
+            return list(results.iter_page(matches, after))
+        return results.select_results(matches, offset + limit + 1, 0,
+            after)[0]
+
+    def handle_contains(self, substring):
+        return self.index.contains(substring)
+
+    def handle_completions(self, prefix, limit):
+        # Each shard only offers its own top completions (see segments.py)
+        return self.index.completions(prefix,
+            max(limit, segments.COMBINED_COMPLETIONS))
+
+    def handle_false_positive_rate(self):
+        return self.index.false_positive_rate()
+
+    def handle_stats(self):
+        return metrics.index_stats(self.index)
+
+    def handle_documents(self):
+        return list(self.index.iter_documents())
+
+    def handle_build(self, batch, strings):
+        if strings:
+            self.pending[batch] = (self.index.build_segment(strings), strings)
+
+    def handle_publish(self, batch):
+        if batch in self.pending:
+            self.index.publish(*self.pending.pop(batch))
+
+    def handle_begin_compaction(self, number):
+        compaction = self.index.begin_compaction()
+        if compaction is not None:
+            self.compactions[number] = compaction
+        return compaction is not None
+
+    def handle_build_compaction(self, number):
+        if number in self.compactions:
+            compaction = self.compactions[number]
+            self.compactions[number] = (compaction,
+                self.index.build_compaction(compaction))
+
+    def handle_finish_compaction(self, number):
+        if number in self.compactions:
+            self.index.finish_compaction(*self.compactions.pop(number))
+
+class LocalShard(Shard):
+    """
+    A shard in this process
+    """
+    def send(self, method, *args):
+        """
+        Handles a request, returning a future holding its reply
+        """
+        future = Future()
+        try:
+            future.set_result(self.handle(method, args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def close(self):
+        pass
+
+def serve_shard(connection, factory, options):
+    """
+    Answers requests for a shard in a worker process until told to stop
+    (or the connection is closed). Builds are handled on a thread of their
+    own, and every other request as it arrives, so searches are answered
+    while a build runs. Replies are tagged with their request's number,
+    since they can come back out of order.
+    """
+    shard = Shard(factory, options)
+    builder = ThreadPoolExecutor(max_workers=1)
+    lock = threading.Lock()
+
+    def answer(number, method, args):
+        try:
+            reply = (number, True, shard.handle(method, args))
+        except Exception as error:
+            reply = (number, False, error)
+        with lock:
+            connection.send(reply)
+
+    while True:
+        try:
+            number, method, args = connection.recv()
+        except EOFError:
+            break
+        if method is None:
+            break
+        if method in BUILD_METHODS:
+            builder.submit(answer, number, method, args)
+        else:
+            answer(number, method, args)
+    builder.shutdown()
+
+class ProcessShard(object):
+    """
+    A shard in a worker process, talked to over a Unix socket pair. Each
+    request gets a future, which a thread reading the shard's replies
+    resolves, so requests can be in flight to every shard at once, and none
+    waits on another's reply.
+    """
+    def __init__(self, factory, options):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve_shard,
+            args=(child, factory, options))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.requests = itertools.count()
+        # The futures of requests awaiting their replies, by number
+        self.futures = {}
+        # Held while sending, since requests come from the IOLoop and from
+        # batch worker threads alike
+        self.lock = threading.Lock()
+        self.reader = threading.Thread(target=self.read_replies)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def send(self, method, *args):
+        """
+        Sends a request, returning a future for its reply
+        """
+        future = Future()
+        with self.lock:
+            number = next(self.requests)
+            self.futures[number] = future
+            try:
+                self.connection.send((number, method, args))
+            except:
+                del self.futures[number]
+                raise
+        return future
+
+    def read_replies(self):
+        """
+        Resolves each request's future as its reply arrives, until the
+        worker process exits
+        """
+        while True:
+            try:
+                number, succeeded, reply = self.connection.recv()
+            except (EOFError, IOError):
+                break
+            future = self.futures.pop(number)
+            if succeeded:
+                future.set_result(reply)
+            else:
+                future.set_exception(reply)
+        for number in list(self.futures):
+            self.futures.pop(number).set_exception(
+                EOFError("The shard process exited"))
+
+    def close(self):
+        # Later shards' processes hold copies of this connection, so closing
+        # it wouldn't be noticed; the worker process exits when asked, and
+        # its reader sees it go
+        with self.lock:
+            self.connection.send((None, None, ()))
+        self.process.join()
+        self.reader.join()
+        self.connection.close()
+
+def gather(futures):
+    """
+    Waits for every reply, then returns them all, or raises the first error
+    any shard replied with. This blocks, so it's for worker threads (and
+    requests that shards answer straight away); handlers use lookup.
+    """
+    return [future.result() for future in futures]
+
+@tornado.gen.coroutine
+def gather_async(futures):
+    """
+    Resolves to every reply, or to the first error any shard replied with,
+    without blocking the IOLoop
+    """
+    replies = []
+    for future in futures:
+        replies.append((yield future))
+    raise tornado.gen.Return(replies)
+
+@tornado.gen.coroutine
+def lookup(index, method, *args):
+    """
+    Calls one of an index's lookups (search, contains, completions or
+    false_positive_rate) from a handler. A sharded index's shards are waited
+    on without blocking the IOLoop; a segmented index answers straight away.
+    """
+    if isinstance(index, ShardedIndex):
+        reply = yield index.lookup(method, *args)
+    else:
+        reply = getattr(index, method)(*args)
+    raise tornado.gen.Return(reply)
+
+@tornado.gen.coroutine
+def search(index, page, *args):
+    """
+    Searches an index from a handler, like lookup. page is the (limit,
+    offset, after) the request asked for; a sharded index's shards only
+    send back as many of their results as that page could need.
+    """
+    if isinstance(index, ShardedIndex):
+        reply = yield index.lookup('search_page', page, *args)
+    else:
+        reply = index.search(*args)
+    raise tornado.gen.Return(reply)
+
+class ShardedIndex(object):
+    """
+    An index partitioned across shards by document hash. Each shard is a
+    segmented index made with factory. It offers the same methods as a
+    SegmentedIndex, so the search applications (and batch adds and
+    snapshots) work with either.
+
+    Args:
+        factory:    the index class to make each shard's segments with
+        shards:     the number of shards
+        processes:  whether to run every shard in a worker process of its
+                    own, rather than in this one
+        options:    keyword arguments passed along to factory
+    """
+    def __init__(self, factory, shards=1, processes=False, **options):
+        shard_class = ProcessShard if processes else LocalShard
+        self.shards = tuple(shard_class(factory, options)
+            for _ in range(shards))
+        self.generation = 0
+        self.batches = itertools.count()
+
+    def send(self, method, *args):
+        """
+        Sends a request to every shard, returning futures for their replies
+        """
+        return [shard.send(method, *args) for shard in self.shards]
+
+    def scatter(self, method, *args):
+        """
+        Sends a request to every shard, then waits for all of their replies
+        """
+        return gather(self.send(method, *args))
+
+    @tornado.gen.coroutine
+    def lookup(self, method, *args):
+        """
+        Sends a lookup to every shard, and resolves to their combined
+        replies once they're all in
+        """
+        replies = yield gather_async(self.send(method, *args))
+        raise tornado.gen.Return(getattr(self, 'combine_' + method)(replies,
+            *args))
+
+    def partition(self, strings):
+        """
+        Splits strings into a list for each shard
+        """
+        parts = [[] for _ in self.shards]
+        for string in strings:
+            parts[shard_number(string, len(parts))].append(string)
+        return parts
+
+    def add(self, string):
+        self.shards[shard_number(string, len(self.shards))].send('add',
+            string).result()
+        self.generation += 1
+
+    def delete(self, string):
+        self.shards[shard_number(string, len(self.shards))].send('delete',
+            string).result()
+        self.generation += 1
+
+    def update(self, old, new):
+        self.delete(old)
+        self.add(new)
+
+    def build_segment(self, strings):
+        """
+        Builds every shard's part of a batch, without publishing any of it.
+        Returns an id for the batch to pass to publish.
+        """
+        batch = next(self.batches)
+        gather([shard.send('build', batch, part)
+            for shard, part in zip(self.shards, self.partition(strings))])
+        return batch
+
+    def publish(self, batch, strings):
+        self.scatter('publish', batch)
+        self.generation += 1
+
+    def begin_compaction(self):
+        """
+        Starts compacting every shard that has tombstones or too many
+        segments. Returns an id for the compaction to pass to
+        build_compaction and finish_compaction, or None if no shard needs
+        compacting.
+        """
+        number = next(self.batches)
+        if any(self.scatter('begin_compaction', number)):
+            return number
+        return None
+
+    def build_compaction(self, number):
+        self.scatter('build_compaction', number)
+        return number
+
+    def finish_compaction(self, number, _):
+        self.scatter('finish_compaction', number)
+        self.generation += 1
+
+    def iter_documents(self):
+        return itertools.chain.from_iterable(self.scatter('documents'))
+
+    def search(self, *args):
+        return self.combine_search(self.scatter('search', *args))
+
+    def combine_search(self, replies, *args):
+        """
+        Merges every shard's sorted search results, in sorted order
+        """
+        return list(heapq.merge(*replies))
+
+    def combine_search_page(self, replies, page, *args):
+        """
+        Merges just as much of the shards' sorted results as page needs
+        """
+        limit, offset, _ = page
+        if limit is None:
+            return list(heapq.merge(*replies))
+        return list(itertools.islice(heapq.merge(*replies),
+            offset + limit + 1))
+
+    def contains(self, substring):
+        return self.combine_contains(self.scatter('contains', substring))
+
+    def combine_contains(self, replies, *args):
+        return any(replies)
+
+    def completions(self, prefix, limit):
+        return self.combine_completions(self.scatter('completions', prefix,
+            limit), prefix, limit)
+
+    def combine_completions(self, replies, prefix, limit):
+        return segments.combine_completions(replies, limit)
+
+    def false_positive_rate(self):
+        return self.combine_false_positive_rate(
+            self.scatter('false_positive_rate'))
+
+    def combine_false_positive_rate(self, replies):
+        rates = [rate for rate in replies if rate is not None]
+        if not rates:
+            return None
+        return min(1.0, sum(rates))
+
+    def combine_stats(self, replies):
+        stats = Counter()
+        for shard_stats in replies:
+            stats.update(shard_stats)
+        stats['generation'] = self.generation
+        return stats
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+def make_index(factory, shards=1, processes=False, **options):
+    """
+    Makes a segmented index, or a sharded one if more than one shard (or
+    any worker processes) are asked for
+    """
+    if shards == 1 and not processes:
+        return segments.SegmentedIndex(factory, **options)
+    return ShardedIndex(factory, shards, processes, **options)
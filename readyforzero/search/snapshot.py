@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A versioned on-disk format for suffix arrays, which can be reopened with mmap.
+
+A snapshot file is laid out as follows (all integers little-endian):
+
+    header              magic, format version, and the number of text
+                        characters, suffixes and documents
+    suffix offsets      int32 per suffix
+    LCP array           int32 per suffix
+    document starts     int32 per document
+    text buffer         UTF-32 code unit per character
+    table header        the byte lengths of the next two sections
+    completion index    JSON object giving each prefix in the completion
+                        table the [start, end) of its completions in the
+                        next section
+    completions         a JSON array of [completion, count] pairs for each
+                        prefix
+
+Every section up to the text is 4-byte aligned, so a MappedSuffixArray reads
+the integer sections (and, on builds with 4-byte wide characters, the text)
+straight out of the mapping. Restarting only costs an mmap call (and parsing
+the small completion index), and every process mapping the same file shares
+one copy of its pages. A prefix's completions are only decoded the first time
+they're asked for, so that popular prefixes are answered from the table
+straight away rather than counted again. Version 1 snapshots, which end with
+the text, are still read; their completion tables start out empty.
+"""
+
+import ctypes
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import tornado.gen
+import tornado.web
+
+import suffixarray
+
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from tornado.concurrent import run_on_executor
+
+MAGIC = b'RFZSNAP\x00'
+VERSION = 2
+READABLE_VERSIONS = (1, 2)
+HEADER = struct.Struct('<8sIIII')
+TABLE_HEADER = struct.Struct('<II')
+
+# Whether the text section can be used in place as a ctypes c_wchar array
+MAP_TEXT = ctypes.sizeof(ctypes.c_wchar) == 4 and sys.byteorder == 'little'
+
+class SnapshotError(ValueError):
+    """
+    Raised when a file isn't a snapshot this version can read
+    """
+
+def int32_bytes(sequence):
+    """
+    Packs a sequence of integers as little-endian int32s
+    """
+    packed = array('i', sequence)
+    if packed.itemsize != 4:
+        return struct.pack('<%di' % len(packed), *packed)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tostring()
+
+def write_completion_table(snapshot_file, table):
+    """
+    Writes a completion table's sections: each prefix's completions as a
+    JSON array, and an index of where they are
+    """
+    offsets = {}
+    chunks = []
+    position = 0
+    for prefix, completions in sorted(table.items()):
+        chunk = json.dumps(completions).encode('utf-8')
+        offsets[prefix] = [position, position + len(chunk)]
+        chunks.append(chunk)
+        position += len(chunk)
+    index = json.dumps(offsets).encode('utf-8')
+    snapshot_file.write(TABLE_HEADER.pack(len(index), position))
+    snapshot_file.write(index)
+    snapshot_file.writelines(chunks)
+
+def save(suffix_array, path):
+    """
+    Writes a suffix array to path. The snapshot is written to a temporary
+    file in the same directory and renamed into place, so a crash midway
+    never leaves a partial snapshot behind.
+    """
+    text = suffix_array.text[:]
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory,
+        prefix='.snapshot-')
+    try:
+        with os.fdopen(descriptor, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(MAGIC, VERSION, len(text),
+                len(suffix_array.array), len(suffix_array.document_starts)))
+            for section in (suffix_array.array, suffix_array.lcp,
+                    suffix_array.document_starts):
+                snapshot_file.write(int32_bytes(section))
+            snapshot_file.write(text.encode('utf-32-le'))
+            write_completion_table(snapshot_file,
+                dict(suffix_array.completion_table))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.rename(temporary_path, path)
+    except:
+        os.unlink(temporary_path)
+        raise
+
+def save_index(index, path):
+    """
+    Writes every document in a segmented index to a snapshot at path
+    """
+    save(suffixarray.SuffixArray.build(index.iter_documents()), path)
+
+def save_segment(segment, strings, path, live=False):
+    """
+    Writes one segment of a segmented index, holding the given strings, to
+    a snapshot at path. A segment's own suffix array is written as it is,
+    unless the segment is live (and so still growing) or has none, in which
+    case one is built from the strings.
+    """
+    suffix_array = getattr(segment, 'suffix_array', segment)
+    if live or not isinstance(suffix_array, suffixarray.SuffixArray):
+        suffix_array = suffixarray.SuffixArray.build(strings)
+    save(suffix_array, path)
+
+class DocumentTable(object):
+    """
+    A read-only sequence of a mapped suffix array's documents, sliced out of
+    its text buffer on demand
+    """
+    def __init__(self, suffix_array):
+        self.suffix_array = suffix_array
+
+    def __len__(self):
+        return len(self.suffix_array.document_starts)
+
+    def __getitem__(self, document_id):
+        if not 0 <= document_id < len(self):
+            raise IndexError(document_id)
+        start = self.suffix_array.document_starts[document_id]
+        return self.suffix_array.text[
+            start:self.suffix_array._document_end(start)]
+
+class CompletionTable(object):
+    """
+    A mapped suffix array's completion table, decoding each prefix's
+    completions out of the snapshot the first time they're asked for.
+    Completions counted since (see SuffixArray.completions) are kept too.
+    """
+    def __init__(self, mapping, offsets, start):
+        self.mapping = mapping
+        self.offsets = offsets
+        self.start = start
+        self.decoded = {}
+
+    def __contains__(self, prefix):
+        return prefix in self.decoded or prefix in self.offsets
+
+    def __getitem__(self, prefix):
+        if prefix not in self.decoded:
+            start, end = self.offsets[prefix]
+            self.decoded[prefix] = [tuple(pair) for pair in json.loads(
+                self.mapping[self.start + start:self.start + end])]
+        return self.decoded[prefix]
+
+    def __setitem__(self, prefix, completions):
+        self.decoded[prefix] = completions
+
+    def __iter__(self):
+        return iter(set(self.offsets).union(self.decoded))
+
+    def __len__(self):
+        return len(set(self.offsets).union(self.decoded))
+
+    def keys(self):
+        return list(self)
+
+class MappedSuffixArray(suffixarray.SuffixArray):
+    """
+    A read-only suffix array served directly from a snapshot file
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            header = snapshot_file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise SnapshotError("%s is too short to be a snapshot" % path)
+            magic, version, text_length, suffixes, documents = \
+                HEADER.unpack(header)
+            if magic != MAGIC:
+                raise SnapshotError("%s is not a snapshot" % path)
+            if version not in READABLE_VERSIONS:
+                raise SnapshotError("%s is a version %d snapshot; expected "
+                    "version %d" % (path, version, VERSION))
+            # A private mapping shares the page cache with other processes
+            # until written to, which nothing here does.
+            self.mapping = mmap.mmap(snapshot_file.fileno(), 0,
+                access=mmap.ACCESS_COPY)
+
+        position = HEADER.size
+        sections = []
+        for length in (suffixes, suffixes, documents):
+            sections.append((ctypes.c_int32 * length).from_buffer(
+                self.mapping, position))
+            position += 4 * length
+        self.array, self.lcp, self.document_starts = sections
+        if MAP_TEXT:
+            self.text = (ctypes.c_wchar * text_length).from_buffer(
+                self.mapping, position)
+        else:
+            self.text = self.mapping[position:position + 4 * text_length]\
+                .decode('utf-32-le')
+        position += 4 * text_length
+        self.documents = DocumentTable(self)
+        self.document_ids = None
+        if version == 1:
+            self.completion_table = {}
+        else:
+            index_length, _ = TABLE_HEADER.unpack_from(self.mapping, position)
+            position += TABLE_HEADER.size
+            self.completion_table = CompletionTable(self.mapping,
+                json.loads(self.mapping[position:position + index_length]),
+                position + index_length)
+
+    def insert(self, string):
+        raise TypeError("Snapshots are read-only")
+
+    add = insert
+
+def restore_segment(index, path):
+    """
+    Turns a snapshot into a segment for a segmented index, returning it along
+    with its documents. Index kinds that can wrap a suffix array (those with
+    a from_suffix_array classmethod) serve the mapping directly; others, and
+    sharded indexes, are rebuilt from the snapshot's documents.
+    """
+    mapped = MappedSuffixArray(path)
+    if hasattr(getattr(index, 'factory', None), 'from_suffix_array'):
+        segment = index.factory.from_suffix_array(mapped, **index.options)
+    else:
+        segment = index.build_segment(mapped.documents)
+    return segment, mapped.documents
+
+def restore_index(index, path):
+    """
+    Publishes the contents of a snapshot as a segment of a segmented index
+    """
+    index.publish(*restore_segment(index, path))
+
+class SnapshotHandler(tornado.web.RequestHandler):
+    """
+    Handler for writing the index to its snapshot file. The snapshot is
+    built on a worker thread, so searches carry on in the meantime.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def initialize(self, index, path):
+        self.index = index
+        self.path = path
+
+    @run_on_executor
+    def save(self):
+        save_index(self.index, self.path)
+
+    @tornado.gen.coroutine
+    def post(self):
+        yield self.save()
+        self.write(json.dumps({'snapshot': self.path}))
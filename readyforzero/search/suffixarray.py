@@ -5,60 +5,475 @@
 A module for working with suffix arrays
 """
 
-import difflib
+import bisect
+import heapq
+import levenshtein
+
+from array import array
+
+# Terminates every document in the text buffer. It sorts below any printable
+# character, so a suffix that is a prefix of another still sorts first.
+SEPARATOR = u'\x00'
+
+# Fuzzy searches forgive one typo unless told otherwise. Budgets past
+# MAX_EDITS match nearly everything and make the walk visit most of the index.
+DEFAULT_MAX_EDITS = 1
+MAX_EDITS = 2
+
+# Completions offered for a prefix unless told otherwise, and at most
+DEFAULT_COMPLETIONS = 10
+MAX_COMPLETIONS = 100
+# Prefixes starting more suffixes than this are popular: their top
+# completions are kept in a table rather than counted on every keystroke.
+# Bulk builds fill the table for popular prefixes up to TABLE_PREFIX_LENGTH
+# characters long, the ones that are slowest to count.
+POPULAR_SUFFIXES = 64
+TABLE_PREFIX_LENGTH = 2
+
+def rank_completions(counts, limit):
+    """
+    Returns the limit (completion, count) pairs with the highest counts,
+    breaking ties alphabetically
+    """
+    return heapq.nsmallest(limit, counts, key=lambda pair: (-pair[1], pair[0]))
+
+def _sais(codes, alphabet_size):
+    """
+    Builds the suffix array of a sequence of integer codes in linear time
+    using SA-IS (Nong, Zhang & Chan). The last code must be a unique 0
+    sentinel and all other codes must fall in [1, alphabet_size).
+    """
+    n = len(codes)
+    if n == 1:
+        return [0]
+
+    # True for S-type positions, False for L-type ones
+    types = [False] * n
+    types[-1] = True
+    for i in range(n - 2, -1, -1):
+        types[i] = codes[i] < codes[i + 1] or \
+            (codes[i] == codes[i + 1] and types[i + 1])
+
+    def is_lms(i):
+        return i > 0 and types[i] and not types[i - 1]
+
+    counts = [0] * alphabet_size
+    for code in codes:
+        counts[code] += 1
+
+    def bucket_bounds(tails):
+        bounds, total = [0] * alphabet_size, 0
+        for code in range(alphabet_size):
+            total += counts[code]
+            bounds[code] = total if tails else total - counts[code]
+        return bounds
+
+    def induce(lms_positions):
+        sa = [-1] * n
+        tails = bucket_bounds(True)
+        for i in reversed(lms_positions):
+            tails[codes[i]] -= 1
+            sa[tails[codes[i]]] = i
+        heads = bucket_bounds(False)
+        for j in range(n):
+            i = sa[j] - 1
+            if sa[j] > 0 and not types[i]:
+                sa[heads[codes[i]]] = i
+                heads[codes[i]] += 1
+        tails = bucket_bounds(True)
+        for j in range(n - 1, -1, -1):
+            i = sa[j] - 1
+            if sa[j] > 0 and types[i]:
+                tails[codes[i]] -= 1
+                sa[tails[codes[i]]] = i
+        return sa
+
+    def lms_substrings_equal(a, b):
+        if a == n - 1 or b == n - 1:
+            return a == b
+        j = 0
+        while True:
+            if codes[a + j] != codes[b + j] or types[a + j] != types[b + j]:
+                return False
+            if j > 0 and (is_lms(a + j) or is_lms(b + j)):
+                return is_lms(a + j) and is_lms(b + j)
+            j += 1
+
+    lms_positions = [i for i in range(1, n) if is_lms(i)]
+    sa = induce(lms_positions)
+
+    # Name each LMS substring by its rank, then sort the reduced string
+    names = [-1] * n
+    name, previous = 0, None
+    for i in sa:
+        if is_lms(i):
+            if previous is not None and not lms_substrings_equal(previous, i):
+                name += 1
+            names[i] = name
+            previous = i
+    reduced = [names[i] for i in lms_positions]
+    if name + 1 == len(reduced):
+        reduced_sa = [0] * len(reduced)
+        for position, code in enumerate(reduced):
+            reduced_sa[code] = position
+    else:
+        reduced_sa = _sais(reduced, name + 1)
+
+    return induce([lms_positions[j] for j in reduced_sa])
 
 class SuffixArray(object):
     """
     Suffix Array class. Ideal for fast fuzzy string matching
+
+    Rather than keeping every suffix as its own string, all documents are
+    concatenated into a single text buffer (each followed by SEPARATOR) and
+    the array holds integer offsets into that buffer. Owning documents are
+    found by bisecting the table of document start offsets.
+
+    lcp[i] holds the length of the longest common prefix of the suffixes in
+    positions i - 1 and i (never extending past a separator); lcp[0] is 0.
+
+    completion_table maps popular prefixes to their MAX_COMPLETIONS top
+    completions. It's filled by build and as prefixes are asked for, and
+    entries that an inserted document would change are dropped.
     """
     def __init__(self):
-        self.array = []
-        self.hashmap = {}
+        self.text = u''
+        self.array = array('i')
+        self.lcp = array('i')
+        self.documents = []
+        self.document_starts = array('i')
+        self.document_ids = {}
+        self.completion_table = {}
+
+    def __len__(self):
+        return len(self.array)
+
+    @classmethod
+    def build(cls, strings):
+        """
+        Bulk-builds a suffix array (and its LCP array) over the given strings
+        in linear time, which is much faster than inserting them one by one.
+        """
+        suffix_array = cls()
+        chunks = []
+        for string in strings:
+            if SEPARATOR in string:
+                raise ValueError(
+                    "Strings may not contain the separator character")
+            if string in suffix_array.document_ids:
+                continue
+            suffix_array.document_ids[string] = len(suffix_array.documents)
+            suffix_array.documents.append(string)
+            suffix_array.document_starts.append(
+                suffix_array.document_starts[-1] + len(chunks[-1])
+                if chunks else 0)
+            chunks.append(string + SEPARATOR)
+        text = suffix_array.text = u''.join(chunks)
+
+        # Rank the alphabet so SA-IS only needs buckets for characters that
+        # actually occur; the separator is the smallest and gets code 1.
+        ranks = dict((char, rank) for rank, char in
+            enumerate(sorted(set(text)), 1))
+        codes = [ranks[char] for char in text]
+        codes.append(0)
+        suffix_array.array = array('i', (offset for offset in
+            _sais(codes, len(ranks) + 1) if codes[offset] > 1))
+        suffix_array.lcp = suffix_array._kasai()
+        suffix_array.fill_completion_table()
+        return suffix_array
+
+    @classmethod
+    def from_suffix_array(cls, suffix_array):
+        """
+        Lets a suffix array loaded from a snapshot serve as an index segment
+        """
+        return suffix_array
+
+    def _kasai(self):
+        """
+        Computes the LCP array for the current suffix array in linear time
+        (Kasai et al.)
+        """
+        text, lcp = self.text, array('i', [0]) * len(self.array)
+        rank = array('i', [0]) * len(text)
+        for index, offset in enumerate(self.array):
+            rank[offset] = index
+        common = 0
+        for offset in range(len(text)):
+            if text[offset] == SEPARATOR:
+                common = 0
+                continue
+            index = rank[offset]
+            if index > 0:
+                previous = self.array[index - 1]
+                while text[offset + common] == text[previous + common] and \
+                        text[offset + common] != SEPARATOR:
+                    common += 1
+                lcp[index] = common
+                common = max(common - 1, 0)
+            else:
+                common = 0
+        return lcp
+
+    def _common_prefix_length(self, first, second):
+        """
+        Length of the common prefix of the suffixes at two text offsets
+        """
+        text, common = self.text, 0
+        while text[first + common] == text[second + common] and \
+                text[first + common] != SEPARATOR:
+            common += 1
+        return common
+
+    def suffix_at(self, offset, length=None):
+        """
+        Materializes the suffix starting at the given text offset, up to the
+        end of its document (or at most length characters of it)
+        """
+        end = self._document_end(offset)
+        if length is not None:
+            end = min(end, offset + length)
+        return self.text[offset:end]
+
+    def _document_id(self, offset):
+        return bisect.bisect_right(self.document_starts, offset) - 1
+
+    def _document_end(self, offset):
+        """
+        Returns the offset of the separator ending the document that the
+        given text offset falls in
+        """
+        following = self._document_id(offset) + 1
+        if following < len(self.document_starts):
+            return self.document_starts[following] - 1
+        return len(self.text) - 1
+
+    def suffix(self, index, length=None):
+        """
+        Materializes the suffix in the given position of the array
+        """
+        return self.suffix_at(self.array[index], length)
+
+    def document(self, document_id):
+        return self.documents[document_id]
+
+    def iter_documents(self):
+        """
+        Yields every document, in insertion order
+        """
+        for document_id in range(len(self.document_starts)):
+            yield self.document(document_id)
+
+    def document_at(self, offset):
+        """
+        Returns the document that the given text offset falls in
+        """
+        return self.document(self._document_id(offset))
+
+    def _bisect_left(self, suffix, lo=0, hi=None, length=None):
+        """
+        bisect.bisect_left over array[lo:hi], comparing materialized suffixes
+        (cut down to length characters, if given)
+        """
+        if hi is None:
+            hi = len(self.array)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.suffix(mid, length) < suffix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _bisect_right(self, suffix, lo=0, hi=None, length=None):
+        """
+        bisect.bisect_right over array[lo:hi], comparing materialized suffixes
+        (cut down to length characters, if given)
+        """
+        if hi is None:
+            hi = len(self.array)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if suffix < self.suffix(mid, length):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
 
     def insert(self, string):
         """
         Add a new string to the suffix array
+
+        Only the new suffixes are sorted; they are then merged into the
+        existing order one at a time. Since they arrive in sorted order, each
+        bisection can start from where the previous suffix landed, so the rest
+        of the array never has to be re-sorted.
         """
-        for i in range(len(string)):
-            self.array.append(string[i:])
-            try:
-                self.hashmap[string[i:]].append(string)
-            except KeyError:
-                self.hashmap[string[i:]] = [string]
-        self.array = sorted(self.array)
+        if SEPARATOR in string:
+            raise ValueError("Strings may not contain the separator character")
+        if string in self.document_ids:
+            return
+
+        start = len(self.text)
+        self.document_ids[string] = len(self.documents)
+        self.documents.append(string)
+        self.document_starts.append(start)
+        self.text += string + SEPARATOR
+        for prefix in [prefix for prefix in self.completion_table
+                if prefix in string]:
+            del self.completion_table[prefix]
 
-    def get_fuzzy_search_results(self, string):
+        position = 0
+        for offset in sorted(range(start, start + len(string)),
+                key=self.suffix_at):
+            position = self._bisect_right(self.suffix_at(offset), position)
+            self.array.insert(position, offset)
+            self.lcp.insert(position, self._common_prefix_length(
+                self.array[position - 1], offset) if position > 0 else 0)
+            if position + 1 < len(self.array):
+                self.lcp[position + 1] = self._common_prefix_length(
+                    offset, self.array[position + 1])
+            position += 1
+
+    def get_fuzzy_search_results(self, string, max_edits=DEFAULT_MAX_EDITS):
         """
-        Uses _fuzzy_search and matches results to the hashmap's keys
+        Uses _fuzzy_search and maps the matching suffixes back to their
+        documents
         """
-        results = []
-        for result in self._fuzzy_search(string):
-            results.extend(self.hashmap[result])
-        return set(results)
+        return set(self.document_at(offset)
+            for offset in self._fuzzy_search(string, max_edits))
 
-    def _fuzzy_search(self, string, position=0, array=None):
+    def _exact_range(self, string):
         """
-        Approximate text search
+        Returns the (lo, hi) range of the array holding the suffixes that
+        start with string
         """
-        if not array:
-            array = self.array
+        lo = self._bisect_left(string, length=len(string))
+        return lo, self._bisect_right(string, lo, length=len(string))
 
-        if len(array) == 0:
-            return array
-        elif len(array) == 1:
-            if difflib.SequenceMatcher(a=string, 
-                    b=array[0][:len(string)]).ratio() < 0.60:
-                return []
-            else:
-                return array
+    def get_exact_search_results(self, string):
+        """
+        Returns the documents containing string
+        """
+        lo, hi = self._exact_range(string)
+        return set(self.document_at(offset) for offset in self.array[lo:hi])
+
+    def __contains__(self, string):
+        lo, hi = self._exact_range(string)
+        return lo < hi
+
+    def _count_completion(self, counts, completion):
+        """
+        Counts an occurrence of completion, given counts of [completion,
+        count] pairs in suffix order
+        """
+        if counts and counts[-1][0] == completion:
+            counts[-1][1] += 1
         else:
-            start_point = array[0]
-            end_point = array[-1]
-            if len(start_point) > position and len(end_point) > position and \
-                    start_point[position] == end_point[position]:
-                return self._fuzzy_search(string, position + 1, array)
+            counts.append([completion, 1])
+
+    def fill_completion_table(self, max_length=TABLE_PREFIX_LENGTH):
+        """
+        Fills completion_table for every popular prefix of up to max_length
+        characters, in a single pass over the array. The suffixes starting
+        with each prefix are contiguous, so one group of counts per length
+        is open at a time.
+        """
+        # [prefix, suffixes, counts] for each length
+        groups = [[None, 0, []] for _ in range(max_length)]
+
+        def close(group):
+            prefix, suffixes, counts = group
+            if suffixes > POPULAR_SUFFIXES:
+                self.completion_table[prefix] = [tuple(pair) for pair in
+                    rank_completions(counts, MAX_COMPLETIONS)]
+
+        for offset in self.array:
+            completion = self.suffix_at(offset)
+            for length, group in enumerate(groups, 1):
+                if len(completion) < length:
+                    break
+                if completion[:length] != group[0]:
+                    close(group)
+                    group[:] = [completion[:length], 0, []]
+                group[1] += 1
+                self._count_completion(group[2], completion)
+        for group in groups:
+            close(group)
+
+    def completions(self, prefix, limit=DEFAULT_COMPLETIONS):
+        """
+        Returns up to limit (completion, count) pairs, most frequent first.
+        A completion is the rest of a document from wherever prefix occurs in
+        it, and its count is the number of times it occurs.
+
+        The suffixes starting with prefix are found with two bisections, and
+        identical completions sit next to each other among them, so they're
+        counted in a single pass. Popular prefixes are answered from
+        completion_table instead.
+        """
+        if prefix in self.completion_table:
+            return self.completion_table[prefix][:limit]
+        lo, hi = self._exact_range(prefix)
+        counts = []
+        for offset in self.array[lo:hi]:
+            self._count_completion(counts, self.suffix_at(offset))
+        if hi - lo <= POPULAR_SUFFIXES:
+            return [tuple(pair) for pair in rank_completions(counts, limit)]
+        top = self.completion_table[prefix] = [tuple(pair) for pair in
+            rank_completions(counts, MAX_COMPLETIONS)]
+        return top[:limit]
+
+    # So that a suffix array can be used as a search application's index
+    add = insert
+    search = get_fuzzy_search_results
+
+    def _fuzzy_search(self, string, max_edits=DEFAULT_MAX_EDITS, lo=0,
+            hi=None):
+        """
+        Approximate text search over array[lo:hi]: finds the suffixes that
+        start with some string within max_edits edits of the query. Returns
+        their text offsets, in array order
+
+        The suffixes are fed through a Levenshtein automaton in sorted order,
+        so a suffix only has to step the characters past its LCP with the
+        previous one. Once a prefix is accepted (or can no longer match),
+        every suffix sharing that prefix gets the same answer, and a bisection
+        skips to the end of their run. The work per query is therefore bounded
+        by the number of distinct prefixes that stay within max_edits of the
+        query, not by the size of the index.
+        """
+        if hi is None:
+            hi = len(self.array)
+
+        automaton = levenshtein.LevenshteinAutomaton(string, max_edits)
+        states = [automaton.start()]
+        results = []
+        index = lo
+        while index < hi:
+            offset = self.array[index]
+            depth = min(self.lcp[index], len(states) - 1) if index > lo else 0
+            del states[depth + 1:]
+
+            state = states[depth]
+            while automaton.can_match(state) and \
+                    not automaton.is_match(state) and \
+                    self.text[offset + depth] != SEPARATOR:
+                state = automaton.step(state, self.text[offset + depth])
+                states.append(state)
+                depth += 1
+
+            if automaton.is_match(state):
+                end = self._bisect_right(self.suffix_at(offset, depth),
+                    index + 1, hi, depth)
+                results.extend(self.array[index:end])
+            elif not automaton.can_match(state):
+                end = self._bisect_right(self.suffix_at(offset, depth),
+                    index + 1, hi, depth)
             else:
-                length = len(array) / 2
-                left = self._fuzzy_search(string, position, array[:length])
-                right = self._fuzzy_search(string, position, array[length:])
-                return left + right
+                # The suffix ran out undecided; longer suffixes sharing it
+                # follow directly and carry on from its states.
+                end = index + 1
+            index = end
+        return results
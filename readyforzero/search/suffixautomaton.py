@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A module for working with generalized suffix automata
+"""
+
+class SuffixAutomaton(object):
+    """
+    Generalized suffix automaton over a set of strings. Every substring of
+    every inserted string is spelled by exactly one path from the root, so
+    substring queries take O(len(query)) steps, and the automaton has at most
+    twice as many states as the strings have characters in total.
+
+    States are stored in parallel lists indexed by state number. The state
+    reached by each prefix of each document keeps that document's id, so
+    there is one id per character inserted. A document contains X exactly
+    when one of its prefixes ends with X, that is when one of its prefixes'
+    states lies under X's state in the suffix-link tree, so "which documents
+    contain X" costs O(len(X)) plus a walk over that subtree, which holds
+    fewer than two states per occurrence of X.
+    """
+    def __init__(self):
+        self.transitions = [{}]
+        self.links = [-1]
+        self.lengths = [0]
+        # The suffix-link tree, as each state's list of children
+        self.children = [[]]
+        # The ids of the documents with a prefix ending at each state
+        self.terminals = [[]]
+        self.documents = []
+        self.document_ids = {}
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _new_state(self, length, transitions, link):
+        self.transitions.append(transitions)
+        self.links.append(link)
+        self.lengths.append(length)
+        self.children.append([])
+        self.terminals.append([])
+        state = len(self.lengths) - 1
+        self.children[link].append(state)
+        return state
+
+    def _set_link(self, state, link):
+        self.children[self.links[state]].remove(state)
+        self.links[state] = link
+        self.children[link].append(state)
+
+    def _clone(self, state, length):
+        """
+        Splits off the shorter substrings of state into a new state, which
+        becomes its suffix link. Prefixes ending at state keep doing so,
+        since each is the longest substring of its state.
+        """
+        clone = self._new_state(length, dict(self.transitions[state]),
+            self.links[state])
+        self._set_link(state, clone)
+        return clone
+
+    def _redirect(self, state, char, old_target, new_target):
+        """
+        Points state and its suffix-link ancestors at new_target on char, as
+        long as they currently point at old_target
+        """
+        while state != -1 and \
+                self.transitions[state].get(char) == old_target:
+            self.transitions[state][char] = new_target
+            state = self.links[state]
+
+    def _extend(self, last, char):
+        """
+        Extends the automaton with one character, returning the state for the
+        longest string ending with it
+        """
+        if char in self.transitions[last]:
+            # The string already occurs, possibly as a suffix of a longer one
+            target = self.transitions[last][char]
+            if self.lengths[last] + 1 == self.lengths[target]:
+                return target
+            clone = self._clone(target, self.lengths[last] + 1)
+            self._redirect(last, char, target, clone)
+            return clone
+
+        current = self._new_state(self.lengths[last] + 1, {}, 0)
+        state = last
+        while state != -1 and char not in self.transitions[state]:
+            self.transitions[state][char] = current
+            state = self.links[state]
+        if state != -1:
+            target = self.transitions[state][char]
+            if self.lengths[state] + 1 == self.lengths[target]:
+                self._set_link(current, target)
+            else:
+                clone = self._clone(target, self.lengths[state] + 1)
+                self._redirect(state, char, target, clone)
+                self._set_link(current, clone)
+        return current
+
+    def insert(self, string):
+        """
+        Add a new string to the automaton
+        """
+        if string in self.document_ids:
+            return
+        document_id = len(self.documents)
+        self.document_ids[string] = document_id
+        self.documents.append(string)
+
+        state = 0
+        for char in string:
+            state = self._extend(state, char)
+            self.terminals[state].append(document_id)
+
+    def _walk(self, string):
+        """
+        Returns the state spelling string, or None if it isn't a substring
+        """
+        state = 0
+        for char in string:
+            state = self.transitions[state].get(char)
+            if state is None:
+                return None
+        return state
+
+    def __contains__(self, string):
+        return self._walk(string) is not None
+
+    def documents_containing(self, string):
+        """
+        Returns the inserted strings containing string
+        """
+        state = self._walk(string)
+        if state is None:
+            return []
+        if state == 0:
+            return list(self.documents)
+        document_ids = set()
+        states = [state]
+        while states:
+            state = states.pop()
+            document_ids.update(self.terminals[state])
+            states.extend(self.children[state])
+        return [self.documents[document_id]
+            for document_id in sorted(document_ids)]
@@ -5,14 +5,36 @@
 Some tests for our search application
 """
 
+import bloom
+import cache
+import loadtest
+import metrics
+import prefork
+import results
 import search1
 import search2
 import search2_suffixarray
 import search3
+import segments
+import shards
+import snapshot
 import suffixarray
+import suffixautomaton
 
+import itertools
 import json
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tornado.httpserver
+import tornado.ioloop
 import tornado.testing
+import tornado.web
 import unittest
 import urllib
 
@@ -57,6 +79,175 @@ class TestSearch1(tornado.testing.AsyncHTTPTestCase):
         results = json.loads(x.buffer.read())
         self.assertEqual(results['results'], [])
 
+    def testGetLimit(self):
+        """
+        Test paging through the results for 'a' one at a time
+        """
+        x = self.fetch('/search/a?limit=1', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results, {'results': ["Alabama"], 'next_offset': 1})
+        x = self.fetch('/search/a?limit=1&offset=1', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results, {'results': ["Arkansas"]})
+
+    def testGetAfter(self):
+        """
+        Test resuming the results for 'a' after a given result
+        """
+        x = self.fetch('/search/a?after=Alabama', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results['results'], ["Arkansas"])
+        x = self.fetch('/search/a?after=A&limit=1', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results, {'results': ["Alabama"],
+            'next_after': "Alabama"})
+
+    def testGetStream(self):
+        """
+        Test streaming the results for 'a' as JSON lines
+        """
+        x = self.fetch('/search/a?stream=1', method="GET")
+        self.assertEqual(x.headers['Content-Type'], "application/x-ndjson")
+        self.assertEqual([json.loads(line) for line in x.body.splitlines()],
+            ["Alabama", "Arkansas"])
+
+    def testGetBadLimit(self):
+        """
+        Test what happens when we ask for a nonsensical page
+        """
+        x = self.fetch('/search/a?limit=-1', method="GET")
+        self.assertEqual(x.code, 400)
+        # An empty page would never move next_offset on
+        x = self.fetch('/search/a?limit=0', method="GET")
+        self.assertEqual(x.code, 400)
+
+    def testBatchAdd(self):
+        """
+        Test adding Ohio and Kentucky in one batch, as a JSON array and as
+        lines
+        """
+        x = self.fetch('/add/batch', method='POST',
+            body=json.dumps(['Ohio', 'Kentucky']))
+        self.assertEqual(json.loads(x.body), {'added': 2})
+        x = self.fetch('/add/batch', method='POST', body='Ohio\nKentucky\n')
+        self.assertEqual(json.loads(x.body), {'added': 2})
+        x = self.fetch('/search/hi', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results['results'], ["Ohio"])
+
+    def testBatchAddMalformed(self):
+        """
+        Test what happens when we send a broken JSON array
+        """
+        x = self.fetch('/add/batch', method='POST', body='["Ohio", 5]')
+        self.assertEqual(x.code, 400)
+
+    def testCache(self):
+        """
+        Test that repeated searches are served from the cache until a new
+        string is added
+        """
+        before = json.loads(self.fetch('/cache', method="GET").body)
+        x = self.fetch('/search/yom', method="GET")
+        self.assertEqual(x.headers['X-Cache'], "MISS")
+        x = self.fetch('/search/yom', method="GET")
+        self.assertEqual(x.headers['X-Cache'], "HIT")
+        self.assertEqual(json.loads(x.body)['results'], [])
+        self.fetch('/add', method='POST',
+            body=urllib.urlencode({'string': 'Wyoming'}))
+        x = self.fetch('/search/yom', method="GET")
+        self.assertEqual(x.headers['X-Cache'], "MISS")
+        self.assertEqual(json.loads(x.body)['results'], ["Wyoming"])
+        after = json.loads(self.fetch('/cache', method="GET").body)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 2)
+
+    def testDeleteAndUpdate(self):
+        """
+        Test that Oregon stops turning up once updated to Vermont, and
+        Vermont once deleted
+        """
+        self.fetch('/add', method='POST',
+            body=urllib.urlencode({'string': 'Oregon'}))
+        x = self.fetch('/search/Ore', method="GET")
+        self.assertEqual(json.loads(x.body)['results'], ["Oregon"])
+        self.fetch('/update', method='POST',
+            body=urllib.urlencode({'old': 'Oregon', 'new': 'Vermont'}))
+        x = self.fetch('/search/Ore', method="GET")
+        self.assertEqual(json.loads(x.body)['results'], [])
+        x = self.fetch('/search/mont', method="GET")
+        self.assertEqual(json.loads(x.body)['results'], ["Vermont"])
+        x = self.fetch('/delete', method='POST',
+            body=urllib.urlencode({'string': 'Vermont'}))
+        self.assertEqual(json.loads(x.body), {'deleted': 'Vermont'})
+        x = self.fetch('/search/mont', method="GET")
+        self.assertEqual(json.loads(x.body)['results'], [])
+
+    def testMetrics(self):
+        """
+        Make sure that the phases of searches and the index size are
+        reported
+        """
+        self.fetch('/search/Ark', method="GET")
+        x = self.fetch('/metrics', method="GET")
+        self.assertTrue(x.headers['Content-Type'].startswith('text/plain'))
+        for line in ('search_phase_seconds_count{handler="SearchHandler",'
+                'phase="lookup"}', 'search_phase_seconds_count{handler='
+                '"AddHandler",phase="index"}', 'search_index_documents ',
+                'search_cache_hits_total '):
+            self.assertIn(line, x.body)
+
+class TestSearch1Automaton(TestSearch1):
+    """
+    Test extension 1 of our search application, using the suffix automaton
+    index
+    """
+    def get_app(self):
+        return search1.make_application(
+            segments.SegmentedIndex(search1.SuffixAutomatonIndex))
+
+class TestSearch1SuffixArray(TestSearch1):
+    """
+    Test extension 1 of our search application, using the suffix array
+    index and a snapshot file
+    """
+    def get_app(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'index.snapshot')
+        return search1.make_application(
+            segments.SegmentedIndex(search1.SuffixArrayIndex), self.path)
+
+    def tearDown(self):
+        super(TestSearch1SuffixArray, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def testSnapshot(self):
+        """
+        Test writing a snapshot and restoring it into a fresh index
+        """
+        x = self.fetch('/snapshot', method='POST', body='')
+        self.assertEqual(json.loads(x.body), {'snapshot': self.path})
+        index = segments.SegmentedIndex(search1.SuffixArrayIndex)
+        snapshot.restore_index(index, self.path)
+        self.assertEqual(index.search('Ark'), set(['Arkansas']))
+
+class TestSearch1Sharded(TestSearch1):
+    """
+    Test extension 1 of our search application, with the index split into
+    16 shards
+    """
+    def get_app(self):
+        return search1.make_application(
+            shards.ShardedIndex(search1.SubstringIndex, 16))
+
+class TestSearch1Trigrams(TestSearch1):
+    """
+    Test extension 1 of our search application, using the trigram index
+    """
+    def get_app(self):
+        return search1.make_application(
+            segments.SegmentedIndex(search1.TrigramIndex))
+
 class TestSearch2(tornado.testing.AsyncHTTPTestCase):
     """
     Test extension 2 of our search application
@@ -106,6 +297,50 @@ class TestSearch2(tornado.testing.AsyncHTTPTestCase):
         results = json.loads(x.buffer.read())
         self.assertEqual(results['results'], [])
 
+class TestSearch2Variants(TestSearch2):
+    """
+    Test extension 2 of our search application, using the substitution
+    variant index
+    """
+    def get_app(self):
+        return search2.make_application(
+            segments.SegmentedIndex(search2.VariantIndex))
+
+class TestSearch2Wildcards(TestSearch2):
+    """
+    Test extension 2 of our search application, using the substitution
+    wildcard index
+    """
+    def get_app(self):
+        return search2.make_application(
+            segments.SegmentedIndex(search2.WildcardIndex))
+
+class TestSearch2Indexes(unittest.TestCase):
+    """
+    Tests comparing the fuzzy indexes available to search2
+    """
+    def testWildcardsMatchVariants(self):
+        """
+        Make sure that the substitution wildcard index finds the same strings
+        as the substitution variant index for one-substitution queries
+        """
+        generator = random.Random(0)
+        strings = [''.join(generator.choice('abcAB') for _ in
+            range(generator.randint(1, 8))) for _ in range(20)]
+        wildcards, variants = search2.WildcardIndex(), search2.VariantIndex()
+        for string in strings:
+            wildcards.add(string)
+            variants.add(string)
+        for _ in range(200):
+            string = generator.choice(strings)
+            i = generator.randint(0, len(string) - 1)
+            j = generator.randint(i + 1, len(string))
+            query = list(string[i:j])
+            query[generator.randint(0, len(query) - 1)] = \
+                generator.choice('abcdAB')
+            query = ''.join(query)
+            self.assertEqual(wildcards.search(query), variants.search(query))
+
 class TestSearch2SuffixArray(tornado.testing.AsyncHTTPTestCase):
     """
     Test extension 2 of our search application, using suffix arrays
@@ -154,6 +389,71 @@ class TestSearch2SuffixArray(tornado.testing.AsyncHTTPTestCase):
         x = self.fetch('/search/Banana', method="GET")
         results = json.loads(x.buffer.read())
         self.assertEqual(results['results'], [])
+
+    def testGetMaxEdits(self):
+        """
+        Test what happens when we search for 'Alxbxma' with different edit
+        budgets
+        """
+        x = self.fetch('/search/Alxbxma', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results['results'], [])
+        x = self.fetch('/search/Alxbxma?max_edits=2', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results['results'], ["Alabama"])
+
+    def testGetBadMaxEdits(self):
+        """
+        Test what happens when we ask for an unsupported edit budget
+        """
+        x = self.fetch('/search/Alabama?max_edits=9', method="GET")
+        self.assertEqual(x.code, 400)
+        x = self.fetch('/search/Alabama?max_edits=x', method="GET")
+        self.assertEqual(x.code, 400)
+
+    def testBatchAdd(self):
+        """
+        Test adding Ohio and Kentucky in one batch, then searching for a typo
+        """
+        self.fetch('/add/batch', method='POST', body='Ohio\nKentucky')
+        x = self.fetch('/search/Kentacky', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results['results'], ["Kentucky"])
+
+    def testAutocomplete(self):
+        """
+        Test completing 'Wy' and 'mi' once Wyoming and Laramie Wyoming are
+        in
+        """
+        self.fetch('/add/batch', method='POST',
+            body='Wyoming\nLaramie Wyoming')
+        x = self.fetch('/autocomplete/Wy', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results, {'results': ["Wyoming"], 'counts': [2]})
+        x = self.fetch('/autocomplete/mi?limit=2', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results, {'results': ["ming", "mie Wyoming"],
+            'counts': [2, 1]})
+        x = self.fetch('/autocomplete/Wy?limit=0', method="GET")
+        self.assertEqual(x.code, 400)
+
+    def testDeleteAddedTwice(self):
+        """
+        Test that deleting Cheyenne, added alone and then in a batch, takes
+        it out of search and autocomplete
+        """
+        payload = urllib.urlencode({'string': 'Cheyenne'})
+        self.fetch('/add', method='POST', body=payload)
+        self.fetch('/add/batch', method='POST', body='Cheyenne')
+        x = self.fetch('/autocomplete/Chey', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results, {'results': ["Cheyenne"], 'counts': [1]})
+        self.fetch('/delete', method='POST', body=payload)
+        x = self.fetch('/search/Cheyenne?max_edits=0', method="GET")
+        self.assertEqual(json.loads(x.buffer.read())['results'], [])
+        x = self.fetch('/autocomplete/Chey', method="GET")
+        self.assertEqual(json.loads(x.buffer.read())['results'], [])
+
 class TestSearch3(tornado.testing.AsyncHTTPTestCase):
     """
     Test extension 3 of our search application
@@ -195,6 +495,1017 @@ class TestSearch3(tornado.testing.AsyncHTTPTestCase):
         results = json.loads(x.buffer.read())
         self.assertEqual(results['results'], False)
 
+    def testBatchAdd(self):
+        """
+        Test adding Ohio and Kentucky in one batch
+        """
+        self.fetch('/add/batch', method='POST', body='Ohio\nKentucky')
+        x = self.fetch('/search/tuc', method="GET")
+        results = json.loads(x.buffer.read())
+        self.assertEqual(results['results'], True)
+
+    def testDelete(self):
+        """
+        Test that deleting Vermont leaves only Montana holding 'mont'
+        """
+        self.fetch('/add/batch', method='POST', body='Vermont\nMontana')
+        self.fetch('/delete', method='POST',
+            body=urllib.urlencode({'string': 'Vermont'}))
+        x = self.fetch('/search/ermo', method="GET")
+        self.assertEqual(json.loads(x.body)['results'], False)
+        x = self.fetch('/search/ont', method="GET")
+        self.assertEqual(json.loads(x.body)['results'], True)
+
+    def testMetrics(self):
+        """
+        Make sure that containment checks are timed
+        """
+        self.fetch('/search/Ark', method="GET")
+        x = self.fetch('/metrics', method="GET")
+        self.assertIn('search_phase_seconds_count{handler="SearchHandler",'
+            'phase="lookup"}', x.body)
+
+class TestSearch3Bloom(TestSearch3):
+    """
+    Test extension 3 of our search application, using the Bloom filter
+    index
+    """
+    def get_app(self):
+        return search3.make_application(
+            segments.SegmentedIndex(search3.BloomIndex, error_rate=0.01))
+
+    def testErrorBound(self):
+        """
+        Make sure that responses carry the false positive bound
+        """
+        x = self.fetch('/search/Ark', method="GET")
+        self.assertEqual(json.loads(x.body)['false_positive_rate'], 0.01)
+        self.fetch('/add/batch', method='POST', body='Ohio')
+        x = self.fetch('/search/Ark', method="GET")
+        self.assertEqual(json.loads(x.body)['false_positive_rate'], 0.02)
+
+class TestSearch3Automaton(TestSearch3):
+    """
+    Test extension 3 of our search application, using the suffix automaton
+    index
+    """
+    def get_app(self):
+        return search3.make_application(
+            segments.SegmentedIndex(search3.SuffixAutomatonIndex))
+
+class testSubstringIndex(unittest.TestCase):
+    """
+    Tests for search1's interned substring index
+    """
+    def testPostings(self):
+        """
+        Make sure that each string is posted once per substring, in ID order
+        """
+        index = search1.SubstringIndex()
+        for string in ('banana', 'bandana', 'banana', 'cab'):
+            index.add(string)
+        self.assertEqual(index.documents, ['banana', 'bandana', 'cab'])
+        self.assertEqual(list(index.substring_dict['an']), [0, 1])
+        self.assertEqual(list(index.substring_dict['a']), [0, 1, 2])
+        self.assertEqual(list(index.search('ana')), ['banana', 'bandana'])
+        self.assertEqual(len(index.search('ana')), 2)
+        self.assertEqual(list(index.search('nab')), [])
+
+class CountingList(list):
+    """
+    A list that counts the items looked up in it
+    """
+    lookups = 0
+
+    def __getitem__(self, position):
+        self.lookups += 1
+        return list.__getitem__(self, position)
+
+class testPostingsPaging(unittest.TestCase):
+    """
+    Tests for paging through search1's interned results
+    """
+    def setUp(self):
+        generator = random.Random(5)
+        self.strings = [''.join(generator.choice('abc') for _ in range(8))
+            for _ in range(500)]
+
+    def check(self, index, substring='ab'):
+        expected = sorted(set(s for s in self.strings if substring in s))
+        # The live segment's rank table is built by its first search
+        index.search(substring)
+        index.documents = CountingList(index.documents)
+        matches = index.search(substring)
+        self.assertEqual(results.select_results(matches, 5, 10),
+            (expected[10:15], True))
+        self.assertEqual(index.documents.lookups, 5 + 1)
+        self.assertEqual(results.select_results(matches, 3,
+            after=expected[20]), (expected[21:24], True))
+        self.assertEqual(list(matches.iter_sorted()), expected)
+
+    def testLiveSegment(self):
+        """
+        Make sure that strings added out of order are paged through in
+        sorted order, looking up only the page
+        """
+        index = search1.SubstringIndex()
+        for string in self.strings:
+            index.add(string)
+        self.check(index)
+        # Dense and sparse results are paged through differently
+        self.check(index, 'abca')
+        dense = search1.DENSE_POSTINGS
+        try:
+            search1.DENSE_POSTINGS = 1
+            self.check(index, 'abca')
+        finally:
+            search1.DENSE_POSTINGS = dense
+
+    def testBuiltSegment(self):
+        """
+        Make sure that a built segment's IDs sort like its strings
+        """
+        index = search1.SubstringIndex.build(self.strings)
+        self.assertEqual(index.documents, sorted(set(self.strings)))
+        self.assertEqual(index.ranks, None)
+        self.check(index)
+
+    def testSegments(self):
+        """
+        Make sure that several segments' results are merged lazily, in
+        order, without duplicates or deleted strings
+        """
+        index = segments.SegmentedIndex(search1.SubstringIndex)
+        for string in self.strings[:300]:
+            index.add(string)
+        batch = self.strings[200:]
+        index.publish(index.build_segment(batch), batch)
+        index.delete(self.strings[0])
+        expected = sorted(set(s for s in self.strings[1:] if 'ab' in s) -
+            set([self.strings[0]]))
+        self.assertEqual(results.select_results(index.search('ab'), 4, 2),
+            (expected[2:6], True))
+        self.assertEqual(list(index.search('ab')), expected)
+
+class testTrigramIndex(unittest.TestCase):
+    """
+    Tests for search1's trigram index
+    """
+    def testIntersect(self):
+        """
+        Make sure that galloping intersection finds the common IDs
+        """
+        self.assertEqual(search1.intersect([range(0, 100, 3),
+            range(0, 100, 5), [15, 16, 45, 90, 99]]), [15, 45, 90])
+        self.assertEqual(search1.intersect([[1, 2], []]), [])
+        for target in range(12):
+            self.assertEqual(search1.gallop(range(0, 10, 2), target),
+                min((target + 1) // 2, 5))
+
+    def testSearch(self):
+        """
+        Make sure that results match a scan of every string
+        """
+        random.seed(15)
+        strings = [''.join(random.choice('abc') for _ in
+            range(random.randint(1, 10))) for _ in range(300)]
+        index = search1.TrigramIndex()
+        for string in strings:
+            index.add(string)
+        for substring in ('a', 'bc', 'abc', 'cab', 'abcab', 'aaaa', 'cccccc'):
+            self.assertEqual(list(index.search(substring)),
+                [string for string in index.documents if substring in string])
+
+class testBloom(unittest.TestCase):
+    """
+    Tests for Bloom filters
+    """
+    def setUp(self):
+        random.seed(18)
+        self.keys = set(''.join(random.choice('abcdefgh') for _ in range(8))
+            for _ in range(2000))
+        self.others = set(''.join(random.choice('abcdefgh') for _ in
+            range(8)) for _ in range(20000)) - self.keys
+
+    def check(self, bloom_filter, error_rate):
+        for key in self.keys:
+            bloom_filter.add(key)
+        self.assertTrue(all(key in bloom_filter for key in self.keys))
+        false_positives = sum(key in bloom_filter for key in self.others)
+        self.assertTrue(false_positives <= 2 * error_rate * len(self.others))
+
+    def testBloomFilter(self):
+        """
+        Make sure that there are no false negatives, and few false positives
+        """
+        for error_rate in (0.1, 0.01, 0.001):
+            self.check(bloom.BloomFilter(len(self.keys), error_rate),
+                error_rate)
+
+    def testScalableBloomFilter(self):
+        """
+        Make sure that a growing filter keeps to its error rate
+        """
+        bloom_filter = bloom.ScalableBloomFilter(0.01, initial_capacity=100)
+        self.check(bloom_filter, 0.01)
+        self.assertTrue(len(bloom_filter.filters) > 1)
+
+    def testBloomIndex(self):
+        """
+        Make sure that built and grown indexes find every substring
+        """
+        strings = ['Alabama', 'Arkansas', 'Kentucky']
+        built = search3.BloomIndex.build(strings)
+        grown = search3.BloomIndex()
+        for string in strings:
+            grown.add(string)
+        for index in (built, grown):
+            self.assertTrue(all(index.contains(string[i:j])
+                for string in strings for i in range(len(string))
+                for j in range(i + 1, len(string) + 1)))
+            self.assertFalse(index.contains('Ohio'))
+
+class testSegments(unittest.TestCase):
+    """
+    Tests for segmented indexes
+    """
+    def testPublish(self):
+        """
+        Make sure that a built segment is only searched once published
+        """
+        index = segments.SegmentedIndex(suffixarray.SuffixArray)
+        index.add('Alabama')
+        segment = index.build_segment(['Arkansas'])
+        self.assertEqual(index.search('a', 0), set(['Alabama']))
+        index.publish(segment, ['Arkansas'])
+        self.assertEqual(index.search('a', 0), set(['Alabama', 'Arkansas']))
+
+    def testDelete(self):
+        """
+        Make sure that deleted strings are hidden from every kind of lookup
+        until they're added again
+        """
+        index = segments.SegmentedIndex(suffixarray.SuffixArray)
+        index.add('Alabama')
+        index.add('Arkansas')
+        index.delete('Alabama')
+        self.assertEqual(index.search('a', 0), set(['Arkansas']))
+        self.assertEqual(list(index.iter_documents()), ['Arkansas'])
+        self.assertEqual(index.completions('A', 10), [('Arkansas', 1)])
+        index.add('Alabama')
+        self.assertEqual(index.search('a', 0), set(['Alabama', 'Arkansas']))
+
+        index = segments.SegmentedIndex(search3.SubstringSetIndex)
+        index.add('Alabama')
+        index.add('Arkansas')
+        index.delete('Alabama')
+        self.assertFalse(index.contains('bam'))
+        self.assertTrue(index.contains('a'))
+
+    def testHeldOnce(self):
+        """
+        Make sure that a string added to several segments is counted once,
+        and dropped from all but one by compaction
+        """
+        index = segments.SegmentedIndex(suffixarray.SuffixArray)
+        index.add(u'abc')
+        index.add(u'abc')
+        self.assertEqual(index.completions(u'ab', 10), [(u'abc', 1)])
+        index.publish(index.build_segment([u'abc', u'abd']),
+            [u'abc', u'abd'])
+        self.assertEqual(index.completions(u'ab', 10),
+            [(u'abc', 1), (u'abd', 1)])
+        self.assertEqual(sorted(index.iter_documents()), [u'abc', u'abd'])
+        self.assertEqual(index.search(u'abc', 0), set([u'abc']))
+        compaction = index.begin_compaction()
+        index.finish_compaction(compaction,
+            index.build_compaction(compaction))
+        self.assertEqual(index.strays, {})
+        # Only the batch held a stray, so only it was rebuilt
+        self.assertEqual(index.segment_documents, ([u'abc'], [u'abd']))
+        index.delete(u'abc')
+        self.assertEqual(index.completions(u'ab', 10), [(u'abd', 1)])
+
+    def testCompaction(self):
+        """
+        Make sure that compaction drops deleted strings a segment at a time,
+        leaving segments without any be, and keeps whatever changed while
+        it ran
+        """
+        index = segments.SegmentedIndex(suffixarray.SuffixArray)
+        self.assertEqual(index.begin_compaction(), None)
+        index.add('Alabama')
+        index.add('Arkansas')
+        index.publish(index.build_segment(['Ohio', 'Kentucky']),
+            ['Ohio', 'Kentucky'])
+        index.publish(index.build_segment(['Utah']), ['Utah'])
+        index.delete('Alabama')
+        index.delete('Ohio')
+        compaction = index.begin_compaction()
+        self.assertEqual(compaction.segment_documents,
+            (['Alabama', 'Arkansas'],))
+        self.assertEqual(index.begin_compaction(), None)
+        index.add('Wyoming')
+        index.add('Alabama')
+        index.delete('Arkansas')
+        segment = index.build_compaction(compaction)
+        self.assertEqual(index.search('a', 0), set(['Alabama', 'Utah']))
+        index.finish_compaction(compaction, segment)
+        self.assertEqual(index.segment_documents, (['Wyoming', 'Alabama'],
+            ['Arkansas'], ['Ohio', 'Kentucky'], ['Utah']))
+        self.assertEqual(index.tombstones, set(['Arkansas', 'Ohio']))
+        self.assertEqual(index.search('a', 0), set(['Alabama', 'Utah']))
+
+        compaction = index.begin_compaction()
+        self.assertEqual(compaction.segment_documents, (['Arkansas'],))
+        index.finish_compaction(compaction,
+            index.build_compaction(compaction))
+        compaction = index.begin_compaction()
+        self.assertEqual(compaction.segment_documents,
+            (['Ohio', 'Kentucky'],))
+        utah = index.segments[-1]
+        index.finish_compaction(compaction,
+            index.build_compaction(compaction))
+        self.assertEqual(index.begin_compaction(), None)
+        self.assertEqual(index.tombstones, set())
+        self.assertEqual(sorted(index.iter_documents()),
+            ['Alabama', 'Kentucky', 'Utah', 'Wyoming'])
+        self.assertTrue(utah in index.segments)
+
+        index.delete('Utah')
+        compaction = index.begin_compaction()
+        segment = index.build_compaction(compaction)
+        index.replace(index.build_segment(['Alabama']), ['Alabama'])
+        index.finish_compaction(compaction, segment)
+        self.assertEqual(list(index.iter_documents()), ['Alabama'])
+
+    def testRollOver(self):
+        """
+        Make sure that a full live segment is replaced by a fresh one
+        """
+        size = segments.LIVE_SEGMENT_SIZE
+        try:
+            segments.LIVE_SEGMENT_SIZE = 2
+            index = segments.SegmentedIndex(suffixarray.SuffixArray)
+            for string in ('Alabama', 'Arkansas', 'Ohio', 'Kentucky', 'Iowa'):
+                index.add(string)
+        finally:
+            segments.LIVE_SEGMENT_SIZE = size
+        self.assertEqual(index.segment_documents,
+            (['Iowa'], ['Ohio', 'Kentucky'], ['Alabama', 'Arkansas']))
+        self.assertEqual(index.search('a', 0),
+            set(['Alabama', 'Arkansas', 'Iowa']))
+
+    def testMerge(self):
+        """
+        Make sure that batches are merged by size tier, keeping the number of
+        segments logarithmic, without losing anything added or deleted
+        meanwhile
+        """
+        index = segments.SegmentedIndex(suffixarray.SuffixArray)
+        self.assertEqual(index.begin_compaction(), None)
+        strings = ['%s %d' % (state, number)
+            for number in range(20) for state in ('Ohio', 'Utah')]
+        for position in range(0, len(strings), 2):
+            batch = strings[position:position + 2]
+            index.publish(index.build_segment(batch), batch)
+            tornado.ioloop.IOLoop.current().run_sync(
+                segments.Compactor(index).compact)
+            # The live segment, plus up to 3 of each size: 2, 8 and 32
+            self.assertTrue(len(index.segments) <= 1 + 3 * 3)
+        self.assertEqual(sorted(index.iter_documents()), sorted(strings))
+        self.assertEqual(index.search('Utah 1', 0),
+            set('Utah %d' % number for number in [1] + range(10, 20)))
+        self.assertEqual(sorted(len(strings)
+            for strings in index.segment_documents), [0, 8, 32])
+
+        index.add('Iowa')
+        compaction = None
+        batches = itertools.count()
+        while compaction is None:
+            batch = ['Iowa %d' % next(batches)]
+            index.publish(index.build_segment(batch), batch)
+            compaction = index.begin_compaction()
+        self.assertEqual(len(compaction.segments), segments.MERGE_FACTOR)
+        self.assertFalse(index.segments[0] in compaction.segments)
+        index.delete('Ohio 0')
+        index.publish(index.build_segment(['Utah 0']), ['Utah 0'])
+        index.finish_compaction(compaction,
+            index.build_compaction(compaction))
+        self.assertEqual(index.tombstones, set(['Ohio 0']))
+        self.assertEqual(index.search('Ohio 0', 0), set())
+        self.assertEqual(index.search('Iowa', 0), set(['Iowa'] +
+            ['Iowa %d' % number for number in range(next(batches))]))
+        self.assertEqual(sorted(index.iter_documents()), sorted(strings[1:] +
+            list(index.search('Iowa', 0))))
+
+    def testParseBatch(self):
+        """
+        Make sure that both batch formats are understood
+        """
+        self.assertEqual(segments.parse_batch('["a", "b"]'), ['a', 'b'])
+        self.assertEqual(segments.parse_batch('a\n\nb\n'), ['a', 'b'])
+
+class SlowBuildSuffixArray(suffixarray.SuffixArray):
+    """
+    A suffix array that takes a second to build in bulk
+    """
+    @classmethod
+    def build(cls, strings):
+        time.sleep(1)
+        return super(SlowBuildSuffixArray, cls).build(strings)
+
+class testShards(unittest.TestCase):
+    """
+    Tests for sharded indexes
+    """
+    def setUp(self):
+        random.seed(13)
+        self.strings = [''.join(random.choice('abc') for _ in range(6))
+            for _ in range(60)]
+
+    def check(self, index):
+        for string in self.strings[:30]:
+            index.add(string)
+        batch = index.build_segment(self.strings[30:])
+        self.assertEqual(index.search('ab', 0),
+            sorted(set(s for s in self.strings[:30] if 'ab' in s)))
+        index.publish(batch, self.strings[30:])
+        for substring in ('a', 'ab', 'cab', 'bbb'):
+            self.assertEqual(index.search(substring, 0),
+                sorted(set(s for s in self.strings if substring in s)))
+        # Each string is held once, however often it's added
+        self.assertEqual(sorted(index.iter_documents()),
+            sorted(set(self.strings)))
+
+    def testShardCounts(self):
+        """
+        Make sure that results come out merged and sorted for any number of
+        shards
+        """
+        for count in (1, 2, 3, 16):
+            index = shards.ShardedIndex(suffixarray.SuffixArray, count)
+            self.check(index)
+            self.assertTrue(all(index.partition(self.strings)))
+
+    def testSearchPage(self):
+        """
+        Make sure that each shard only returns what a page could need, and
+        that the merged results still page like the whole set
+        """
+        index = shards.ShardedIndex(suffixarray.SuffixArray, 4)
+        for string in self.strings:
+            index.add(string)
+        matches = sorted(set(s for s in self.strings if 'a' in s))
+        for page in ((3, 0, None), (5, 10, None), (4, 2, matches[7]),
+                (None, 0, matches[3]), (100, 0, None)):
+            replies = index.scatter('search_page', page, 'a', 0)
+            if page[0] is not None:
+                self.assertTrue(all(len(reply) <= page[0] + page[1] + 1
+                    for reply in replies))
+            merged = tornado.ioloop.IOLoop.current().run_sync(
+                lambda: shards.search(index, page, 'a', 0))
+            self.assertEqual(results.select_results(merged, *page),
+                results.select_results(matches, *page))
+
+    def testProcesses(self):
+        """
+        Make sure that shards in worker processes answer like local ones
+        """
+        index = shards.ShardedIndex(suffixarray.SuffixArray, 4, True)
+        try:
+            self.check(index)
+            self.assertRaises(AttributeError, index.scatter, 'missing')
+            self.assertEqual(index.search('cab', 0),
+                sorted(set(s for s in self.strings if 'cab' in s)))
+        finally:
+            index.close()
+
+    def testSearchDuringBuild(self):
+        """
+        Make sure that worker process shards answer searches, without
+        blocking the IOLoop, while a batch is being built
+        """
+        index = shards.ShardedIndex(SlowBuildSuffixArray, 2, True)
+        try:
+            index.add('Alabama')
+            build = threading.Thread(target=index.build_segment,
+                args=(['Arkansas', 'Ohio'],))
+            build.start()
+            time.sleep(0.2)
+            self.assertEqual(tornado.ioloop.IOLoop.current().run_sync(
+                lambda: shards.lookup(index, 'search', 'a', 0)), ['Alabama'])
+            self.assertTrue(build.is_alive())
+            build.join()
+        finally:
+            index.close()
+
+    def testContains(self):
+        """
+        Make sure that containment checks go to every shard
+        """
+        index = shards.ShardedIndex(search3.SubstringSetIndex, 16)
+        index.add('Alabama')
+        index.add('Arkansas')
+        self.assertTrue(index.contains('kan'))
+        self.assertFalse(index.contains('Ohio'))
+
+    def testCompletions(self):
+        """
+        Make sure that every shard's completions are combined
+        """
+        index = shards.ShardedIndex(suffixarray.SuffixArray, 4)
+        for string in set(self.strings):
+            index.add(string)
+        expected = suffixarray.SuffixArray.build(self.strings)
+        for prefix in ('a', 'cab'):
+            for limit in (1, 5, 20):
+                self.assertEqual(index.completions(prefix, limit),
+                    expected.completions(prefix, limit))
+
+    def testCompaction(self):
+        """
+        Make sure that deletes reach the right shard, and that compaction
+        clears every shard's tombstones
+        """
+        index = shards.ShardedIndex(suffixarray.SuffixArray, 4, True)
+        try:
+            self.check(index)
+            deleted = set(self.strings[::3])
+            for string in deleted:
+                index.delete(string)
+            remaining = set(self.strings) - deleted
+            expected = sorted(s for s in remaining if 'a' in s)
+            self.assertEqual(index.search('a', 0), expected)
+            tornado.ioloop.IOLoop.current().run_sync(
+                segments.Compactor(index).compact)
+            self.assertEqual(index.search('a', 0), expected)
+            self.assertEqual(sorted(index.iter_documents()),
+                sorted(remaining))
+            self.assertEqual(metrics.index_stats(index)['tombstones'], 0)
+        finally:
+            index.close()
+
+    def testSnapshot(self):
+        """
+        Make sure that a snapshot restores into a sharded index
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'index.snapshot')
+            snapshot.save(suffixarray.SuffixArray.build(self.strings), path)
+            index = shards.ShardedIndex(suffixarray.SuffixArray, 4)
+            snapshot.restore_index(index, path)
+            self.assertEqual(index.search('cab', 0),
+                sorted(set(s for s in self.strings if 'cab' in s)))
+        finally:
+            shutil.rmtree(directory)
+
+class testResponseCache(unittest.TestCase):
+    """
+    Tests for the response cache
+    """
+    def setUp(self):
+        self.cache = cache.ResponseCache(max_entries=2)
+
+    def testGeneration(self):
+        """
+        Make sure that entries from an older index generation are misses
+        """
+        self.cache.put('/search/a', 1, 'body')
+        self.assertEqual(self.cache.get('/search/a', 1), 'body')
+        self.assertEqual(self.cache.get('/search/a', 2), None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def testEviction(self):
+        """
+        Make sure that the least recently used entry is evicted first
+        """
+        self.cache.put('/search/a', 1, 'a')
+        self.cache.put('/search/b', 1, 'b')
+        self.cache.get('/search/a', 1)
+        self.cache.put('/search/c', 1, 'c')
+        self.assertEqual(self.cache.get('/search/b', 1), None)
+        self.assertEqual(self.cache.get('/search/a', 1), 'a')
+
+    def testTTL(self):
+        """
+        Make sure that entries expire after their TTL
+        """
+        self.cache.ttl = -1
+        self.cache.put('/search/a', 1, 'a')
+        self.assertEqual(self.cache.get('/search/a', 1), None)
+
+class testSnapshot(unittest.TestCase):
+    """
+    Tests for writing and memory-mapping suffix array snapshots
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'index.snapshot')
+        self.strings = [u'Alabama', u'Arkansas', u'Alaska', u'S\xe3o Paulo']
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRoundTrip(self):
+        """
+        Make sure that a mapped snapshot answers like the original
+        """
+        original = suffixarray.SuffixArray.build(self.strings)
+        snapshot.save(original, self.path)
+        mapped = snapshot.MappedSuffixArray(self.path)
+        self.assertEqual(list(mapped.array), list(original.array))
+        self.assertEqual(list(mapped.lcp), list(original.lcp))
+        self.assertEqual(list(mapped.documents), self.strings)
+        for query in ('a', 'Alam', 'Paulo', 'Banana'):
+            self.assertEqual(mapped.get_fuzzy_search_results(query),
+                original.get_fuzzy_search_results(query))
+        self.assertTrue(u'\xe3o' in mapped)
+        self.assertRaises(TypeError, mapped.insert, 'Ohio')
+
+    def testCompletionTable(self):
+        """
+        Make sure that popular prefixes are answered from the snapshot's
+        completion table, without counting their completions again
+        """
+        random.seed(17)
+        strings = [u''.join(random.choice(u'abc') for _ in range(5))
+            for _ in range(300)]
+        original = suffixarray.SuffixArray.build(strings)
+        snapshot.save(original, self.path)
+        mapped = snapshot.MappedSuffixArray(self.path)
+        self.assertEqual(sorted(mapped.completion_table),
+            sorted(original.completion_table))
+        self.assertTrue(u'ab' in mapped.completion_table)
+        mapped.array = None
+        self.assertEqual(mapped.completions(u'ab', 5),
+            original.completions(u'ab', 5))
+
+    def testVersionCheck(self):
+        """
+        Make sure that files from another format version are refused
+        """
+        snapshot.save(suffixarray.SuffixArray.build(self.strings), self.path)
+        with open(self.path, 'r+b') as snapshot_file:
+            snapshot_file.seek(8)
+            snapshot_file.write(struct.pack('<I', snapshot.VERSION + 1))
+        self.assertRaises(snapshot.SnapshotError,
+            snapshot.MappedSuffixArray, self.path)
+        with open(self.path, 'wb') as snapshot_file:
+            snapshot_file.write('not a snapshot, but long enough to be one')
+        self.assertRaises(snapshot.SnapshotError,
+            snapshot.MappedSuffixArray, self.path)
+
+    def testFailedWrite(self):
+        """
+        Make sure that a failed write leaves the old snapshot in place
+        """
+        snapshot.save(suffixarray.SuffixArray.build(self.strings), self.path)
+        broken = suffixarray.SuffixArray.build(['Ohio'])
+        broken.lcp = None
+        self.assertRaises(TypeError, snapshot.save, broken, self.path)
+        self.assertEqual(os.listdir(self.directory), ['index.snapshot'])
+        self.assertEqual(list(snapshot.MappedSuffixArray(self.path).documents),
+            self.strings)
+
+    def testRestoreIndex(self):
+        """
+        Make sure that snapshots restore into both suffix array backed and
+        rebuilt indexes
+        """
+        index = segments.SegmentedIndex(search1.SubstringIndex)
+        for string in self.strings:
+            index.add(string)
+        snapshot.save_index(index, self.path)
+        for factory in (search1.SuffixArrayIndex, search1.SubstringIndex):
+            restored = segments.SegmentedIndex(factory)
+            snapshot.restore_index(restored, self.path)
+            self.assertEqual(set(restored.search('Ala')),
+                set(['Alabama', 'Alaska']))
+            self.assertEqual(sorted(restored.iter_documents()),
+                sorted(self.strings))
+
+class testPrefork(unittest.TestCase):
+    """
+    Tests for publishing index generations to pre-forked workers
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = prefork.GenerationStore(self.directory)
+        self.writer = segments.SegmentedIndex(suffixarray.SuffixArray)
+        self.writer.add(u'Alabama')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testPublish(self):
+        """
+        Make sure that generations are numbered and old ones pruned
+        """
+        self.assertEqual(self.store.current(), None)
+        for number in (1, 2, 3):
+            self.assertEqual(self.store.publish(self.writer), number)
+        self.assertEqual(self.store.current(), (3, self.store.path(3)))
+        # Only the first generation wrote the unchanged live segment
+        self.assertEqual(sorted(name for name in os.listdir(self.directory)
+                if not name.startswith('.')),
+            ['CURRENT', 'generation-2.json', 'generation-3.json',
+                'segment-1-0.snapshot'])
+
+    def testPublishChanges(self):
+        """
+        Make sure that each generation only writes the segments that changed,
+        and that workers see its deletes and strays
+        """
+        self.store.publish(self.writer)
+        batch = [u'Alabama', u'Alaska', u'Arizona']
+        self.writer.publish(self.writer.build_segment(batch), batch)
+        self.assertEqual(self.store.publish(self.writer), 2)
+        self.writer.delete(u'Arizona')
+        self.store.publish(self.writer)
+        self.assertEqual(self.store.read(self.store.path(3))['segments'],
+            ['segment-1-0.snapshot', 'segment-2-1.snapshot'])
+        worker = segments.SegmentedIndex(suffixarray.SuffixArray)
+        prefork.Watcher(worker, self.store).check()
+        self.assertEqual(worker.search(u'A', 0),
+            set([u'Alabama', u'Alaska']))
+        self.assertEqual(worker.completions(u'Ala', 5),
+            [(u'Alabama', 1), (u'Alaska', 1)])
+        self.assertEqual(worker.document_count(), 2)
+
+        self.writer.add(u'Arkansas')
+        compaction = self.writer.begin_compaction()
+        self.writer.finish_compaction(compaction,
+            self.writer.build_compaction(compaction))
+        self.store.publish(self.writer)
+        self.store.publish(self.writer)
+        # The grown live segment and the compacted batch are new, and the
+        # segments only older generations held are gone with them
+        self.assertEqual(sorted(name for name in os.listdir(self.directory)
+                if name.endswith('.snapshot')),
+            ['segment-4-0.snapshot', 'segment-4-1.snapshot'])
+        # A restarted writer carries on from the segments on disk
+        restarted = segments.SegmentedIndex(suffixarray.SuffixArray)
+        self.store.restore(restarted)
+        restarted.add(u'Ohio')
+        self.assertEqual(self.store.publish(restarted), 6)
+        self.assertEqual(self.store.read(self.store.path(6))['segments'],
+            ['segment-6-0.snapshot', 'segment-4-0.snapshot',
+                'segment-4-1.snapshot'])
+
+    def testWatcher(self):
+        """
+        Make sure that workers swap in each new generation once
+        """
+        worker = segments.SegmentedIndex(suffixarray.SuffixArray)
+        watcher = prefork.Watcher(worker, self.store)
+        watcher.check()
+        self.assertEqual(worker.search(u'Alab', 0), set())
+
+        self.store.publish(self.writer)
+        watcher.check()
+        self.assertEqual(worker.search(u'Alab', 0), set([u'Alabama']))
+        generation = worker.generation
+        watcher.check()
+        self.assertEqual(worker.generation, generation)
+
+        self.writer.add(u'Alaska')
+        self.store.publish(self.writer)
+        mapped = watcher.mapped
+        watcher.check()
+        self.assertEqual(worker.search(u'Alas', 0), set([u'Alaska']))
+        # The grown live segment is mapped again, behind an empty live one
+        self.assertEqual(len(worker.segments), 2)
+        self.assertFalse(set(mapped) & set(watcher.mapped))
+        self.assertTrue(worker.generation > generation)
+
+class TestSearch2SuffixArrayWorker(tornado.testing.AsyncHTTPTestCase):
+    """
+    Test a pre-forked worker of the suffix array search application
+    """
+    def get_app(self):
+        return search2_suffixarray.make_application(
+            segments.SegmentedIndex(suffixarray.SuffixArray),
+            writer_url='http://127.0.0.1:8889')
+
+    def testAddRedirects(self):
+        """
+        Make sure that adds are sent on to the writer
+        """
+        for path in ('/add', '/add/batch'):
+            x = self.fetch(path, method='POST', body='string=Ohio',
+                follow_redirects=False)
+            self.assertEqual(x.code, 307)
+            self.assertEqual(x.headers['Location'],
+                'http://127.0.0.1:8889' + path)
+
+class TestPreforkDelete(tornado.testing.AsyncHTTPTestCase):
+    """
+    Test deleting through the writer of a pre-forked suffix array search
+    application, while a worker serves searches
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        store = prefork.GenerationStore(self.directory)
+        self.writer = segments.SegmentedIndex(suffixarray.SuffixArray)
+        self.writer.add(u'Alabama')
+        self.writer.add(u'Alaska')
+        self.publisher = prefork.Publisher(self.writer, store)
+        worker = segments.SegmentedIndex(suffixarray.SuffixArray)
+        self.watcher = prefork.Watcher(worker, store)
+        self.worker = prefork.WatchingRouter(
+            search2_suffixarray.make_application(worker,
+                writer_url='http://127.0.0.1:8889'), self.watcher)
+        super(TestPreforkDelete, self).setUp()
+        socket, self.worker_port = tornado.testing.bind_unused_port()
+        self.worker_server = tornado.httpserver.HTTPServer(self.worker)
+        self.worker_server.add_socket(socket)
+
+    def tearDown(self):
+        self.worker_server.stop()
+        super(TestPreforkDelete, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def get_app(self):
+        return search2_suffixarray.make_application(self.writer,
+            publisher=self.publisher)
+
+    def search(self, substring):
+        self.http_client.fetch('http://127.0.0.1:%d/search/%s?max_edits=0' %
+            (self.worker_port, substring), self.stop)
+        return json.loads(self.wait().body)['results']
+
+    def testDelete(self):
+        """
+        Make sure that a worker's next search after a delete (or an update)
+        is answered leaves the deleted string out, without waiting for the
+        next periodic publish
+        """
+        self.assertEqual(self.search('Ala'), [])
+        self.assertEqual(self.fetch('/delete', method='POST',
+            body='string=Alaska').code, 200)
+        self.assertEqual(self.search('Ala'), ['Alabama'])
+        self.assertEqual(self.fetch('/update', method='POST',
+            body='old=Alabama&new=Arkansas').code, 200)
+        self.assertEqual(self.search('Ala'), [])
+        self.assertEqual(self.search('Ark'), ['Arkansas'])
+        # Nothing changed since, so nothing more is published
+        generation = self.watcher.loaded
+        self.io_loop.run_sync(self.publisher.check)
+        self.assertEqual(self.watcher.loaded, generation)
+
+class testMetrics(unittest.TestCase):
+    """
+    Tests for request timings and index sizes
+    """
+    def testRender(self):
+        """
+        Make sure that histograms are cumulative and gauges are reported
+        """
+        index = segments.SegmentedIndex(suffixarray.SuffixArray)
+        index.add(u'Ohio')
+        registry = metrics.Metrics(index)
+        registry.observe('SearchHandler', 'lookup', 0.002)
+        registry.observe('SearchHandler', 'lookup', 2)
+        text = registry.render()
+        for line in ('search_phase_seconds_bucket{handler="SearchHandler",'
+                    'phase="lookup",le="0.001"} 0',
+                'search_phase_seconds_bucket{handler="SearchHandler",'
+                    'phase="lookup",le="0.005"} 1',
+                'search_phase_seconds_bucket{handler="SearchHandler",'
+                    'phase="lookup",le="+Inf"} 2',
+                'search_index_documents 1', 'search_index_suffixes 4',
+                'search_index_bytes 56'):
+            self.assertIn(line + '\n', text)
+
+    def testIndexStats(self):
+        """
+        Make sure that each kind of index reports its size
+        """
+        index = segments.SegmentedIndex(search1.SubstringIndex)
+        index.add('Ohio')
+        self.assertEqual(metrics.index_stats(index)['keys'], 10)
+        # Deleted and duplicate strings are entries, not documents
+        index.add('Iowa')
+        index.publish(index.build_segment(['Ohio']), ['Ohio'])
+        index.delete('Iowa')
+        stats = metrics.index_stats(index)
+        self.assertEqual(stats['documents'], 1)
+        self.assertEqual(stats['entries'], 3)
+        # The count holds through compaction, and re-adding after it
+        while index.compaction is not None or index.tombstones:
+            compaction = index.begin_compaction()
+            index.finish_compaction(compaction,
+                index.build_compaction(compaction))
+        index.add('Iowa')
+        self.assertEqual(metrics.index_stats(index)['documents'], 2)
+        self.assertEqual(index.document_count(),
+            len(set(index.iter_documents())))
+        index = shards.ShardedIndex(search1.TrigramIndex, 4)
+        index.add('Ohio')
+        index.add('Kentucky')
+        stats = metrics.index_stats(index)
+        self.assertEqual(stats['documents'], 2)
+        self.assertEqual(stats['keys'], 8)
+        self.assertEqual(tornado.ioloop.IOLoop.current().run_sync(
+            lambda: metrics.gather_index_stats(index)), stats)
+
+    def testProfiler(self):
+        """
+        Make sure that the stacks of slow requests are written out collapsed
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'stacks.folded')
+            profiler = metrics.Profiler(path, threshold=1)
+            profiler.start(self)
+            profiler.sample(sys._getframe())
+            profiler.finish(self, 0.5)
+            self.assertFalse(os.path.exists(path))
+            profiler.start(self)
+            profiler.sample(sys._getframe())
+            profiler.sample(sys._getframe())
+            profiler.finish(self, 2)
+            with open(path) as stacks:
+                stack, count = stacks.read().rsplit(' ', 1)
+            self.assertTrue(stack.endswith(';testProfiler (test.py:%d)' %
+                self.testProfiler.im_func.func_code.co_firstlineno))
+            self.assertEqual(count, '2\n')
+        finally:
+            shutil.rmtree(directory)
+
+class testLoadTest(unittest.TestCase):
+    """
+    Tests for the load testing harness
+    """
+    def testPercentile(self):
+        """
+        Make sure that percentiles are taken by nearest rank
+        """
+        latencies = range(1, 101)
+        self.assertEqual(loadtest.percentile(latencies, 50), 50)
+        self.assertEqual(loadtest.percentile(latencies, 99), 99)
+        self.assertEqual(loadtest.percentile([7], 95), 7)
+
+    def testRun(self):
+        """
+        Make sure that a short run reports every measurement
+        """
+        corpus = ['Ohio', 'Kentucky', 'Wyoming'] * 10
+        report = loadtest.run('search1:trigrams', corpus, 20, concurrency=4)
+        self.assertEqual(report['documents'], 30)
+        self.assertEqual(report['ingest_failures'], 0)
+        self.assertEqual(report['searches'], 20)
+        self.assertEqual(sorted(report['latency_ms']), ['p50', 'p95', 'p99'])
+
+class testResults(unittest.TestCase):
+    """
+    Tests for selecting pages of search results
+    """
+    def testSelectResults(self):
+        """
+        Make sure that pages come from the sorted results
+        """
+        matches = set(['d', 'b', 'a', 'e', 'c'])
+        self.assertEqual(results.select_results(matches),
+            (['a', 'b', 'c', 'd', 'e'], False))
+        self.assertEqual(results.select_results(matches, 2),
+            (['a', 'b'], True))
+        self.assertEqual(results.select_results(matches, 2, 3),
+            (['d', 'e'], False))
+        self.assertEqual(results.select_results(matches, 2, after='b'),
+            (['c', 'd'], True))
+
+    def testIntArgument(self):
+        """
+        Make sure that out of range arguments are refused in plain words
+        """
+        class Handler(object):
+            def get_argument(self, name, default=None):
+                return {'limit': '0', 'offset': '-1'}.get(name, default)
+        for name, minimum, message in (
+                ('limit', 1, "limit must be a positive integer"),
+                ('offset', 0, "offset must be a non-negative integer")):
+            with self.assertRaises(tornado.web.HTTPError) as context:
+                results.int_argument(Handler(), name, minimum=minimum)
+            self.assertEqual(context.exception.log_message, message)
+
+    def testIterSorted(self):
+        """
+        Make sure that lazily sorted results come out in order
+        """
+        self.assertEqual(list(results.iter_sorted(['c', 'a', 'b'])),
+            ['a', 'b', 'c'])
+
+class TestSearch3SuffixArray(TestSearch3):
+    """
+    Test extension 3 of our search application, using the suffix array index
+    """
+    def get_app(self):
+        return search3.make_application(
+            segments.SegmentedIndex(search3.SuffixArrayIndex))
+
 class testSuffixArray(unittest.TestCase):
     """
     Tests for the the Suffix Array data structure.
@@ -205,21 +1516,116 @@ class testSuffixArray(unittest.TestCase):
         """
         self.suffix_array = suffixarray.SuffixArray()
 
+    def suffixes(self):
+        """
+        Materialize every suffix in the array, in order
+        """
+        return [self.suffix_array.suffix(i)
+            for i in range(len(self.suffix_array))]
+
     def testInsert(self):
         """
         Make sure that our suffix array is being properly sorted after 
         insertion
         """
         self.suffix_array.insert('Alabama')
-        self.assertEquals(self.suffix_array.array, ['Alabama', 'a', 'abama', 'ama', 'bama', 'labama', 'ma'])
+        self.assertEquals(self.suffixes(), ['Alabama', 'a', 'abama', 'ama', 'bama', 'labama', 'ma'])
+
+    def testInsertMerges(self):
+        """
+        Make sure that a second insertion is merged into the existing order
+        rather than appended to it
+        """
+        self.suffix_array.insert('Alabama')
+        self.suffix_array.insert('Arkansas')
+        expected = sorted([s[i:] for s in ('Alabama', 'Arkansas')
+            for i in range(len(s))])
+        self.assertEquals(self.suffixes(), expected)
+
+    def testInsertDuplicate(self):
+        """
+        Make sure that inserting the same string twice doesn't index it twice
+        """
+        self.suffix_array.insert('Alabama')
+        self.suffix_array.insert('Alabama')
+        self.assertEquals(len(self.suffix_array), len('Alabama'))
+        self.assertEquals(self.suffix_array.documents, ['Alabama'])
+
+    def testDocumentAt(self):
+        """
+        Make sure that text offsets map back to the document they fall in
+        """
+        self.suffix_array.insert('Alabama')
+        self.suffix_array.insert('Arkansas')
+        self.assertEquals(self.suffix_array.document_at(0), 'Alabama')
+        self.assertEquals(self.suffix_array.document_at(6), 'Alabama')
+        self.assertEquals(self.suffix_array.document_at(8), 'Arkansas')
+
+    def testBuild(self):
+        """
+        Make sure that a bulk build produces the same order as inserting one
+        string at a time
+        """
+        strings = ['Alabama', 'Arkansas', 'Alaska', 'banana', 'ananas']
+        for string in strings:
+            self.suffix_array.insert(string)
+        built = suffixarray.SuffixArray.build(strings)
+        self.assertEquals(self.suffixes(),
+            [built.suffix(i) for i in range(len(built))])
+
+    def testLCP(self):
+        """
+        Make sure that the LCP array is kept up to date by both insertion and
+        bulk builds
+        """
+        strings = ['Alabama', 'Arkansas', 'Alaska', 'banana', 'ananas']
+        for string in strings:
+            self.suffix_array.insert(string)
+        built = suffixarray.SuffixArray.build(strings)
+        for suffix_array in (self.suffix_array, built):
+            suffixes = [suffix_array.suffix(i)
+                for i in range(len(suffix_array))]
+            expected = [0] + [len(os.path.commonprefix(pair))
+                for pair in zip(suffixes, suffixes[1:])]
+            self.assertEquals(list(suffix_array.lcp), expected)
 
     def test_FuzzySearch(self):
         """
-        Test a search of 'alam' on the hidden _fuzzy_search method
+        Test a search of 'aban' on the hidden _fuzzy_search method
+        """
+        self.suffix_array.insert('Alabama')
+        self.assertEquals(['abama'],
+                [self.suffix_array.suffix_at(offset)
+                    for offset in self.suffix_array._fuzzy_search('aban')])
+
+    def test_FuzzySearchMaxEdits(self):
+        """
+        Make sure that max_edits bounds how far a match may be from the query
         """
         self.suffix_array.insert('Alabama')
-        self.assertEquals(['abama', 'labama'], 
-                self.suffix_array._fuzzy_search('aban'))
+        self.suffix_array.insert('Arkansas')
+        self.assertEquals(set(['Alabama']),
+                self.suffix_array.get_fuzzy_search_results('Alabama', 0))
+        self.assertEquals(set(),
+                self.suffix_array.get_fuzzy_search_results('Alxbxma', 1))
+        self.assertEquals(set(['Alabama']),
+                self.suffix_array.get_fuzzy_search_results('Alxbxma', 2))
+        self.assertEquals(set(['Arkansas']),
+                self.suffix_array.get_fuzzy_search_results('Arkanas', 1))
+
+    def test_FuzzySearchEmpty(self):
+        """
+        Make sure that searching an empty suffix array finds nothing
+        """
+        self.assertEquals([], self.suffix_array._fuzzy_search('aban'))
+
+    def test_FuzzySearchLongQuery(self):
+        """
+        Make sure that a very long query doesn't blow the stack
+        """
+        self.suffix_array.insert('Alabama' * 200)
+        self.assertEquals(set(['Alabama' * 200]),
+                self.suffix_array.get_fuzzy_search_results('Alabama' * 150))
 
     def test_FuzzySearchResults(self):
         """
@@ -229,5 +1635,140 @@ class testSuffixArray(unittest.TestCase):
         self.assertEquals(set(['Alabama']), 
                 self.suffix_array.get_fuzzy_search_results('aban'))
 
+    def testCompletions(self):
+        """
+        Make sure that completions are ranked by how often they occur, then
+        alphabetically
+        """
+        for string in ('New York', 'York', 'Yorkshire', 'Kentucky'):
+            self.suffix_array.insert(string)
+        self.assertEqual(self.suffix_array.completions('Yor'),
+            [('York', 2), ('Yorkshire', 1)])
+        self.assertEqual(self.suffix_array.completions('k', 2),
+            [('k', 2), ('kshire', 1)])
+        self.assertEqual(self.suffix_array.completions('Ohio'), [])
+
+    def testCompletionTable(self):
+        """
+        Make sure that popular prefixes are answered from the table, until
+        a document containing them is inserted
+        """
+        popular = suffixarray.POPULAR_SUFFIXES
+        suffixarray.POPULAR_SUFFIXES = 1
+        try:
+            self.suffix_array.insert('Alabama')
+            self.assertEqual(self.suffix_array.completions('ba'),
+                [('bama', 1)])
+            self.assertEqual(self.suffix_array.completions('a', 1),
+                [('a', 1)])
+            self.assertEqual(sorted(self.suffix_array.completion_table),
+                ['a'])
+            self.suffix_array.insert('Ohio')
+            self.assertEqual(sorted(self.suffix_array.completion_table),
+                ['a'])
+            self.suffix_array.insert('Kansas')
+            self.assertEqual(self.suffix_array.completion_table, {})
+            self.assertEqual(self.suffix_array.completions('a', 2),
+                [('a', 1), ('abama', 1)])
+        finally:
+            suffixarray.POPULAR_SUFFIXES = popular
+
+    def testBuiltCompletionTable(self):
+        """
+        Make sure that bulk builds fill the table for short popular prefixes
+        with the same completions that would be counted on demand
+        """
+        strings = ['Alabama', 'Alaska', 'Arkansas', 'Kansas', 'Kentucky']
+        popular = suffixarray.POPULAR_SUFFIXES
+        suffixarray.POPULAR_SUFFIXES = 2
+        try:
+            built = suffixarray.SuffixArray.build(strings)
+        finally:
+            suffixarray.POPULAR_SUFFIXES = popular
+        self.assertEqual(sorted(built.completion_table),
+            ['A', 'a', 'as', 'k', 'n', 's'])
+        for string in strings:
+            self.suffix_array.insert(string)
+        for prefix, completions in built.completion_table.items():
+            self.assertEqual(completions,
+                self.suffix_array.completions(prefix, 100))
+
+class testSuffixAutomaton(unittest.TestCase):
+    """
+    Tests for the generalized suffix automaton data structure.
+    """
+    def setUp(self):
+        """
+        Initialize our suffix automaton
+        """
+        self.automaton = suffixautomaton.SuffixAutomaton()
+
+    def testContains(self):
+        """
+        Make sure that every substring, and nothing else, is found
+        """
+        for string in ('Alabama', 'Arkansas'):
+            self.automaton.insert(string)
+        for string in ('Alabama', 'Arkansas'):
+            for i in range(len(string)):
+                for j in range(i + 1, len(string) + 1):
+                    self.assertTrue(string[i:j] in self.automaton)
+        self.assertFalse('Banana' in self.automaton)
+        self.assertFalse('amaA' in self.automaton)
+
+    def testDocumentsContaining(self):
+        """
+        Make sure that substring queries return each containing string once
+        """
+        for string in ('Alabama', 'Arkansas', 'Alaska', 'Alabama'):
+            self.automaton.insert(string)
+        self.assertEqual(sorted(self.automaton.documents_containing('a')),
+            ['Alabama', 'Alaska', 'Arkansas'])
+        self.assertEqual(self.automaton.documents_containing('las'),
+            ['Alaska'])
+        self.assertEqual(self.automaton.documents_containing('Banana'), [])
+
+    def testLinearSize(self):
+        """
+        Make sure that the automaton stays linear in the input size
+        """
+        strings = ['Alabama', 'Arkansas', 'Alaska', 'banana', 'ananas']
+        for string in strings:
+            self.automaton.insert(string)
+        self.assertTrue(len(self.automaton) <=
+            2 * sum(len(string) for string in strings))
+
+    def testLinearDocuments(self):
+        """
+        Make sure that the documents are recorded once per character, even
+        for strings sharing every substring, and are still all found
+        """
+        string = ''.join(chr(ord('a') + position % 7)
+            for position in range(200))
+        strings = [string[i:] + string[:i] for i in range(len(string))]
+        for rotation in strings:
+            self.automaton.insert(rotation)
+        self.assertEqual(sum(len(document_ids)
+            for document_ids in self.automaton.terminals), len(string) ** 2)
+        self.assertEqual(len(self.automaton.documents_containing('abc')),
+            len(set(strings)))
+
+    def testDocumentsMatchBruteForce(self):
+        """
+        Make sure that substring queries find exactly the strings holding
+        the substring, as clones move states around the link tree
+        """
+        generator = random.Random(0)
+        strings = [''.join(generator.choice('abc') for _ in
+            range(generator.randint(1, 12))) for _ in range(60)]
+        for string in strings:
+            self.automaton.insert(string)
+        for _ in range(300):
+            query = ''.join(generator.choice('abc') for _ in
+                range(generator.randint(1, 5)))
+            self.assertEqual(
+                sorted(self.automaton.documents_containing(query)),
+                sorted(set(string for string in strings if query in string)))
+
 if __name__ == "__main__":
     unittest.main()
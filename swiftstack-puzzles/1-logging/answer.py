@@ -8,17 +8,63 @@ following usage methods will work.
 USAGE:
     cat sample_record_file | python answer.py
     python answer.py sample_record_file
+    python answer.py sample_record_file another_sample_record_file ...
 """
 
+import bisect
+import collections
 import fileinput
 import heapq
+import itertools
+import operator
+import re
 import sys
+import tempfile
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Bytes read (or, from an iterable of lines, lines gathered) at a time by a
+# BlockEventStream
+BLOCK_SIZE = 1 << 20
+BLOCK_LINES = 1 << 14
+
+# Bytes of attacks a SpillingEventStream holds in memory before spilling them
+# to a run on disk, the bytes it reads or writes of each run at a time, and
+# the most runs it merges at once
+BUFFER_BYTES = 1 << 26
+RUN_BUFFER = 1 << 16
+MERGE_FAN_IN = 64
+
+# Separates a record's attack time from its city
+SEPARATOR = '   '
+# Finds a line holding the separator more than once
+REPEATED_SEPARATOR = re.compile(re.escape(SEPARATOR) + '[^\n]*' +
+    re.escape(SEPARATOR))
+# The same formatting as EventStream.format_attack, applied by the % operator
+ATTACK_FORMAT = '%10.6f' + SEPARATOR + '%s'
+# Runs on disk hold attack times exactly, as repr does
+RUN_FORMAT = '%r' + SEPARATOR + '%s\n'
+# Roughly the bytes a buffered attack takes besides its city's characters:
+# the tuple, the float, the empty string and the list's pointer to the tuple
+ATTACK_OVERHEAD = sys.getsizeof((0.0, '')) + sys.getsizeof(0.0) + \
+    sys.getsizeof('') + 8
 
 class EventStream(object):
     """
     A class for managing an un-sorted stream of events. Functions by holding events
-    in memory until an event comes in that is newer than the oldest event, at which 
-    point it emits the oldest events until the window has been closed again.
+    in a heap, and keeping a low watermark: the newest attack time seen, less the
+    window. No event still to come can be older than the watermark, so whenever it
+    moves every event below it is emitted, in one batch.
+
+    Only the events inside the window are ever held, however far the stream runs.
+    An event that turns up below the watermark anyway (say, after a spike of
+    events from the future) can't be put back in order, so it's emitted as soon
+    as possible and counted in late_events.
 
     Args:
         input_stream:   the target file or stream iterable that unsorted 
@@ -28,10 +74,14 @@ class EventStream(object):
     """
     def __init__(self, input_stream, window=300):
         self.attack_heap = []
-        self.oldest_attack = None
-        self.latest_record = None
-        self.input_stream = input_stream
+        # Attacks below the watermark, in order, waiting to be emitted
+        self.ready = collections.deque()
+        self.latest_attack = None
+        self.input_stream = iter(input_stream)
         self.window = window
+        self.late_events = 0
+        # The most attacks held at once, for keeping an eye on memory use
+        self.peak_buffered = 0
 
     @staticmethod
     def parse_event(record):
@@ -39,31 +89,62 @@ class EventStream(object):
         Parses a record and returns a tuple (attack_time, city), with 
         attack_time as a float and city as a string
         """
-        attack_time, city = record.strip().split('   ', 1)
+        attack_time, city = record.strip().split(SEPARATOR, 1)
         attack_time = float(attack_time)
         return attack_time, city
 
-    def emit_oldest_attack(self):
+    @staticmethod
+    def format_attack(attack):
         """
-        Formats an attack record from the heap as a string for printing.
+        Formats an attack (attack_time, city) as a string for printing.
         """
-        record = heapq.heappop(self.attack_heap)
         # Format our floats so that Python doesn't truncate them
-        record = ("{:10.6f}".format(record[0]), record[1])
-        record = '   '.join([str(x) for x in record])
-        return record
+        return "{:10.6f}".format(attack[0]) + SEPARATOR + attack[1]
+
+    def flush(self, watermark=None):
+        """
+        Moves every attack older than the watermark (or every attack, without
+        one) from the heap to the ready queue.
+        """
+        self.peak_buffered = max(self.peak_buffered, len(self.attack_heap))
+        heap = self.attack_heap
+        while heap and (watermark is None or heap[0][0] < watermark):
+            self.ready.append(heapq.heappop(heap))
 
-    def update_oldest_attack(self, current_record_time):
+    def fill(self):
         """
-        Checks to make sure our current record isn't older than our oldest 
-        known attack time.
+        Reads records until the watermark moves past the oldest attack held,
+        or the input stream runs out, then flushes.
         """
-        if not self.oldest_attack or current_record_time < self.oldest_attack:
-            self.oldest_attack = current_record_time
+        heap = self.attack_heap
+        for record in self.input_stream:
+            attack = self.parse_event(record)
+            heapq.heappush(heap, attack)
+            if self.latest_attack is None or attack[0] > self.latest_attack:
+                self.latest_attack = attack[0]
+            elif attack[0] < self.latest_attack - self.window:
+                self.late_events += 1
+            if heap[0][0] < self.latest_attack - self.window:
+                self.flush(self.latest_attack - self.window)
+                return
+        self.input_stream = None
+        self.flush()
 
     def __iter__(self):
         return self
 
+    def iter_attacks(self):
+        """
+        Yields the attacks themselves, as (attack_time, city) tuples, in the
+        order next would emit them
+        """
+        while True:
+            while self.ready:
+                yield self.ready.popleft()
+            if self.input_stream is None:
+                return
+            self.fill()
+
     def next(self):
         """
         Emit the oldest record by attack time in the input stream.
@@ -72,30 +153,416 @@ class EventStream(object):
         recent than our uncertainty window has been observed, or when we've
         reached the end of our input stream.
         """
-        if self.input_stream:
-            if len(self.attack_heap) == 0:
-                self.oldest_attack = None
+        while not self.ready:
+            if self.input_stream is None:
+                raise StopIteration
+            self.fill()
+        return self.format_attack(self.ready.popleft())
+
+def read_blocks(input_stream, block_size=BLOCK_SIZE):
+    """
+    Yields blocks of whole records from a file (read block_size bytes at a
+    time, with any partial last line held over for the next block) or from
+    any other iterable of lines.
+    """
+    if not hasattr(input_stream, 'read'):
+        lines = iter(input_stream)
+        while True:
+            block = ''.join(itertools.islice(lines, BLOCK_LINES))
+            if not block:
+                return
+            yield block
+    remainder = ''
+    while True:
+        data = input_stream.read(block_size)
+        if not data:
+            break
+        data = remainder + data
+        end = data.rfind('\n') + 1
+        remainder = data[end:]
+        if end:
+            yield data[:end]
+    if remainder:
+        yield remainder
+
+def parse_block(block):
+    """
+    Parses every record in a block, returning an array of attack times (a
+    NumPy float64 array if NumPy is installed) and a list of cities.
+
+    If every line holds one separator and nothing that would be stripped,
+    the whole block is split into fields at once, and the times converted
+    at once; that's nearly every block in practice. Anything else is parsed
+    a line at a time, skipping blank lines, as is a block whose times don't
+    all convert, so that a malformed record raises just as it would from
+    EventStream.
+    """
+    lines = block.count('\n') + (not block.endswith('\n'))
+    # As many separators as lines, and none repeated on a line, means every
+    # line holds exactly one
+    if block.count(SEPARATOR) == lines and not block.endswith(' ') and \
+            not any(odd in block for odd in (' \n', '\t', '\r')) and \
+            not REPEATED_SEPARATOR.search(block):
+        fields = block.replace('\n', SEPARATOR).split(SEPARATOR)
+        times, cities = fields[0:2 * lines:2], fields[1:2 * lines:2]
+        if numpy is not None and len(times) == len(cities) == lines:
+            # fromstring stops quietly at the first time it can't convert
+            times_array = numpy.fromstring(' '.join(times), sep=' ')
+            if len(times_array) == lines:
+                return times_array, cities
+        elif len(times) == len(cities) == lines:
+            return array('d', map(float, times)), cities
+    records = [EventStream.parse_event(line)
+        for line in block.splitlines() if line.strip()]
+    times = [attack_time for attack_time, _ in records]
+    cities = [city for _, city in records]
+    if numpy is not None:
+        return numpy.array(times, dtype=numpy.float64), cities
+    return array('d', times), cities
+
+class BlockEventStream(EventStream):
+    """
+    An EventStream that reads its input in blocks and parses each block's
+    records in bulk (see parse_block), rather than one line at a time. Its
+    events come out exactly as an EventStream's would, save that late events
+    are only emitted once their block has been read, in order among it.
+
+    Args:
+        block_size:     the number of bytes to read at a time, for files
+    """
+    def __init__(self, input_stream, window=300, block_size=BLOCK_SIZE):
+        super(BlockEventStream, self).__init__(input_stream, window)
+        self.blocks = read_blocks(input_stream, block_size)
+
+    def fill(self):
+        """
+        Reads blocks until the watermark moves past the oldest attack held,
+        or the input stream runs out, then flushes.
+        """
+        heap = self.attack_heap
+        for block in self.blocks:
+            times, cities = parse_block(block)
+            latest = self.latest_attack
+            for attack in itertools.izip(times.tolist(), cities):
+                heapq.heappush(heap, attack)
+                if latest is None or attack[0] > latest:
+                    latest = attack[0]
+                elif attack[0] < latest - self.window:
+                    self.late_events += 1
+            self.latest_attack = latest
+            if heap and heap[0][0] < latest - self.window:
+                self.flush(latest - self.window)
+                return
+        self.input_stream = None
+        self.flush()
+
+def sort_block(times, cities):
+    """
+    Returns a block's attacks as (attack_time, city) tuples sorted just as
+    a heap of them would pop them. With NumPy, the order is found by
+    argsorting the times (with the cities breaking ties) instead.
+    """
+    if numpy is not None and len(times) > 1:
+        order = numpy.lexsort((numpy.array(cities), times))
+        return zip(times[order].tolist(),
+            operator.itemgetter(*order.tolist())(cities))
+    attacks = zip(times.tolist(), cities)
+    attacks.sort()
+    return attacks
+
+class SortedBlockEventStream(BlockEventStream):
+    """
+    A BlockEventStream that reorders a block at a time rather than an event
+    at a time. Each block is sorted (see sort_block) and cut into fixed time
+    buckets, each a list of sorted slices. Once the watermark passes the end
+    of a bucket, its slices are merged by a single sort onto the ready
+    queue, so every event is sorted twice at most, whatever the window.
+    Attacks are formatted as they're taken, with the % operator, so
+    iter_attacks yields them as tuples like an EventStream's.
+
+    Without late events, its events come out exactly as an EventStream's
+    would. Events that arrive in a bucket that has already been emitted
+    count as late.
+
+    Args:
+        bucket_size:    the number of seconds each bucket spans; events are
+                        emitted up to this much later than an EventStream
+                        would emit them, and held for this much longer
+    """
+    def __init__(self, input_stream, window=300, block_size=BLOCK_SIZE,
+            bucket_size=None):
+        super(SortedBlockEventStream, self).__init__(input_stream, window,
+            block_size)
+        self.bucket_size = bucket_size or window / 10.0
+        self.buckets = {}
+        # The end of the newest bucket emitted so far
+        self.emitted_until = None
+        self.events = itertools.imap(ATTACK_FORMAT.__mod__,
+            self.iter_attacks())
+
+    def bucket(self, attack_time):
+        """
+        Returns the number of the bucket holding attack_time: the bucket
+        from number * bucket_size up to (number + 1) * bucket_size
+        """
+        number = int(attack_time // self.bucket_size)
+        # Rounding can leave the division one out either way
+        while (number + 1) * self.bucket_size <= attack_time:
+            number += 1
+        while number * self.bucket_size > attack_time:
+            number -= 1
+        return number
+
+    def fill(self):
+        """
+        Reads blocks until the watermark passes the end of a bucket, or the
+        input stream runs out, then emits every bucket behind it.
+        """
+        for block in self.blocks:
+            times, cities = parse_block(block)
+            if not len(times):
+                continue
+            attacks = sort_block(times, cities)
+            if self.emitted_until is not None:
+                self.late_events += bisect.bisect_left(attacks,
+                    (self.emitted_until,))
+            start = 0
+            while start < len(attacks):
+                number = self.bucket(attacks[start][0])
+                end = bisect.bisect_left(attacks,
+                    ((number + 1) * self.bucket_size,), start)
+                self.buckets.setdefault(number, []).extend(
+                    attacks[start:end])
+                start = end
+            self.latest_attack = max(self.latest_attack, attacks[-1][0])
+            self.peak_buffered = max(self.peak_buffered,
+                sum(len(bucket) for bucket in self.buckets.itervalues()))
+            if self.emit(self.latest_attack - self.window):
+                return
+        self.input_stream = None
+        self.emit()
 
-            while (not self.oldest_attack) or \
-                    (self.latest_record - self.oldest_attack < self.window):
-                try:
-                    record = self.input_stream.next()
-                    attack_time, city = record.strip().split('   ', 1)
-                    attack_time, city = self.parse_event(record)
-                except StopIteration:
-                    self.input_stream = None
-                    break
-                heapq.heappush(self.attack_heap, (attack_time, city))
-                self.update_oldest_attack(attack_time)
-                self.latest_record = attack_time
+    def emit(self, watermark=None):
+        """
+        Sorts every bucket that ends at or below the watermark
+        (or every bucket, without one) onto the ready queue. Returns whether
+        there were any.
+        """
+        numbers = sorted(number for number in self.buckets if watermark is
+            None or (number + 1) * self.bucket_size <= watermark)
+        for number in numbers:
+            bucket = self.buckets.pop(number)
+            # Timsort merges the bucket's sorted slices
+            bucket.sort()
+            self.ready.extend(bucket)
+            self.emitted_until = max(self.emitted_until,
+                (number + 1) * self.bucket_size)
+        return bool(numbers)
 
-            return self.emit_oldest_attack()
+    def next(self):
+        return next(self.events)
 
-        elif len(self.attack_heap) > 0:
-            return self.emit_oldest_attack()
+class Run(object):
+    """
+    Sorted attacks spilled to a temporary file, read back a buffered read at
+    a time. head is the next attack still to be taken, and size the number
+    of them (head included); once the last is taken, the file is closed, and
+    so deleted.
 
-        else:
-            raise StopIteration
+    Args:
+        level:  how many merges the run's attacks have been through
+    """
+    def __init__(self, attacks, level=0):
+        self.level = level
+        self.file = tempfile.TemporaryFile(bufsize=RUN_BUFFER)
+        # izip stops at the last attack without taking another count, so
+        # the next count is the number of attacks written
+        counter = itertools.count()
+        self.file.writelines(RUN_FORMAT % attack
+            for attack, _ in itertools.izip(attacks, counter))
+        self.size = next(counter)
+        self.file.seek(0)
+        self.attacks = itertools.imap(EventStream.parse_event, self.file)
+        self.head = next(self.attacks, None)
+
+    def take(self):
+        """
+        Returns the head, moving on to the next attack
+        """
+        attack = self.head
+        self.head = next(self.attacks, None)
+        self.size -= 1
+        if self.head is None:
+            self.file.close()
+        return attack
+
+    def __iter__(self):
+        while self.head is not None:
+            yield self.take()
+
+class SpillingEventStream(object):
+    """
+    Reorders an event stream with no bound on its disorder, such as replays
+    of data hours late. Attacks are held in memory until they take up more
+    than buffer_bytes, then sorted and spilled to a temporary file as a run.
+    Once the input runs out, the runs are merged with heapq.merge, a
+    buffered read at a time, so memory stays capped however disordered the
+    input, and the output is ordered throughout.
+
+    Without a window, nothing is emitted until the input runs out. With one,
+    every spill is also a checkpoint: the attacks older than the watermark
+    are taken from the fronts of the runs and emitted, leaving the rest
+    where they are. Attacks that turn up below a checkpoint's watermark
+    anyway count as late events. Runs are merged in tiers: once there are
+    MERGE_FAN_IN runs that have been through as many merges, they're merged
+    into one, which has been through one more. So each attack is rewritten
+    only O(log n) times, and fewer than MERGE_FAN_IN runs of each tier are
+    ever open.
+
+    Like an EventStream, it iterates over formatted events, and its
+    iter_attacks yields the attacks themselves.
+
+    Args:
+        buffer_bytes:   roughly the most memory to hold attacks in
+        window:         the number of seconds within which events can be
+                        expected to have arrived, or None for no bound
+    """
+    def __init__(self, input_stream, buffer_bytes=BUFFER_BYTES, window=None):
+        self.input_stream = iter(input_stream)
+        self.window = window
+        self.buffer_bytes = buffer_bytes
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.runs = []
+        self.latest_attack = None
+        self.late_events = 0
+        # The most attacks held in memory at once, the number of runs
+        # spilled to disk so far, and the attacks written to runs, spilled
+        # and merged alike
+        self.peak_buffered = 0
+        self.spills = 0
+        self.written = 0
+        self.attacks = self.generate()
+        self.events = itertools.imap(EventStream.format_attack, self.attacks)
+
+    def add_run(self, attacks, level=0):
+        run = Run(attacks, level)
+        self.written += run.size
+        self.runs.append(run)
+
+    def spill(self):
+        """
+        Sorts the attacks held in memory into a run on disk, then merges any
+        tier that's full, from the smallest up
+        """
+        self.peak_buffered = max(self.peak_buffered, len(self.buffer))
+        self.buffer.sort()
+        self.add_run(self.buffer)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.spills += 1
+        level = 0
+        while True:
+            tier = [run for run in self.runs if run.level == level]
+            if len(tier) < MERGE_FAN_IN:
+                break
+            self.runs = [run for run in self.runs if run.level != level]
+            self.add_run(heapq.merge(*tier), level + 1)
+            level += 1
+
+    def checkpoint(self, watermark):
+        """
+        Yields every attack older than the watermark, in order, taking them
+        from the fronts of the runs, which keep the rest
+        """
+        heap = [(run.head, number) for number, run in enumerate(self.runs)
+            if run.head[0] < watermark]
+        heapq.heapify(heap)
+        while heap:
+            attack, number = heapq.heappop(heap)
+            run = self.runs[number]
+            yield run.take()
+            if run.head is not None and run.head[0] < watermark:
+                heapq.heappush(heap, (run.head, number))
+        self.runs = [run for run in self.runs if run.head is not None]
+
+    def generate(self):
+        """
+        Yields every attack in order (but for late events)
+        """
+        watermark = None
+        for record in self.input_stream:
+            attack = EventStream.parse_event(record)
+            self.buffer.append(attack)
+            self.buffered_bytes += len(attack[1]) + ATTACK_OVERHEAD
+            if self.latest_attack is None or attack[0] > self.latest_attack:
+                self.latest_attack = attack[0]
+            elif watermark is not None and attack[0] < watermark:
+                self.late_events += 1
+            if self.buffered_bytes > self.buffer_bytes:
+                self.spill()
+                if self.window is not None:
+                    watermark = self.latest_attack - self.window
+                    for ready in self.checkpoint(watermark):
+                        yield ready
+        self.input_stream = None
+        self.peak_buffered = max(self.peak_buffered, len(self.buffer))
+        self.buffer.sort()
+        runs = self.runs + [self.buffer]
+        self.runs, self.buffer, self.buffered_bytes = [], [], 0
+        for attack in heapq.merge(*runs):
+            yield attack
+
+    def __iter__(self):
+        return self
+
+    def iter_attacks(self):
+        """
+        Yields the attacks themselves, as (attack_time, city) tuples, in the
+        order next would emit them
+        """
+        return self.attacks
+
+    def next(self):
+        return next(self.events)
+
+class MergedEventStream(object):
+    """
+    One ordered stream of the events of many input streams, each of them
+    only a little out of order by itself. Each input stream is reordered by
+    an EventStream with its own window, and their attacks are merged with
+    heapq.merge, which keeps a heap of each stream's next attack. Only each
+    stream's window is ever held, rather than the window a single
+    EventStream of them all would need.
+
+    Args:
+        input_streams:  the files or other iterables of attack records
+        window:         the number of seconds within which each stream's
+                        events can be expected to have arrived
+    """
+    def __init__(self, input_streams, window=300):
+        self.streams = [EventStream(input_stream, window)
+            for input_stream in input_streams]
+        self.events = itertools.imap(EventStream.format_attack,
+            heapq.merge(*[stream.iter_attacks() for stream in self.streams]))
+
+    @property
+    def late_events(self):
+        return sum(stream.late_events for stream in self.streams)
+
+    @property
+    def peak_buffered(self):
+        """
+        The most attacks held at once, or at least a bound on it: the sum of
+        each stream's most
+        """
+        return sum(stream.peak_buffered for stream in self.streams)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self.events)
 
 def event_stream(stream_obj):
     """
@@ -113,11 +580,24 @@ def update_model(event):
 
 def main(args):
     """
-    Main logging method
+    Main logging method. Several files are each reordered by themselves and
+    merged, rather than read as one stream.
     """
-    for event in event_stream(fileinput.input(args)):
-        update_model(event)
-        print(event)
+    if len(args) < 2:
+        events = event_stream(fileinput.input(args))
+        files = []
+    else:
+        files = [sys.stdin if path == '-' else open(path, 'rb')
+            for path in args]
+        events = MergedEventStream(files)
+    try:
+        for event in events:
+            update_model(event)
+            print(event)
+    finally:
+        for log_file in files:
+            if log_file is not sys.stdin:
+                log_file.close()
 
 if __name__ == "__main__":
     main(sys.argv[1:])
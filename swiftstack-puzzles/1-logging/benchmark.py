@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Throughput of the ways of reading and reordering an event stream, over a
+file generated by sample-file-generator.py.
+
+USAGE:
+    python benchmark.py [ticks] [lines_per_tick]
+"""
+
+import imp
+import os
+import random
+import sys
+import tempfile
+import time
+
+import answer
+
+generator = imp.load_source('sample_file_generator',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'sample-file-generator.py'))
+
+def parse_lines(path):
+    with open(path, 'rb') as records:
+        for record in records:
+            answer.EventStream.parse_event(record)
+
+def parse_blocks(path):
+    with open(path, 'rb') as records:
+        for block in answer.read_blocks(records):
+            answer.parse_block(block)
+
+def reorder(stream_class):
+    def run(path):
+        with open(path, 'rb') as records:
+            for _ in stream_class(records):
+                pass
+    return run
+
+CASES = [
+    ('parse, per line', parse_lines),
+    ('parse, blocks', parse_blocks),
+    ('EventStream', reorder(answer.EventStream)),
+    ('BlockEventStream', reorder(answer.BlockEventStream)),
+    ('SortedBlockEventStream', reorder(answer.SortedBlockEventStream)),
+    ('SpillingEventStream', reorder(answer.SpillingEventStream)),
+]
+
+def main(args):
+    """
+    Generates a sample file and times each case over it
+    """
+    ticks = int(args[0]) if args else generator.TICKS
+    lines_per_tick = int(args[1]) if len(args) > 1 else \
+        generator.LINES_PER_TICK
+    random.seed(0)
+    descriptor, path = tempfile.mkstemp(suffix='.log')
+    try:
+        with os.fdopen(descriptor, 'w') as sample:
+            for line in generator.log_lines(time.time(), ticks,
+                    lines_per_tick):
+                sample.write(line + '\n')
+        lines = ticks * lines_per_tick
+        print("%d lines, NumPy %s" % (lines,
+            "installed" if answer.numpy is not None else "not installed"))
+        print("%-24s %10s %14s" % ("case", "seconds", "lines/second"))
+        for name, case in CASES:
+            start = time.time()
+            case(path)
+            seconds = time.time() - start
+            print("%-24s %9.2fs %14d" % (name, seconds, lines / seconds))
+    finally:
+        os.unlink(path)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,7 +4,7 @@
 import time
 import random
 
-JITTER = 275 
+JITTER = 275
 TICKS = 1000
 LINES_PER_TICK = 1000
 
@@ -12,9 +12,12 @@ def log_line(now):
     timestamp = now - (random.random() * JITTER)
     return "%f   City %d" % (timestamp, random.randint(0,10000))
 
-start = time.time()
+def log_lines(start, ticks=TICKS, lines_per_tick=LINES_PER_TICK):
+    for tick in xrange(ticks):
+        now = start + tick
+        for num_line in xrange(lines_per_tick):
+            yield log_line(now)
 
-for tick in xrange(TICKS):
-    now = start + tick
-    for num_line in xrange(LINES_PER_TICK):
-        print(log_line(now))
+if __name__ == "__main__":
+    for line in log_lines(time.time()):
+        print(line)
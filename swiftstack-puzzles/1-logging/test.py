@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Tests for the logging puzzle's EventStream.
+"""
+
+import answer
+import imp
+import os
+import random
+import StringIO
+import sys
+import tempfile
+import unittest
+
+generator = imp.load_source('sample_file_generator',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'sample-file-generator.py'))
+
+def records(times):
+    """
+    Makes a record for each attack time, naming the city after its position
+    """
+    return ["%f   City %d" % (attack_time, position)
+        for position, attack_time in enumerate(times)]
+
+def attack_times(events):
+    return [float(event.split('   ', 1)[0]) for event in events]
+
+class testEventStream(unittest.TestCase):
+    """
+    Tests for reordering an event stream
+    """
+    def testOrder(self):
+        """
+        Make sure that events come out in order, ties broken by city
+        """
+        events = list(answer.EventStream(records([5, 3, 9, 3, 1, 12]),
+            window=10))
+        self.assertEqual(events, [
+            '  1.000000   City 4',
+            '  3.000000   City 1',
+            '  3.000000   City 3',
+            '  5.000000   City 0',
+            '  9.000000   City 2',
+            ' 12.000000   City 5',
+        ])
+
+    def testWatermark(self):
+        """
+        Make sure that events are emitted as soon as the watermark passes
+        them, and not before
+        """
+        stream = answer.EventStream(iter(records([100, 95, 120, 111, 90])),
+            window=10)
+        self.assertEqual(attack_times([stream.next()]), [95])
+        self.assertEqual(list(stream.ready), [(100, 'City 0')])
+        self.assertEqual(stream.attack_heap, [(120, 'City 2')])
+        self.assertEqual(attack_times(stream), [100, 90, 111, 120])
+        self.assertEqual(stream.late_events, 1)
+
+    def testSpike(self):
+        """
+        Make sure that a spike from the future doesn't lose any events
+        """
+        times = [10, 11, 5000, 12, 13, 14]
+        stream = answer.EventStream(records(times), window=10)
+        self.assertEqual(attack_times(stream), [10, 11, 12, 13, 14, 5000])
+        self.assertEqual(stream.late_events, 3)
+
+    def testPeakBuffered(self):
+        """
+        Make sure that only the events inside the window are ever held, on
+        the sample file generator's workload
+        """
+        random.seed(0)
+        ticks, lines_per_tick = 1000, 100
+        lines = list(generator.log_lines(1363359470, ticks, lines_per_tick))
+        stream = answer.EventStream(lines)
+        times = attack_times(stream)
+        self.assertEqual(times, sorted(float(line.split()[0])
+            for line in lines))
+        self.assertEqual(stream.late_events, 0)
+        # Anything held is newer than the watermark, so it was generated in
+        # the last window + 2 ticks. Events are up to JITTER seconds older
+        # than their tick, so in fact only a little over half of those are.
+        self.assertTrue(stream.peak_buffered <=
+            (stream.window + 2) * lines_per_tick)
+        self.assertTrue(stream.peak_buffered <
+            0.6 * stream.window * lines_per_tick)
+
+class testBlockEventStream(unittest.TestCase):
+    """
+    Tests for reading and parsing an event stream a block at a time
+    """
+    def testReadBlocks(self):
+        """
+        Make sure that blocks only ever hold whole lines, from files and
+        from iterables of lines
+        """
+        text = ''.join(record + '\n' for record in records(range(100)))
+        for block_size in (1, 7, 64, len(text) * 2):
+            blocks = list(answer.read_blocks(StringIO.StringIO(text),
+                block_size))
+            self.assertEqual(''.join(blocks), text)
+            self.assertTrue(all(block.endswith('\n') for block in blocks))
+        blocks = list(answer.read_blocks(StringIO.StringIO('1   A\n2   B')))
+        self.assertEqual(blocks, ['1   A\n', '2   B'])
+        self.assertEqual(''.join(answer.read_blocks(text.splitlines(True))),
+            text)
+
+    def testParseBlock(self):
+        """
+        Make sure that a block parses just like its lines do one at a time,
+        with and without NumPy
+        """
+        regular = '12.5   Paris, TX, USA\n3    Kyoto, Japan\n4   X'
+        irregular = '  12.5   Paris, TX, USA\r\n\n3   Kyoto,   Japan  \n4   X'
+        numpy = answer.numpy
+        try:
+            for answer.numpy in set([None, numpy]):
+                for block in (regular, irregular, regular + '\n'):
+                    times, cities = answer.parse_block(block)
+                    self.assertEqual(zip(times, cities),
+                        [answer.EventStream.parse_event(line)
+                            for line in block.splitlines() if line])
+                times, cities = answer.parse_block('')
+                self.assertEqual((list(times), cities), ([], []))
+        finally:
+            answer.numpy = numpy
+
+    def testParseMalformedBlock(self):
+        """
+        Make sure that malformed records raise, with and without NumPy, even
+        when the block holds as many separators as lines
+        """
+        # One line lacks a separator, and the next has a spare one
+        shifted = '12.5\n13.5   1   2\n'
+        unconvertible = '12.5   Paris\n1e   Kyoto\n3   X\n'
+        numpy = answer.numpy
+        try:
+            for answer.numpy in set([None, numpy]):
+                for block in (shifted, unconvertible):
+                    self.assertRaises(ValueError, answer.parse_block, block)
+        finally:
+            answer.numpy = numpy
+
+    def testMatchesEventStream(self):
+        """
+        Make sure that events come out just as they do from an EventStream,
+        on the sample file generator's workload
+        """
+        random.seed(1)
+        text = ''.join(line + '\n' for line in
+            generator.log_lines(1363359470, 600, 20))
+        expected = list(answer.EventStream(text.splitlines(True)))
+        for block_size in (4096, answer.BLOCK_SIZE):
+            self.assertEqual(list(answer.BlockEventStream(
+                StringIO.StringIO(text), block_size=block_size)), expected)
+        self.assertEqual(list(answer.BlockEventStream(
+            text.splitlines(True))), expected)
+
+class testSortedBlockEventStream(unittest.TestCase):
+    """
+    Tests for reordering an event stream a block at a time
+    """
+    def testSortBlock(self):
+        """
+        Make sure that blocks sort like tuples, ties included, with and
+        without NumPy
+        """
+        numpy = answer.numpy
+        try:
+            for answer.numpy in set([None, numpy]):
+                for times in ([3.0, 1.0, 2.0], [3.0, 1.0, 3.0, 1.0], [1.0]):
+                    cities = ['City %d' % (9 - position)
+                        for position in range(len(times))]
+                    times_array, _ = answer.parse_block(''.join(
+                        record + '\n' for record in records(times)))
+                    self.assertEqual(answer.sort_block(times_array, cities),
+                        sorted(zip(times, cities)))
+        finally:
+            answer.numpy = numpy
+
+    def testMatchesEventStream(self):
+        """
+        Make sure that events come out just as they do from an EventStream,
+        ties included, on the sample file generator's workload
+        """
+        random.seed(2)
+        lines = []
+        for position, line in enumerate(generator.log_lines(1363359470,
+                600, 20)):
+            lines.append(line)
+            # Some ties, which must be broken by city
+            if position % 50 == 0:
+                lines.append(line.split()[0] + '   City X')
+        text = ''.join(line + '\n' for line in lines)
+        expected = list(answer.EventStream(lines))
+        for block_size in (answer.BLOCK_SIZE, 4096):
+            stream = answer.SortedBlockEventStream(StringIO.StringIO(text),
+                block_size=block_size)
+            self.assertEqual(list(stream), expected)
+        # A window's events, a bucket's and a block's (of about 20 bytes per
+        # line) at 20 lines per tick
+        self.assertTrue(stream.peak_buffered < (0.6 * stream.window +
+            stream.bucket_size) * 20 + 4096 / 20)
+        # Attacks themselves come out as tuples, like an EventStream's
+        stream = answer.SortedBlockEventStream(StringIO.StringIO(text))
+        self.assertEqual(list(stream.iter_attacks()),
+            list(answer.EventStream(lines).iter_attacks()))
+
+    def testSpike(self):
+        """
+        Make sure that a spike from the future doesn't lose any events
+        """
+        stream = answer.SortedBlockEventStream([record + '\n' for record in
+            records([10, 11, 5000, 12, 13, 14])], window=10)
+        self.assertEqual(attack_times(stream), [10, 11, 12, 13, 14, 5000])
+        self.assertEqual(stream.late_events, 0)
+        stream = answer.SortedBlockEventStream(StringIO.StringIO(''.join(
+            record + '\n' for record in records([10, 11, 5000, 12, 10.5]))),
+            window=10, block_size=40)
+        # 12 arrives in the same block as 5000, so only 10.5 is late
+        self.assertEqual(attack_times(stream), [10, 11, 12, 10.5, 5000])
+        self.assertEqual(stream.late_events, 1)
+
+class testSpillingEventStream(unittest.TestCase):
+    """
+    Tests for reordering an event stream with runs spilled to disk
+    """
+    def testMatchesEventStream(self):
+        """
+        Make sure that events come out just as they do from an EventStream,
+        with and without checkpoints, while memory stays within the budget,
+        on the sample file generator's workload
+        """
+        random.seed(3)
+        lines = list(generator.log_lines(1363359470, 600, 20))
+        expected = list(answer.EventStream(lines))
+        for window in (None, 300):
+            stream = answer.SpillingEventStream(lines, buffer_bytes=100000,
+                window=window)
+            self.assertEqual(list(stream), expected)
+            self.assertEqual(stream.late_events, 0)
+            self.assertTrue(stream.spills > 10)
+            # Checkpoints leave the attacks they don't emit where they are
+            self.assertTrue(stream.written <= len(lines))
+            self.assertTrue(stream.peak_buffered * answer.ATTACK_OVERHEAD <=
+                100000 + answer.ATTACK_OVERHEAD)
+
+    def testUnboundedDisorder(self):
+        """
+        Make sure that input hours out of order, in more runs than are
+        merged at once, comes out in order, and that times keep their full
+        precision on disk
+        """
+        lines = ['1.0000002   City 1000'] + \
+            records(7200 - position * 7 for position in range(1000)) + \
+            ['1.0000001   City 1001']
+        stream = answer.SpillingEventStream(lines, buffer_bytes=1000)
+        events = list(stream)
+        self.assertEqual(attack_times(events), sorted(attack_times(events)))
+        self.assertEqual(events[:2], ['  1.000000   City 1001',
+            '  1.000000   City 1000'])
+        self.assertTrue(stream.spills > answer.MERGE_FAN_IN)
+        self.assertEqual(stream.runs, [])
+
+    def testTieredMerge(self):
+        """
+        Make sure that only full tiers of runs are merged, so that each
+        attack is rewritten once per tier rather than once per merge
+        """
+        lines = records(20000 - position * 3 for position in range(3200))
+        stream = answer.SpillingEventStream(lines, buffer_bytes=1000)
+        attacks = stream.iter_attacks()
+        self.assertEqual(next(attacks), (20000 - 3199 * 3, 'City 3199'))
+        self.assertTrue(stream.spills > 6 * answer.MERGE_FAN_IN)
+        # Each attack was spilled, and merged into the second tier at most
+        self.assertTrue(stream.written <= 2 * len(lines))
+        self.assertEqual(len(list(attacks)), len(lines) - 1)
+
+    def testLateEvents(self):
+        """
+        Make sure that events below a checkpoint's watermark are counted as
+        late, and still emitted
+        """
+        stream = answer.SpillingEventStream(records([10, 11, 5000, 12, 13]),
+            buffer_bytes=2 * answer.ATTACK_OVERHEAD, window=10)
+        self.assertEqual(attack_times(stream), [10, 11, 12, 13, 5000])
+        self.assertEqual(stream.late_events, 1)
+
+class testMergedEventStream(unittest.TestCase):
+    """
+    Tests for merging many event streams into one
+    """
+    def testMerge(self):
+        """
+        Make sure that streams each a little out of order, but far behind
+        one another, come out merged in order while only their own windows
+        are held
+        """
+        random.seed(4)
+        sources = [["%f   City %d" % (tick - lag + random.random() * 5, lag)
+            for tick in range(1000) for _ in range(10)]
+            for lag in range(0, 600, 60)]
+        stream = answer.MergedEventStream(sources, window=10)
+        events = list(stream)
+        self.assertEqual(events, map(answer.EventStream.format_attack,
+            sorted(map(answer.EventStream.parse_event, sum(sources, [])))))
+        self.assertEqual(stream.late_events, 0)
+        # Each stream holds its last window and a tick, at 10 lines per tick
+        self.assertTrue(stream.peak_buffered <= len(sources) * 11 * 10)
+
+    def testMain(self):
+        """
+        Make sure that several files given to main are merged in order
+        """
+        paths = []
+        stdout = sys.stdout
+        try:
+            for times in ([3, 1, 4], [2, 7, 5]):
+                descriptor, path = tempfile.mkstemp()
+                paths.append(path)
+                with os.fdopen(descriptor, 'w') as log_file:
+                    log_file.writelines(record + '\n'
+                        for record in records(times))
+            sys.stdout = StringIO.StringIO()
+            answer.main(paths)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            for path in paths:
+                os.unlink(path)
+        self.assertEqual(attack_times(output.splitlines()),
+            [1, 2, 3, 4, 5, 7])
+
+if __name__ == '__main__':
+    unittest.main()